@@ -0,0 +1,5 @@
+"""
+Benchmarks for gmail-yaml-filters. These are not run as part of the test suite;
+run the whole suite with ``python -m benchmarks`` (or ``tox -e benchmarks``),
+or a single comparison directly, e.g. ``python -m benchmarks.foreach``.
+"""
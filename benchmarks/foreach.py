@@ -0,0 +1,65 @@
+"""
+Compares building a large `for_each` loop from a compiled RuleTemplate
+against rebuilding and formatting the rule for every item, which is how
+RuleSet.from_foreach_dict worked before templates were compiled.
+"""
+
+import argparse
+import timeit
+
+from gmail_yaml_filters.ruleset import RuleSet
+
+
+def foreach_data(items):
+    return {
+        "for_each": [
+            {"list": "list{}".format(n), "domain": "example{}.com".format(n % 50)}
+            for n in range(items)
+        ],
+        "rule": {
+            "list": "{list}.{domain}",
+            "label": "lists/{list}",
+            "archive": True,
+            "more": [
+                {"from": {"any": ["boss@{domain}", "ceo@{domain}"]}, "star": True},
+                {"subject": "weekly digest", "read": True},
+            ],
+        },
+    }
+
+
+def build_uncompiled(data):
+    ruleset = RuleSet()
+    for index, item in enumerate(data["for_each"]):
+        item_ruleset = RuleSet.from_object(data["rule"])
+        for rule in item_ruleset:
+            rule.apply_format(index=index, **item)
+        ruleset.update(item_ruleset)
+    return ruleset
+
+
+def build_compiled(data):
+    return RuleSet.from_object(data)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--items", type=int, default=2000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    data = foreach_data(args.items)
+    assert [r.fingerprint for r in build_uncompiled(data)] == [
+        r.fingerprint for r in build_compiled(data)
+    ]
+
+    results = {}
+    for name, func in (("uncompiled", build_uncompiled), ("compiled", build_compiled)):
+        timer = timeit.Timer(lambda: func(data))
+        results[name] = min(timer.repeat(repeat=args.repeat, number=1))
+        print("{0:>10}: {1:.3f}s".format(name, results[name]))
+    print("   speedup: {0:.1f}x".format(results["uncompiled"] / results["compiled"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""
+Synthetic configurations for benchmarks. Each function returns data in the
+same shape as a parsed YAML file, i.e. something RuleSet.from_object accepts.
+"""
+
+
+def flat_rules(count):
+    """Independent rules with a handful of conditions and actions each."""
+    return [
+        {
+            "from": "sender{0}@example{1}.com".format(n, n % 100),
+            "subject": "report {0}".format(n),
+            "label": "senders/{0}".format(n % 250),
+            "archive": True,
+        }
+        for n in range(count)
+    ]
+
+
+def deep_more(depth, width):
+    """A tree of `more:` rules, `depth` levels deep with `width` children per rule."""
+
+    def level(remaining, path):
+        rule = {
+            "to": "team{0}@example.com".format(path),
+            "label": "teams/{0}".format(path),
+        }
+        if remaining > 1:
+            rule["more"] = [
+                level(remaining - 1, "{0}.{1}".format(path, n)) for n in range(width)
+            ]
+        return rule
+
+    return [level(depth, str(n)) for n in range(width)]
+
+
+def wide_foreach(items):
+    """A single `for_each` loop over many mailing lists."""
+    return [
+        {
+            "for_each": [
+                {"list": "list{0}".format(n), "domain": "example{0}.com".format(n % 50)}
+                for n in range(items)
+            ],
+            "rule": {
+                "list": "{list}.{domain}",
+                "label": "lists/{list}",
+                "archive": True,
+                "more": [{"from": "boss@{domain}", "star": True}],
+            },
+        }
+    ]
+
+
+def big_any_all(count, terms):
+    """Rules whose conditions are long `any:` and `all:` lists."""
+    return [
+        {
+            "from": {
+                "any": ["user{0}.{1}@example.com".format(n, t) for t in range(terms)]
+            },
+            "has": {
+                "all": ["keyword{0}".format(t) for t in range(terms)],
+                "not": {"any": ["spam{0}".format(t) for t in range(terms)]},
+            },
+            "label": "big/{0}".format(n),
+        }
+        for n in range(count)
+    ]
+
+
+def sender_rules(count):
+    """Rules matching senders, domains, mailing lists and subjects."""
+    rules = []
+    for n in range(count):
+        kind = n % 4
+        if kind == 0:
+            rule = {"from": "sender{0}@example{1}.com".format(n, n % 100)}
+        elif kind == 1:
+            rule = {"from": "@domain{0}.org".format(n)}
+        elif kind == 2:
+            rule = {"list": "list{0}.example.com".format(n)}
+        else:
+            rule = {"to": "me@example.com", "subject": "invoice{0}".format(n)}
+        rule["label"] = "senders/{0}".format(n % 250)
+        rules.append(rule)
+    return rules
+
+
+def messages(count, senders):
+    """Raw messages, some of which match rules from sender_rules(senders)."""
+    for n in range(count):
+        sender = n * 7 % (senders * 2)  # half of these have no rule
+        lines = [
+            "From: Sender {0} <sender{0}@example{1}.com>".format(sender, sender % 100),
+            "To: me@example.com",
+            "Subject: invoice{0} for {1}".format(sender, n),
+            "Date: Mon, 20 May 2024 10:00:00 +0000",
+        ]
+        if n % 3 == 0:
+            lines.append("List-Id: <list{0}.example.com>".format(sender))
+        if n % 5 == 0:
+            lines.append("Cc: someone@domain{0}.org".format(sender))
+        yield ("\n".join(lines) + "\n\nHello\n").encode("utf-8")
@@ -0,0 +1,56 @@
+"""
+Compares matching messages against a RuleIndex, which only tests each
+message against the rules it might match, with testing every message
+against every rule.
+"""
+
+import argparse
+import timeit
+
+from gmail_yaml_filters.query import criteria_query, rule_criteria
+from gmail_yaml_filters.ruleset import RuleSet
+from gmail_yaml_filters.simulate import Needs, RuleIndex, parse_message
+
+from . import generators
+
+
+def index_and_messages(rules, messages):
+    ruleset = RuleSet.from_object(generators.sender_rules(rules))
+    queries = [criteria_query(rule_criteria(rule)) for rule in ruleset]
+    needs = Needs.of(queries)
+    return RuleIndex(queries), [
+        parse_message(data, needs) for data in generators.messages(messages, rules)
+    ]
+
+
+def match_indexed(index, messages):
+    return [sorted(index.matches(message)) for message in messages]
+
+
+def match_brute_force(index, messages):
+    return [index.match_all(message) for message in messages]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rules", type=int, default=2000)
+    parser.add_argument("--messages", type=int, default=5000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    index, messages = index_and_messages(args.rules, args.messages)
+    assert match_indexed(index, messages) == match_brute_force(index, messages)
+
+    results = {}
+    for name, func in (
+        ("brute force", match_brute_force),
+        ("indexed", match_indexed),
+    ):
+        timer = timeit.Timer(lambda: func(index, messages))
+        results[name] = min(timer.repeat(repeat=args.repeat, number=1))
+        print("{0:>11}: {1:.3f}s".format(name, results[name]))
+    print("    speedup: {0:.1f}x".format(results["brute force"] / results["indexed"]))
+
+
+if __name__ == "__main__":
+    main()
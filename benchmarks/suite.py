@@ -0,0 +1,232 @@
+"""
+Measures wall time and peak memory of the main code paths: building a RuleSet,
+flattening rules, serializing XML, converting rules to API resources,
+uploading/pruning against an in-memory fake of the Gmail API, and matching
+messages against rules.
+
+Results can be saved as JSON and compared against a previous run, in which
+case the exit status is non-zero if anything got slower (or bigger) by more
+than the given tolerance.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import sys
+import time
+import tracemalloc
+from collections import namedtuple
+
+from gmail_yaml_filters.cache import RuleCache
+from gmail_yaml_filters.main import ruleset_to_xml
+from gmail_yaml_filters.ruleset import RuleSet
+from gmail_yaml_filters.scheduler import RequestScheduler, use_scheduler
+from gmail_yaml_filters.upload import (
+    GmailLabels,
+    prune_filters_not_in_ruleset,
+    rule_to_resource,
+    upload_ruleset,
+)
+from tests.fake_gmail import FakeGmail, remote_filter, user_label
+
+from . import generators
+from .matching import index_and_messages, match_indexed
+
+#: setup() returns the argument to run(); only run() is measured.
+Benchmark = namedtuple("Benchmark", ["name", "setup", "run"])
+
+
+def _flatten_all(ruleset):
+    for rule in ruleset:
+        rule.flatten()
+
+
+def _resources(args):
+    ruleset, gmail = args
+    labels = GmailLabels(gmail)
+    for rule in ruleset:
+        rule_to_resource(rule, labels)
+
+
+def _upload(args):
+    ruleset, gmail = args
+    upload_ruleset(ruleset, service=gmail)
+
+
+def _prune(args):
+    ruleset, gmail = args
+    prune_filters_not_in_ruleset(ruleset, service=gmail)
+
+
+def _build_cached(args):
+    data, cache = args
+    RuleSet.from_object(data, cache=cache)
+
+
+def _match_indexed(args):
+    match_indexed(*args)
+
+
+def _service_for(ruleset, remote_filters):
+    labels = {
+        action.value
+        for rule in ruleset
+        for action in rule.actions
+        if action.key == "label"
+    }
+    gmail = FakeGmail(
+        labels=[user_label(name) for name in sorted(labels)],
+        filters=[remote_filter(n) for n in range(remote_filters)],
+    )
+    # measure our own overhead, not Gmail's rate limit
+    use_scheduler(gmail, RequestScheduler(rate=None))
+    return gmail
+
+
+def benchmarks(scale=1.0):
+    """
+    Returns the list of benchmarks. Sizes are multiplied by scale.
+    """
+
+    def size(n):
+        return max(1, int(n * scale))
+
+    flat = generators.flat_rules(size(2000))
+
+    def ruleset():
+        return RuleSet.from_object(flat)
+
+    def warm_cache():
+        # one entry has changed since the cache was filled
+        cache = RuleCache(":memory:")
+        RuleSet.from_object(flat, cache=cache)
+        return (flat[:-1] + [dict(flat[-1], subject="changed")], cache)
+
+    def with_service(remote_filters):
+        def setup():
+            rules = ruleset()
+            return (rules, _service_for(rules, remote_filters))
+
+        return setup
+
+    return [
+        Benchmark("compile/flat", lambda: flat, RuleSet.from_object),
+        Benchmark(
+            "compile/deep_more",
+            lambda: generators.deep_more(4, size(7)),
+            RuleSet.from_object,
+        ),
+        Benchmark(
+            "compile/wide_foreach",
+            lambda: generators.wide_foreach(size(2000)),
+            RuleSet.from_object,
+        ),
+        Benchmark(
+            "compile/big_any_all",
+            lambda: generators.big_any_all(size(200), 20),
+            RuleSet.from_object,
+        ),
+        Benchmark("compile/cached_one_changed", warm_cache, _build_cached),
+        Benchmark("flatten", ruleset, _flatten_all),
+        Benchmark("serialize/xml", ruleset, ruleset_to_xml),
+        Benchmark("upload/rule_to_resource", with_service(0), _resources),
+        Benchmark("upload/upload_ruleset", with_service(size(500)), _upload),
+        Benchmark("upload/prune", with_service(size(500)), _prune),
+        Benchmark(
+            "simulate/match_indexed",
+            lambda: index_and_messages(size(2000), size(2000)),
+            _match_indexed,
+        ),
+    ]
+
+
+def measure(benchmark, repeat=3):
+    """
+    Returns (best wall time in seconds, peak memory in bytes) of benchmark.run.
+    Memory is measured on a separate run, since tracing slows everything down.
+    """
+    # the API functions report what they're doing on stderr
+    with contextlib.redirect_stderr(io.StringIO()):
+        times = []
+        for _ in range(repeat):
+            arg = benchmark.setup()
+            start = time.perf_counter()
+            benchmark.run(arg)
+            times.append(time.perf_counter() - start)
+
+        arg = benchmark.setup()
+        tracemalloc.start()
+        try:
+            benchmark.run(arg)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+    return min(times), peak
+
+
+def compare(results, baseline, tolerance):
+    """
+    Returns a list of human-readable regressions of results against baseline.
+    """
+    regressions = []
+    for name, current in sorted(results.items()):
+        if name not in baseline:
+            continue
+        for metric in ("seconds", "peak_bytes"):
+            before, after = baseline[name][metric], current[metric]
+            if before and after > before * (1 + tolerance):
+                regressions.append(
+                    "{0} {1}: {2:.4g} -> {3:.4g} (+{4:.0%})".format(
+                        name, metric, before, after, after / before - 1
+                    )
+                )
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks",
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument("--scale", type=float, default=1.0, help="multiply sizes by N")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--only", metavar="PREFIX", help="only run matching names")
+    parser.add_argument("--save", metavar="JSON_FILE", help="write results to a file")
+    parser.add_argument(
+        "--compare", metavar="JSON_FILE", help="compare with saved results"
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.25,
+        help="allowed slowdown when comparing, as a fraction (default 0.25)",
+    )
+    args = parser.parse_args(argv)
+
+    results = {}
+    for benchmark in benchmarks(scale=args.scale):
+        if args.only and not benchmark.name.startswith(args.only):
+            continue
+        seconds, peak = measure(benchmark, repeat=args.repeat)
+        results[benchmark.name] = {"seconds": seconds, "peak_bytes": peak}
+        print(
+            "{0:<28} {1:>9.4f}s {2:>10.1f} KiB".format(
+                benchmark.name, seconds, peak / 1024
+            )
+        )
+
+    if args.save:
+        with open(args.save, "w") as outputf:
+            json.dump(results, outputf, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as inputf:
+            regressions = compare(results, json.load(inputf), args.tolerance)
+        for regression in regressions:
+            print("REGRESSION:", regression, file=sys.stderr)
+        return 1 if regressions else 0
+
+    return 0
@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+
+import yaml
+
+from .plan import apply_plan, make_plan
+from .ruleset import RuleSet
+
+"""
+Syncs filters for many Gmail accounts at once, based on a manifest which
+says which configuration files apply to which account.
+
+A manifest is a YAML list like this one; paths are relative to the manifest:
+
+    - name: alice
+      credential_store: credentials/alice.json
+      filters: [common.yaml, alice.yaml]
+    - credential_store: credentials/bob.json
+      filters: common.yaml
+"""
+
+
+class Account(object):
+    def __init__(self, name, credential_store, filenames):
+        self.name = name
+        self.credential_store = credential_store
+        self.filenames = list(filenames)
+
+    def __repr__(self):
+        return "{0}({1!r}, {2!r}, {3!r})".format(
+            self.__class__.__name__, self.name, self.credential_store, self.filenames
+        )
+
+    def __eq__(self, other):
+        return isinstance(other, Account) and (
+            (self.name, self.credential_store, self.filenames)
+            == (other.name, other.credential_store, other.filenames)
+        )
+
+
+def load_manifest(filename):
+    """
+    Returns a list of Accounts from a manifest file.
+    """
+    with open(filename) as inputf:
+        entries = yaml.safe_load(inputf) or []
+    if not isinstance(entries, list):
+        raise ValueError("{0}: expected a list of accounts".format(filename))
+    return accounts_from_manifest(entries, os.path.dirname(os.path.abspath(filename)))
+
+
+def accounts_from_manifest(entries, base_dir=""):
+    """
+    Returns a list of Accounts from parsed manifest entries, resolving
+    relative paths against base_dir.
+
+    >>> accounts_from_manifest(
+    ...     [{"credential_store": "alice.json", "filters": "common.yaml"}], "/etc"
+    ... )
+    [Account('alice', '/etc/alice.json', ['/etc/common.yaml'])]
+    """
+
+    def path(value):
+        return os.path.join(base_dir, os.path.expanduser(value))
+
+    accounts = []
+    names = set()
+    for entry in entries:
+        if not isinstance(entry, dict) or "credential_store" not in entry:
+            raise ValueError("account needs a credential_store: {0!r}".format(entry))
+        filenames = entry.get("filters", [])
+        if isinstance(filenames, str):
+            filenames = [filenames]
+        credential_store = path(entry["credential_store"])
+        name = (
+            entry.get("name") or os.path.splitext(os.path.basename(credential_store))[0]
+        )
+        if name in names:
+            raise ValueError("duplicate account name: {0!r}".format(name))
+        names.add(name)
+        accounts.append(
+            Account(name, credential_store, [path(value) for value in filenames])
+        )
+    return accounts
+
+
+def build_account_rulesets(accounts, build_file, errors=None):
+    """
+    Returns a dict of each account's name to the RuleSet built from all of
+    its configuration files. build_file is called once for each distinct file,
+    however many accounts use it, and must return a RuleSet.
+
+    If errors is a dict, any exception raised by build_file is stored in it
+    under the name of each account which uses that file, and those accounts
+    are left out of the result; otherwise the exception is raised.
+    """
+    by_filename = {}
+    rulesets = {}
+    for account in accounts:
+        ruleset = RuleSet()
+        for filename in account.filenames:
+            if filename not in by_filename:
+                try:
+                    by_filename[filename] = build_file(filename)
+                except Exception as exc:
+                    if errors is None:
+                        raise
+                    by_filename[filename] = exc
+            built = by_filename[filename]
+            if isinstance(built, Exception):
+                errors[account.name] = built
+                break
+            ruleset.update(built)
+        else:
+            rulesets[account.name] = ruleset
+    return rulesets
+
+
+class AccountResult(object):
+    """
+    What happened when syncing one account: the Plan that was applied,
+    or the exception which stopped it (in which case the plan may have
+    been partly applied).
+    """
+
+    def __init__(self, account, plan=None, error=None, seconds=0.0):
+        self.account = account
+        self.plan = plan
+        self.error = error
+        self.seconds = seconds
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+class _PrefixedOutput(object):
+    """
+    A file-like object which writes each complete line to another file,
+    prefixed with an account's name, so that the output of accounts which
+    are synced at the same time can be told apart.
+    """
+
+    _lock = threading.Lock()
+
+    def __init__(self, name, file):
+        self.prefix = "{0}: ".format(name)
+        self.file = file
+        self._partial = ""
+
+    def write(self, text):
+        lines = (self._partial + text).split("\n")
+        self._partial = lines.pop()
+        if lines:
+            with self._lock:
+                self.file.write("".join(self.prefix + line + "\n" for line in lines))
+        return len(text)
+
+    def flush(self):
+        if self._partial:
+            self.write("\n")
+        self.file.flush()
+
+
+def sync_account(
+    account, ruleset, connect, upload=True, prune=True, cache=None, **kwargs
+):
+    """
+    Syncs one account and returns an AccountResult, rather than raising.
+    Each change is printed to sys.stderr, prefixed with the account's name.
+    """
+    started = perf_counter()
+    plan = None
+    output = _PrefixedOutput(account.name, sys.stderr)
+    try:
+        service = connect(account)
+        plan = make_plan(ruleset, service, upload=upload, prune=prune, cache=cache)
+        apply_plan(plan, service, cache=cache, file=output, **kwargs)
+    except Exception as exc:
+        return AccountResult(account, plan, exc, perf_counter() - started)
+    finally:
+        output.flush()
+    return AccountResult(account, plan, None, perf_counter() - started)
+
+
+def sync_accounts(
+    accounts,
+    rulesets,
+    connect,
+    upload=True,
+    prune=True,
+    workers=4,
+    cache_for=None,
+    errors=None,
+    **kwargs
+):
+    """
+    Syncs each account with its RuleSet (from build_account_rulesets),
+    using up to `workers` threads. connect(account) must return a Gmail
+    service for the account, and cache_for(account), if given, a
+    SnapshotCache. Returns an AccountResult for each account, in order.
+
+    Accounts named in errors (as filled in by build_account_rulesets)
+    aren't synced, and fail with the error which stopped them being built.
+
+    Any other keyword arguments (dry_run, batch_size) are passed to apply_plan.
+    """
+
+    def sync(account):
+        if errors and account.name in errors:
+            return AccountResult(account, error=errors[account.name])
+        cache = cache_for(account) if cache_for else None
+        return sync_account(
+            account,
+            rulesets[account.name],
+            connect,
+            upload=upload,
+            prune=prune,
+            cache=cache,
+            **kwargs
+        )
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        return list(executor.map(sync, accounts))
+
+
+def report(results, file=None):
+    file = file or sys.stdout
+    row = "{0:<30} {1:>8} {2:>8} {3:>8} {4:>8}  {5}"
+    print(
+        row.format("account", "labels", "created", "deleted", "seconds", "status"),
+        file=file,
+    )
+    for result in results:
+        plan = result.plan
+        print(
+            row.format(
+                result.account.name,
+                "-" if plan is None else len(plan.labels),
+                "-" if plan is None else len(plan.create),
+                "-" if plan is None else len(plan.delete),
+                "{0:.1f}".format(result.seconds),
+                "ok" if result.ok else "failed: {0}".format(result.error),
+            ),
+            file=file,
+        )
@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+
+import json
+import os
+import pickle
+import sqlite3
+import tempfile
+import time
+from collections import deque
+from hashlib import blake2b
+from itertools import islice
+
+from .ruleset import Rule, RuleSet
+
+"""
+Keeps things on disk between runs, so that repeated runs don't need to do
+the same work again: a snapshot of a Gmail account's labels and filters,
+and the rules built from each top-level entry in a configuration file.
+"""
+
+
+#: How long (in seconds) a snapshot is trusted before it is fetched again.
+DEFAULT_TTL = 3600
+
+
+class SnapshotCache(object):
+    """
+    Stores lists of labels and filters (as returned by the Gmail API) for one
+    account in a JSON file, along with when each list was fetched.
+
+    As soon as anything is changed, the file is removed, and it is only
+    written again by save(). That way, if a run fails partway through,
+    the next run fetches everything again rather than trusting a snapshot
+    which no longer matches the account.
+
+    If path is None, the snapshot is only kept in memory.
+    """
+
+    kinds = ("labels", "filters")
+
+    def __init__(self, path, ttl=DEFAULT_TTL, refresh=False, account=None):
+        self.path = path
+        self.ttl = ttl
+        self.account = account
+        self._data = {}
+        self._dirty = False
+        if path and not refresh:
+            self._load()
+
+    @classmethod
+    def for_account(cls, cache_dir, account, **kwargs):
+        """
+        Returns the cache for the given account (any string which uniquely
+        identifies it, such as the path to its credential store).
+        """
+        digest = blake2b(account.encode("utf-8"), digest_size=16).hexdigest()
+        path = os.path.join(cache_dir, "{0}.json".format(digest))
+        return cls(path, account=account, **kwargs)
+
+    def _load(self):
+        try:
+            with open(self.path) as inputf:
+                data = json.load(inputf)
+        except (OSError, ValueError):
+            return
+        self._data = {kind: data[kind] for kind in self.kinds if kind in data}
+
+    def get(self, kind):
+        """
+        Returns the cached list of labels or filters, or None if there isn't one
+        or it has expired.
+        """
+        try:
+            entry = self._data[kind]
+        except KeyError:
+            return None
+        if time.time() - entry["fetched"] > self.ttl:
+            return None
+        return entry["items"]
+
+    def put(self, kind, items):
+        """Replaces the cached list of labels or filters."""
+        self._data[kind] = {"fetched": time.time(), "items": list(items)}
+        self._changed()
+
+    def add(self, kind, item):
+        """Records that a label or filter was created."""
+        if kind in self._data:
+            self._data[kind]["items"].append(item)
+            self._changed()
+
+    def remove(self, kind, item_id):
+        """Records that a label or filter was deleted."""
+        if kind in self._data:
+            items = self._data[kind]["items"]
+            items[:] = [item for item in items if item.get("id") != item_id]
+            self._changed()
+
+    def _changed(self):
+        if self.path and not self._dirty:
+            self._dirty = True
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+    def save(self):
+        """Writes the snapshot to disk, if anything has changed."""
+        if not (self.path and self._dirty):
+            return
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        data = dict(self._data, account=self.account)
+        with tempfile.NamedTemporaryFile(
+            "w", dir=directory, suffix=".tmp", delete=False
+        ) as outputf:
+            json.dump(data, outputf)
+        os.replace(outputf.name, self.path)
+        self._dirty = False
+
+
+def package_version():
+    """
+    Returns the installed version of this package (if it is installed) and
+    a digest of its source files, which changes whenever the code which
+    builds rules might have changed, even in an editable install or a
+    checkout with an older version installed.
+    """
+    installed = "dev"
+    try:
+        from importlib.metadata import PackageNotFoundError, version
+    except ImportError:  # pragma: no cover
+        pass
+    else:
+        try:
+            installed = version("gmail-yaml-filters")
+        except PackageNotFoundError:
+            pass
+
+    digest = blake2b(digest_size=16)
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+    for filename in sorted(os.listdir(package_dir)):
+        if filename.endswith(".py"):
+            with open(os.path.join(package_dir, filename), "rb") as inputf:
+                digest.update(inputf.read())
+    return "{0}-{1}".format(installed, digest.hexdigest())
+
+
+class RuleCache(object):
+    """
+    Stores the rules built from each top-level configuration entry in an
+    SQLite database, keyed by a hash of the entry and the package version,
+    so that only entries which have changed need to be built again.
+
+    Rules are stored with their flattened conditions and actions already
+    computed. Entries which weren't used by a run are removed by prune().
+    If path is ":memory:", the database is only kept in memory.
+    """
+
+    #: Bump this whenever the pickled format of rules changes.
+    format_version = 3
+
+    #: How many entries to look up at a time
+    chunksize = 256
+
+    def __init__(self, path, version=None):
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.salt = "{0}:{1}".format(self.format_version, version or package_version())
+        self.hits = 0
+        self.misses = 0
+        self._used = set()
+        self._db = sqlite3.connect(path)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS rules (key TEXT PRIMARY KEY, rules BLOB)"
+        )
+
+    def key(self, data, base_rule=None):
+        """
+        Returns the key for the rules built from the given entry.
+        """
+        source = json.dumps(
+            [
+                self.salt,
+                base_rule.fingerprint if base_rule is not None else None,
+                data,
+            ],
+            sort_keys=True,
+            separators=(",", ":"),
+            default=repr,
+        )
+        return blake2b(source.encode("utf-8"), digest_size=16).hexdigest()
+
+    def _get_many(self, keys):
+        found = {}
+        unique = list(set(keys))
+        # SQLite limits the number of parameters in a single query
+        for start in range(0, len(unique), 500):
+            batch = unique[start : start + 500]
+            query = "SELECT key, rules FROM rules WHERE key IN ({0})".format(
+                ",".join("?" * len(batch))
+            )
+            for key, blob in self._db.execute(query, batch):
+                found[key] = blob
+        return found
+
+    def _put_many(self, items):
+        self._db.executemany(
+            "INSERT OR REPLACE INTO rules (key, rules) VALUES (?, ?)", items
+        )
+        self._db.commit()
+
+    def build(self, iterable, build_all, base_rule=None):
+        """
+        Yields a RuleSet for each entry in iterable, in order. Entries which
+        aren't in the cache are passed (in order) to build_all, which must
+        yield a RuleSet for each of them, and the results are stored.
+        """
+        iterator = iter(iterable)
+        while True:
+            chunk = list(islice(iterator, self.chunksize))
+            if not chunk:
+                return
+            keys = [self.key(data, base_rule) for data in chunk]
+            found = self._get_many(keys)
+            missing = {}
+            for data, key in zip(chunk, keys):
+                if key not in found:
+                    missing.setdefault(key, data)
+            built = deque(build_all(list(missing.values())) if missing else ())
+            stored = []
+            for key in keys:
+                self._used.add(key)
+                blob = found.get(key)
+                if blob is not None:
+                    self.hits += 1
+                    yield self._load(blob)
+                    continue
+                self.misses += 1
+                ruleset = built.popleft()
+                found[key] = blob = self._dump(ruleset)
+                stored.append((key, blob))
+                yield ruleset
+            if stored:
+                self._put_many(stored)
+
+    @staticmethod
+    def _dump(ruleset):
+        return pickle.dumps(
+            [rule.compact() for rule in ruleset], pickle.HIGHEST_PROTOCOL
+        )
+
+    def _load(self, blob):
+        ruleset = RuleSet()
+        for compact in pickle.loads(blob):
+            ruleset.add(Rule.from_compact(compact))
+        return ruleset
+
+    def start(self):
+        """
+        Starts a new run with this cache, so that prune() keeps only the
+        entries used from now on, rather than every entry used since the
+        cache was opened (which matters if it's kept open between runs).
+        """
+        self._used.clear()
+
+    def prune(self):
+        """
+        Removes every entry which hasn't been used since this cache was opened
+        (or since start() was last called).
+        """
+        self._db.execute("CREATE TEMP TABLE used (key TEXT PRIMARY KEY)")
+        self._db.executemany(
+            "INSERT INTO used (key) VALUES (?)", ((key,) for key in self._used)
+        )
+        self._db.execute("DELETE FROM rules WHERE key NOT IN (SELECT key FROM used)")
+        self._db.execute("DROP TABLE used")
+        self._db.commit()
+
+    def close(self):
+        self._db.close()
@@ -0,0 +1,336 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import print_function, unicode_literals
+
+import os
+import sqlite3
+import time
+from datetime import datetime, timezone
+
+from .query import And, Not, Or, Term, criteria_query, rule_criteria
+from .simulate import (
+    HAS_LINKS,
+    OPERATOR_HEADERS,
+    TEXT_HEADERS,
+    UNSUPPORTED_OPERATORS,
+    Needs,
+    Simulation,
+    iter_messages,
+    message_date,
+    parse_age,
+    parse_date,
+    parse_size,
+)
+
+"""
+Keeps the messages of mbox files and Maildirs in an SQLite database with a
+full-text (FTS5) index of their headers and bodies, so that the messages
+each rule matches can be found by a query instead of by scanning the whole
+mailbox again, which is what --simulate does otherwise.
+
+Matching is the same approximation as in the simulate module, except that
+words are matched by SQLite's tokenizer rather than a regular expression.
+"""
+
+
+#: Headers kept in the full-text index, each in a column named after it
+HEADERS = (
+    "from",
+    "to",
+    "cc",
+    "bcc",
+    "subject",
+    "list-id",
+    "delivered-to",
+    "message-id",
+)
+
+#: How many messages are inserted at a time while ingesting a mailbox
+CHUNK_SIZE = 1000
+
+
+def _column(name):
+    return name.replace("-", "_")
+
+
+COLUMNS = tuple(_column(name) for name in HEADERS) + ("body", "filename")
+
+
+def _phrase(columns, value):
+    """
+    Returns an FTS5 query for value as a phrase in any of the given columns.
+
+    >>> _phrase(['from', 'to'], 'alice@example.com')
+    '{from to} : "alice@example.com"'
+    """
+    return '{{{0}}} : "{1}"'.format(" ".join(columns), value.replace('"', '""'))
+
+
+def _match(columns, value):
+    if not value.strip():
+        return "0", []
+    return (
+        "id IN (SELECT rowid FROM text WHERE text MATCH ?)",
+        [_phrase(columns, value)],
+    )
+
+
+def _term_sql(term, now):
+    operator = term.operator
+    value = term.value
+    if operator in UNSUPPORTED_OPERATORS:
+        return "0", []
+
+    if operator in ("larger", "size", "smaller"):
+        size = parse_size(value)
+        if size is None:
+            return "0", []
+        return ("size < ?" if operator == "smaller" else "size > ?"), [size]
+
+    if operator in ("after", "before", "older", "newer", "older_than", "newer_than"):
+        if operator.endswith("_than"):
+            cutoff = parse_age(value, now)
+        else:
+            cutoff = parse_date(value)
+        if cutoff is None:
+            return "0", []
+        comparison = ">=" if operator in ("after", "newer", "newer_than") else "<"
+        # so that NOT of this is true for messages without a date, as in simulate
+        return (
+            "(date IS NOT NULL AND date {0} ?)".format(comparison),
+            [cutoff.timestamp()],
+        )
+
+    if operator == "has":
+        value = value.lower()
+        if value == "attachment":
+            return "attachments > 0", []
+        link = HAS_LINKS.get(value)
+        if link is None:
+            return "0", []
+        return _match(["body"], link)
+
+    if operator == "filename":
+        return _match(["filename"], value)
+
+    if operator is None:
+        return _match([_column(name) for name in TEXT_HEADERS] + ["body"], value)
+
+    return _match([_column(name) for name in OPERATOR_HEADERS[operator]], value)
+
+
+def to_sql(node, now=None):
+    """
+    Returns (SQL expression, parameters) for a query, to be used in the
+    WHERE clause of a query on the messages table.
+
+    >>> from gmail_yaml_filters.query import parse
+    >>> sql, params = to_sql(parse('from:alice larger:1M'))
+    >>> print(sql)
+    (id IN (SELECT rowid FROM text WHERE text MATCH ?) AND size > ?)
+    >>> params
+    ['{from} : "alice"', 1048576]
+    """
+    now = now or datetime.now(timezone.utc)
+    if isinstance(node, Term):
+        return _term_sql(node, now)
+    if isinstance(node, Not):
+        sql, params = to_sql(node.operand, now)
+        return "NOT ({0})".format(sql), params
+    joiner = " OR " if isinstance(node, Or) else " AND "
+    assert isinstance(node, (And, Or))
+    parts = []
+    params = []
+    for operand in node.operands:
+        sql, operand_params = to_sql(operand, now)
+        parts.append(sql)
+        params.extend(operand_params)
+    return "({0})".format(joiner.join(parts)), params
+
+
+def _signature(path):
+    """
+    Returns something which changes whenever a mailbox does: the size and
+    modification time of an mbox file, or of a Maildir's subdirectories
+    (which change whenever a message is added, removed or has its flags set).
+    """
+    if os.path.isdir(path):
+        paths = [os.path.join(path, subdir) for subdir in ("cur", "new")]
+    else:
+        paths = [path]
+    return ",".join(
+        "{0}:{1}".format(stat.st_size, stat.st_mtime_ns)
+        for stat in (os.stat(each) for each in paths if os.path.exists(each))
+    )
+
+
+class Corpus(object):
+    """
+    An SQLite database of the messages in one or more mailboxes, with a
+    full-text index of their headers and bodies. If path is ":memory:",
+    the database is only kept in memory.
+    """
+
+    #: Bump this whenever the schema changes.
+    format_version = 1
+
+    def __init__(self, path):
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self._db = sqlite3.connect(path)
+        version = self._db.execute("PRAGMA user_version").fetchone()[0]
+        if version != self.format_version:
+            for table in ("mailboxes", "messages", "text"):
+                self._db.execute("DROP TABLE IF EXISTS {0}".format(table))
+            self._db.execute("PRAGMA user_version = {0}".format(self.format_version))
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS mailboxes "
+            "(id INTEGER PRIMARY KEY, path TEXT UNIQUE, signature TEXT)"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS messages (id INTEGER PRIMARY KEY, "
+            "mailbox INTEGER, size INTEGER, date REAL, attachments INTEGER)"
+        )
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS messages_mailbox ON messages (mailbox)"
+        )
+        self._db.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS text USING fts5({0}, "
+            "tokenize=\"unicode61 tokenchars '_'\")".format(", ".join(COLUMNS))
+        )
+        self._db.commit()
+
+    def _mailbox(self, path):
+        row = self._db.execute(
+            "SELECT id, signature FROM mailboxes WHERE path = ?", (path,)
+        ).fetchone()
+        return row if row is not None else (None, None)
+
+    def ingest(self, path, refresh=False):
+        """
+        Adds the messages in an mbox file or Maildir, replacing any from an
+        earlier version of it. Does nothing if the mailbox hasn't changed
+        since it was last ingested (unless refresh is True). Returns the
+        number of messages added.
+        """
+        path = os.path.abspath(path)
+        signature = _signature(path)
+        mailbox, ingested = self._mailbox(path)
+        if mailbox is not None and ingested == signature and not refresh:
+            return 0
+
+        with self._db:
+            if mailbox is None:
+                mailbox = self._db.execute(
+                    "INSERT INTO mailboxes (path) VALUES (?)", (path,)
+                ).lastrowid
+            else:
+                self._db.execute(
+                    "DELETE FROM text WHERE rowid IN "
+                    "(SELECT id FROM messages WHERE mailbox = ?)",
+                    (mailbox,),
+                )
+                self._db.execute("DELETE FROM messages WHERE mailbox = ?", (mailbox,))
+
+            (count,) = self._db.execute(
+                "SELECT coalesce(max(id), 0) FROM messages"
+            ).fetchone()
+            first = count
+            chunk = []
+            needs = Needs(HEADERS + ("date",), body=True)
+            for message in iter_messages(path, needs):
+                count += 1
+                chunk.append((count, message))
+                if len(chunk) >= CHUNK_SIZE:
+                    self._insert(mailbox, chunk)
+                    chunk = []
+            self._insert(mailbox, chunk)
+            self._db.execute(
+                "UPDATE mailboxes SET signature = ? WHERE id = ?", (signature, mailbox)
+            )
+        return count - first
+
+    def _insert(self, mailbox, messages):
+        """Inserts a list of (id, Message)."""
+        rows = []
+        texts = []
+        for message_id, message in messages:
+            date = message_date(message)
+            rows.append(
+                (
+                    message_id,
+                    mailbox,
+                    message.size,
+                    date.timestamp() if date is not None else None,
+                    len(message.attachments),
+                )
+            )
+            texts.append(
+                [message_id]
+                + [message.headers.get(name, "") for name in HEADERS]
+                + [message.body, "\n".join(message.attachments)]
+            )
+        self._db.executemany(
+            "INSERT INTO messages (id, mailbox, size, date, attachments) "
+            "VALUES (?, ?, ?, ?, ?)",
+            rows,
+        )
+        self._db.executemany(
+            "INSERT INTO text (rowid, {0}) VALUES (?, {1})".format(
+                ", ".join('"{0}"'.format(column) for column in COLUMNS),
+                ", ".join("?" * len(COLUMNS)),
+            ),
+            texts,
+        )
+
+    def _where(self, query, path, now):
+        sql, params = to_sql(query, now)
+        if path is None:
+            return sql, params
+        mailbox, _ = self._mailbox(os.path.abspath(path))
+        return "mailbox = ? AND {0}".format(sql), [mailbox] + params
+
+    def matches(self, query, path=None, now=None):
+        """
+        Returns the ids of the messages (in the mailbox at path, or in any
+        mailbox) which match a query.
+        """
+        where, params = self._where(query, path, now)
+        return [
+            row[0]
+            for row in self._db.execute(
+                "SELECT id FROM messages WHERE {0} ORDER BY id".format(where), params
+            )
+        ]
+
+    def count(self, query, path=None, now=None):
+        """
+        Returns the number of messages (in the mailbox at path, or in any
+        mailbox) which match a query.
+        """
+        where, params = self._where(query, path, now)
+        return self._db.execute(
+            "SELECT count(*) FROM messages WHERE {0}".format(where), params
+        ).fetchone()[0]
+
+    def simulate(self, ruleset, path, now=None, refresh=False):
+        """
+        Like simulate.simulate(), but ingests the mailbox into this corpus
+        first (if it has changed) and then counts matches with queries.
+        """
+        started = time.perf_counter()
+        now = now or datetime.now(timezone.utc)
+        self.ingest(path, refresh=refresh)
+        rules = [rule for rule in ruleset if rule.publishable]
+        counts = [
+            self.count(criteria_query(rule_criteria(rule)), path, now) for rule in rules
+        ]
+        (messages,) = self._db.execute(
+            "SELECT count(*) FROM messages WHERE mailbox = ?",
+            (self._mailbox(os.path.abspath(path))[0],),
+        ).fetchone()
+        return Simulation(rules, counts, messages, time.perf_counter() - started)
+
+    def close(self):
+        self._db.close()
@@ -3,17 +3,40 @@
 from __future__ import print_function, unicode_literals
 
 import argparse
+import cProfile
 import os
 import re
 import sys
+import time
+from contextlib import ExitStack, contextmanager
+from io import BytesIO
 
 import yaml
-from lxml import etree
+from yaml.composer import Composer
+from yaml.constructor import SafeConstructor
+from yaml.events import SequenceEndEvent, SequenceStartEvent, StreamEndEvent
+from yaml.resolver import Resolver
 
-from .ruleset import RuleSet, ruleset_to_etree
+from . import timing
+from .accounts import build_account_rulesets, load_manifest, report, sync_accounts
+from .cache import DEFAULT_TTL, RuleCache, SnapshotCache
+from .corpus import Corpus
+from .optimize import compact_ruleset, report_compaction
+from .plan import Plan, apply_plan, make_plan
+from .ruleset import RuleSet, write_ruleset_xml
+from .scheduler import (
+    DEFAULT_UNITS_PER_SECOND,
+    RequestScheduler,
+    scheduler_for,
+    use_scheduler,
+)
+from .simulate import simulate
 from .upload import (
+    DEFAULT_BATCH_SIZE,
+    DEFAULT_CONCURRENCY,
     get_gmail_credentials,
     get_gmail_service,
+    http_factory,
     prune_filters_not_in_ruleset,
     prune_labels_not_in_ruleset,
     upload_ruleset,
@@ -24,15 +47,59 @@ Produces Gmail filter XML files based on a more human-readable YAML spec.
 """
 
 
+try:
+    from yaml.cyaml import CParser
+except ImportError:  # pragma: no cover
+    _StreamingLoader = yaml.SafeLoader
+else:
+
+    class _StreamingLoader(CParser, Composer, SafeConstructor, Resolver):
+        """
+        Uses libyaml to parse events, but composes nodes in Python
+        so that we can build one item of a sequence at a time.
+        """
+
+        def __init__(self, stream):
+            CParser.__init__(self, stream)
+            Composer.__init__(self)
+            SafeConstructor.__init__(self)
+            Resolver.__init__(self)
+
+
+def iter_yaml_rules(stream):
+    """
+    Yields each top-level rule from a YAML stream without loading the whole
+    stream into memory. If a document is a list, each of its items is yielded
+    separately; otherwise the document itself is yielded. Empty documents
+    are skipped.
+
+    >>> list(iter_yaml_rules("- from: alice\\n- from: bob\\n---\\nto: carol\\n"))
+    [{'from': 'alice'}, {'from': 'bob'}, {'to': 'carol'}]
+    """
+    loader = _StreamingLoader(stream)
+    try:
+        loader.get_event()  # StreamStartEvent
+        while not loader.check_event(StreamEndEvent):
+            loader.get_event()  # DocumentStartEvent
+            if loader.check_event(SequenceStartEvent):
+                loader.get_event()
+                while not loader.check_event(SequenceEndEvent):
+                    yield loader.construct_document(loader.compose_node(None, None))
+                loader.get_event()
+            else:
+                data = loader.construct_document(loader.compose_node(None, None))
+                if data is not None:
+                    yield data
+            loader.get_event()  # DocumentEndEvent
+            loader.anchors = {}
+    finally:
+        loader.dispose()
+
+
 def ruleset_to_xml(ruleset, pretty_print=True, encoding="utf8"):
-    dom = ruleset_to_etree(ruleset)
-    chars = etree.tostring(
-        dom,
-        encoding=encoding,
-        pretty_print=pretty_print,
-        xml_declaration=True,
-    )
-    return chars.decode(encoding)
+    output = BytesIO()
+    write_ruleset_xml(ruleset, output, pretty_print=pretty_print, encoding=encoding)
+    return output.getvalue().decode(encoding)
 
 
 def create_parser():
@@ -61,6 +128,130 @@ def create_parser():
             os.path.expanduser("~"), ".credentials", "gmail_yaml_filters.json"
         ),
     )
+    parser.add_argument(
+        "--compact",
+        action="store_true",
+        default=False,
+        help=(
+            "combine rules into as few filters as possible, without changing "
+            "what happens to any message"
+        ),
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        metavar="N",
+        type=int,
+        default=1,
+        help="build rules in N worker processes; 0 means one per CPU",
+    )
+    parser.add_argument(
+        "--batch-size",
+        metavar="N",
+        type=int,
+        default=DEFAULT_BATCH_SIZE,
+        help="send up to N Gmail API requests per HTTP request (default %(default)s)",
+    )
+    parser.add_argument(
+        "--concurrency",
+        metavar="N",
+        type=int,
+        default=DEFAULT_CONCURRENCY,
+        help="have up to N HTTP requests to Gmail in flight at once (default %(default)s)",
+    )
+    parser.add_argument(
+        "--quota",
+        metavar="UNITS",
+        type=int,
+        default=DEFAULT_UNITS_PER_SECOND,
+        help=(
+            "use at most UNITS Gmail API quota units per second for each account "
+            "(default %(default)s); 0 means no limit"
+        ),
+    )
+    parser.add_argument(
+        "--max-retries",
+        metavar="N",
+        type=int,
+        default=5,
+        help="retry rate-limited requests and server errors up to N times (default %(default)s)",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        metavar="DIR",
+        help=(
+            "keep built rules, and a snapshot of the account's labels and filters, "
+            "in DIR between runs"
+        ),
+    )
+    parser.add_argument(
+        "--cache-ttl",
+        metavar="SECONDS",
+        type=int,
+        default=DEFAULT_TTL,
+        help="fetch labels and filters again if the snapshot is older than this (default %(default)s)",
+    )
+    parser.add_argument(
+        "--refresh",
+        action="store_true",
+        default=False,
+        help=(
+            "ignore any cached snapshot and fetch labels and filters again "
+            "(or with --corpus, ingest the mailbox again)"
+        ),
+    )
+    parser.add_argument(
+        "--timings",
+        action="store_true",
+        default=False,
+        help="report time and call counts for each phase to stderr",
+    )
+    parser.add_argument(
+        "--trace-memory",
+        action="store_true",
+        default=False,
+        help="with --timings, also report peak memory for each phase (much slower)",
+    )
+    parser.add_argument(
+        "--profile",
+        metavar="PSTATS_FILE",
+        help="run under cProfile and write the stats to the given file",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        metavar="XML_FILE",
+        help="write XML to the given file instead of stdout",
+    )
+
+    parser.add_argument(
+        "--accounts",
+        metavar="MANIFEST",
+        help=(
+            "with --upload, --prune, --sync or --delete-all, update every "
+            "account listed in MANIFEST instead of FILTER_FILE's account"
+        ),
+    )
+    parser.add_argument(
+        "--workers",
+        metavar="N",
+        type=int,
+        default=8,
+        help="with --accounts, update up to N accounts at once (default %(default)s)",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        default=False,
+        help="keep running, and run again whenever FILTER_FILE changes",
+    )
+    parser.add_argument(
+        "--debounce",
+        metavar="SECONDS",
+        type=float,
+        default=0.5,
+        help="with --watch, wait until FILTER_FILE hasn't changed for this long",
+    )
 
     # Actions
     parser.add_argument(
@@ -84,6 +275,28 @@ def create_parser():
         const="upload_prune",
         help="equivalent to --upload and --prune",
     )
+    parser.add_argument(
+        "--apply",
+        dest="apply_plan",
+        metavar="PLAN_FILE",
+        help="make exactly the changes in a plan file written by --plan",
+    )
+    parser.add_argument(
+        "--simulate",
+        metavar="MAILBOX",
+        help=(
+            "count the messages in an mbox file or Maildir which each filter "
+            "would match, using --jobs processes, instead of changing Gmail"
+        ),
+    )
+    parser.add_argument(
+        "--corpus",
+        metavar="DB_FILE",
+        help=(
+            "with --simulate, keep the mailbox's messages in a full-text index "
+            "in DB_FILE, so later runs don't need to scan it again"
+        ),
+    )
     parser.add_argument(
         "--delete-all",
         dest="action",
@@ -91,6 +304,14 @@ def create_parser():
         const="delete",
         help="delete all Gmail filters",
     )
+    parser.add_argument(
+        "--plan",
+        metavar="PLAN_FILE",
+        help=(
+            "with --upload, --prune, --sync or --delete-all, write the changes "
+            "to PLAN_FILE instead of making them"
+        ),
+    )
     # Options for --prune-labels
     parser.add_argument(
         "--prune-labels",
@@ -115,71 +336,424 @@ def create_parser():
 
 
 def load_data_from_args(action, filename):
-    if action == "delete":
-        return []
+    return list(iter_data_from_args(action, filename))
+
+
+def iter_data_from_args(action, filename):
+    """
+    Returns an iterator over the rules in the given file (or stdin, if the
+    filename is a single dash). Raises ValueError immediately if no filename
+    was given for an action that needs one.
+    """
+    if action in ("delete", "apply"):
+        return iter([])
 
     if filename == "-":
-        data = yaml.safe_load(sys.stdin)
+        return iter_yaml_rules(sys.stdin)
     elif filename:
-        with open(filename) as inputf:
-            data = yaml.safe_load(inputf)
+        return _iter_yaml_rules_from_file(filename)
     else:
         raise ValueError((action, filename))
 
-    if not isinstance(data, list):
-        data = [data]
 
-    return data
+def _iter_yaml_rules_from_file(filename):
+    with open(filename) as inputf:
+        yield from iter_yaml_rules(inputf)
+
+
+@contextmanager
+def _profiled(filename):
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        profiler.dump_stats(filename)
 
 
 def main():
     parser = create_parser()
     args = parser.parse_args()
-    default_client_secret = "client_secret.json"
+    if args.apply_plan:
+        args.action = "apply"
+    if args.simulate:
+        args.action = "simulate"
+    if args.corpus and not args.simulate:
+        parser.error("--corpus needs --simulate")
+    if args.plan and args.action not in PLANNABLE_ACTIONS:
+        parser.error("--plan needs --upload, --prune, --sync or --delete-all")
+    if args.watch and (args.action == "apply" or args.filename in (None, "-")):
+        parser.error("--watch needs a configuration file")
+    if args.accounts and (args.action not in PLANNABLE_ACTIONS or args.plan):
+        parser.error("--accounts needs --upload, --prune, --sync or --delete-all")
 
-    try:
-        data = load_data_from_args(args.action, args.filename)
-    except ValueError:
-        parser.print_help()
+    if args.accounts:
+        data = None
+    else:
+        try:
+            data = iter_data_from_args(args.action, args.filename)
+        except ValueError:
+            parser.print_help()
+            sys.exit(1)
+
+    with ExitStack() as stack:
+        timings = None
+        if args.timings:
+            timings = stack.enter_context(
+                timing.collect(trace_memory=args.trace_memory)
+            )
+        if args.profile:
+            stack.enter_context(_profiled(args.profile))
+        if args.accounts:
+            failed = not run_accounts(args)
+        elif args.watch:
+            session = Session(args, keep_warm=True)
+            stack.callback(session.close)
+            try:
+                watch(args, session)
+            except KeyboardInterrupt:
+                pass
+        else:
+            session = Session(args)
+            run(args, data, session)
+            session.report_requests(verbose=args.timings)
+
+    if timings:
+        timings.report()
+    if args.accounts and failed:
         sys.exit(1)
 
-    ruleset = RuleSet.from_object(rule for rule in data if not rule.get("ignore"))
 
-    if not args.client_secret:
-        args.client_secret = default_client_secret
+class Session(object):
+    """
+    Holds what a run needs besides its rules: a cache of built rules, the
+    Gmail service, and a snapshot of the account's labels and filters.
+
+    Normally each is set up by the run which needs it and closed afterwards.
+    With keep_warm (used by --watch), they are kept in memory and reused by
+    every run, so that only changed entries are built again and the account
+    is only listed once.
+    """
+
+    def __init__(self, args, keep_warm=False, gmail=None):
+        self.args = args
+        self.keep_warm = keep_warm
+        self._rule_cache = None
+        self._gmail = gmail
+        self._http_factory = None
+        self._options = None
+
+    @contextmanager
+    def rule_cache(self):
+        """
+        Yields a RuleCache (or None, if not caching rules). Once every rule
+        has been built, entries which weren't used are removed from the cache.
+        """
+        if self._rule_cache is None:
+            if self.args.cache_dir:
+                path = os.path.join(self.args.cache_dir, "rules.sqlite3")
+            elif self.keep_warm:
+                path = ":memory:"
+            else:
+                yield None
+                return
+            self._rule_cache = RuleCache(path)
+        self._rule_cache.start()
+        try:
+            yield self._rule_cache
+            self._rule_cache.prune()
+        finally:
+            if not self.keep_warm:
+                self.close()
+
+    @property
+    def gmail(self):
+        if self._gmail is None:
+            credentials = get_gmail_credentials(
+                client_secret_path=self.args.client_secret or "client_secret.json",
+                credential_store=self.args.credential_store,
+            )
+            self._gmail = get_gmail_service(credentials)
+            self._http_factory = http_factory(credentials)
+            use_scheduler(self._gmail, scheduler_from_args(self.args))
+        return self._gmail
+
+    def report_requests(self, verbose=False):
+        """
+        Reports how many requests were made and how often they were throttled;
+        unless verbose, only if they were throttled or failed and were retried.
+        """
+        if self._gmail is None:
+            return
+        stats = scheduler_for(self._gmail).stats
+        if verbose or stats.retries or stats.waited_seconds:
+            stats.report()
+
+    @property
+    def concurrency_options(self):
+        """Keyword arguments for upload_ruleset and prune_filters_not_in_ruleset."""
+        self.gmail  # connect first, if we haven't yet
+        if self._http_factory is None:
+            # we weren't given a way to make an Http for each thread
+            return {}
+        return {
+            "concurrency": self.args.concurrency,
+            "http_factory": self._http_factory,
+        }
+
+    @property
+    def options(self):
+        """Keyword arguments for the functions which call the Gmail API."""
+        if self._options is None:
+            args = self.args
+            self._options = {"dry_run": args.dry_run, "batch_size": args.batch_size}
+            if args.cache_dir:
+                self._options["cache"] = SnapshotCache.for_account(
+                    args.cache_dir,
+                    os.path.abspath(args.credential_store),
+                    ttl=args.cache_ttl,
+                    refresh=args.refresh,
+                )
+            elif self.keep_warm:
+                self._options["cache"] = SnapshotCache(None, ttl=args.cache_ttl)
+        return self._options
+
+    def close(self):
+        if self._rule_cache is not None:
+            self._rule_cache.close()
+            self._rule_cache = None
+
+
+def scheduler_from_args(args):
+    return RequestScheduler(rate=args.quota or None, max_retries=args.max_retries)
+
+
+#: Actions which --plan can be used with, and whether they (upload, prune)
+PLANNABLE_ACTIONS = {
+    "upload": (True, False),
+    "prune": (False, True),
+    "upload_prune": (True, True),
+    "delete": (False, True),
+}
+
+
+def run(args, data, session=None):
+    session = session or Session(args)
+    data = timing.timed_iter("load", data)
+    data = (rule for rule in data if not rule.get("ignore"))
+    jobs = args.jobs or os.cpu_count() or 1
 
     if args.action == "xml":
-        print(ruleset_to_xml(ruleset))
+        with session.rule_cache() as rule_cache:
+            if args.compact:
+                with timing.phase("build"):
+                    ruleset = RuleSet.from_object(data, jobs=jobs, cache=rule_cache)
+                rules = compact(ruleset)
+            else:
+                # write each entry as soon as its rule is built
+                rules = timing.timed_iter(
+                    "build",
+                    RuleSet.iter_from_iterable(data, jobs=jobs, cache=rule_cache),
+                )
+            with timing.phase("serialize"):
+                if args.output:
+                    write_ruleset_xml(rules, args.output)
+                else:
+                    write_ruleset_xml(rules, sys.stdout.buffer)
+                    sys.stdout.flush()
+        return
+
+    ruleset = None
+    if args.action != "apply":
+        with session.rule_cache() as rule_cache, timing.phase("build"):
+            ruleset = RuleSet.from_object(data, jobs=jobs, cache=rule_cache)
+        if args.compact:
+            ruleset = compact(ruleset)
+
+    if args.action == "simulate":
+        if args.corpus:
+            corpus = Corpus(args.corpus)
+            try:
+                corpus.simulate(ruleset, args.simulate, refresh=args.refresh).report()
+            finally:
+                corpus.close()
+        else:
+            simulate(ruleset, args.simulate, jobs=jobs).report()
         return
 
     # every command below this point involves the Gmail API
 
-    credentials = get_gmail_credentials(
-        client_secret_path=args.client_secret, credential_store=args.credential_store
-    )
-    gmail = get_gmail_service(credentials)
+    gmail = session.gmail
+    options = session.options
+    concurrent = dict(options, **session.concurrency_options)
 
-    if args.action == "upload":
-        upload_ruleset(ruleset, service=gmail, dry_run=args.dry_run)
+    if args.action == "apply":
+        with open(args.apply_plan) as inputf:
+            plan = Plan.load(inputf)
+        apply_plan(plan, service=gmail, **options)
+    elif args.plan:
+        upload, prune = PLANNABLE_ACTIONS[args.action]
+        if args.action == "delete":
+            ruleset = RuleSet()
+        plan = make_plan(
+            ruleset, gmail, upload=upload, prune=prune, cache=options.get("cache")
+        )
+        plan.report()
+        with open(args.plan, "w") as outputf:
+            plan.dump(outputf)
+    elif args.action == "upload":
+        upload_ruleset(ruleset, service=gmail, **concurrent)
     elif args.action == "delete":
-        prune_filters_not_in_ruleset(RuleSet(), service=gmail, dry_run=args.dry_run)
+        prune_filters_not_in_ruleset(RuleSet(), service=gmail, **concurrent)
     elif args.action == "prune":
-        prune_filters_not_in_ruleset(ruleset, service=gmail, dry_run=args.dry_run)
+        prune_filters_not_in_ruleset(ruleset, service=gmail, **concurrent)
     elif args.action == "upload_prune":
-        upload_ruleset(ruleset, service=gmail, dry_run=args.dry_run)
-        prune_filters_not_in_ruleset(ruleset, service=gmail, dry_run=args.dry_run)
+        upload_ruleset(ruleset, service=gmail, **concurrent)
+        prune_filters_not_in_ruleset(ruleset, service=gmail, **concurrent)
     elif args.action == "prune_labels":
         match = re.compile(args.only_matching).match if args.only_matching else None
         prune_labels_not_in_ruleset(
             ruleset,
             service=gmail,
             match=match,
-            dry_run=args.dry_run,
             continue_on_http_error=args.ignore_errors,
+            **options,
         )
     else:
         raise argparse.ArgumentError("%r not recognized" % args.action)
 
 
+def compact(ruleset):
+    """
+    Returns the ruleset combined into as few filters as possible,
+    and reports how many filters that saved.
+    """
+    with timing.phase("compact"):
+        compacted = compact_ruleset(ruleset)
+    report_compaction(ruleset, compacted)
+    return compacted
+
+
+def run_accounts(args, connect=None):
+    """
+    Updates every account in the --accounts manifest, building each
+    configuration file only once, and prints a summary. Returns True
+    if every account was updated successfully.
+    """
+    accounts = load_manifest(args.accounts)
+    upload, prune = PLANNABLE_ACTIONS[args.action]
+    jobs = args.jobs or os.cpu_count() or 1
+    rule_cache = None
+    if args.cache_dir:
+        rule_cache = RuleCache(os.path.join(args.cache_dir, "rules.sqlite3"))
+
+    def build_file(filename):
+        if args.action == "delete":
+            return RuleSet()
+        data = timing.timed_iter("load", _iter_yaml_rules_from_file(filename))
+        data = (rule for rule in data if not rule.get("ignore"))
+        with timing.phase("build"):
+            return RuleSet.from_object(data, jobs=jobs, cache=rule_cache)
+
+    def connect_with_stored_credentials(account):
+        credentials = get_gmail_credentials(
+            client_secret_path=args.client_secret or "client_secret.json",
+            credential_store=account.credential_store,
+            interactive=False,
+        )
+        gmail = get_gmail_service(credentials)
+        use_scheduler(gmail, scheduler_from_args(args))
+        return gmail
+
+    def cache_for(account):
+        if not args.cache_dir:
+            return None
+        return SnapshotCache.for_account(
+            args.cache_dir,
+            os.path.abspath(account.credential_store),
+            ttl=args.cache_ttl,
+            refresh=args.refresh,
+        )
+
+    errors = {}
+    try:
+        rulesets = build_account_rulesets(accounts, build_file, errors)
+        if args.compact:
+            with timing.phase("compact"):
+                rulesets = {
+                    name: compact_ruleset(ruleset) for name, ruleset in rulesets.items()
+                }
+        # rules from a file which failed part way through might still be used
+        if rule_cache and not errors:
+            rule_cache.prune()
+    finally:
+        if rule_cache:
+            rule_cache.close()
+
+    results = sync_accounts(
+        accounts,
+        rulesets,
+        connect or connect_with_stored_credentials,
+        upload=upload,
+        prune=prune,
+        workers=args.workers,
+        cache_for=cache_for,
+        errors=errors,
+        dry_run=args.dry_run,
+        batch_size=args.batch_size,
+    )
+    report(results)
+    return all(result.ok for result in results)
+
+
+def _file_stamp(filename):
+    try:
+        stat = os.stat(filename)
+    except FileNotFoundError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+def wait_for_change(filename, last_stamp, debounce, poll_interval, sleep=time.sleep):
+    """
+    Waits until the file's modification time or size differs from
+    last_stamp and then stays the same for debounce seconds, so that
+    a burst of saves only causes one run. Returns the new stamp.
+    """
+    stamp = _file_stamp(filename)
+    while stamp == last_stamp:
+        sleep(poll_interval)
+        stamp = _file_stamp(filename)
+    while True:
+        sleep(debounce)
+        settled = _file_stamp(filename)
+        if settled == stamp:
+            return stamp
+        stamp = settled
+
+
+def watch(args, session, poll_interval=0.2, sleep=time.sleep, max_runs=None):
+    """
+    Runs once, then again every time the input file changes, until
+    interrupted (or until max_runs runs have happened). Errors are
+    reported without stopping.
+    """
+    stamp = _file_stamp(args.filename)
+    runs = 0
+    while True:
+        try:
+            run(args, iter_data_from_args(args.action, args.filename), session)
+        except Exception as exc:
+            print("Error:", exc, file=sys.stderr)
+        runs += 1
+        if max_runs is not None and runs >= max_runs:
+            return
+        print("Watching", args.filename, "for changes...", file=sys.stderr)
+        stamp = wait_for_change(
+            args.filename, stamp, args.debounce, poll_interval, sleep=sleep
+        )
+
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import print_function, unicode_literals
+
+import sys
+from collections import OrderedDict
+
+from .query import is_single_term
+from .ruleset import Rule, RuleAction, RuleCondition, RuleSet
+
+"""
+Combines rules into fewer Gmail filters without changing which messages
+get which actions, since Gmail limits how many filters an account can have
+and each one takes a request to create.
+"""
+
+
+#: Gmail rejects filters whose criteria are much longer than this
+MAX_CRITERION_LENGTH = 1500
+
+#: Condition keys which can be combined, in the order they're tried. A message
+#: matches one of several filters which differ only in `from` (say) if it
+#: matches a filter with those values OR'd together; since doesNotHaveTheWord
+#: is negated, its values are AND'd instead.
+MERGEABLE_CONDITIONS = (
+    "from",
+    "to",
+    "subject",
+    "hasTheWord",
+    "doesNotHaveTheWord",
+)
+
+#: Pairs of actions which can't be combined into one filter, besides
+#: actions with the same key and different values (e.g. two labels)
+CONFLICTING_ACTIONS = frozenset(
+    [frozenset(["shouldAlwaysMarkAsImportant", "shouldNeverMarkAsImportant"])]
+)
+
+
+class _Filter(object):
+    """
+    The flattened conditions and actions of a rule, as {key: value} dicts,
+    and the rule itself, until it's combined with another.
+    """
+
+    __slots__ = ("conditions", "actions", "rule")
+
+    def __init__(self, conditions, actions, rule=None):
+        self.conditions = conditions
+        self.actions = actions
+        self.rule = rule
+
+    @classmethod
+    def from_rule(cls, rule):
+        conditions = {}
+        actions = {}
+        for key, construct in rule.flatten().items():
+            target = conditions if isinstance(construct, RuleCondition) else actions
+            target[key] = construct.value
+        return cls(conditions, actions, rule)
+
+    def to_rule(self):
+        if self.rule is not None:
+            return self.rule
+        return Rule.from_constructions(
+            [RuleCondition.from_validated(k, v) for k, v in self.conditions.items()],
+            [RuleAction.from_validated(k, v) for k, v in self.actions.items()],
+        )
+
+
+def _operand(value):
+    return value if is_single_term(value) else "({0})".format(value)
+
+
+def _conflicting(actions, other):
+    for key, value in other.items():
+        if actions.get(key, value) != value:
+            return True
+    keys = set(actions) | set(other)
+    return any(pair <= keys for pair in CONFLICTING_ACTIONS)
+
+
+def _merge_actions(filters):
+    """
+    Combines the actions of filters with the same criteria, where they
+    don't conflict.
+    """
+    groups = OrderedDict()
+    for each in filters:
+        key = frozenset(each.conditions.items())
+        if not each.conditions or not each.actions:
+            key = id(each)  # not publishable, so leave it alone
+        buckets = groups.setdefault(key, [])
+        for bucket in buckets:
+            if not _conflicting(bucket.actions, each.actions):
+                bucket.actions = dict(bucket.actions, **each.actions)
+                bucket.rule = None
+                break
+        else:
+            buckets.append(_Filter(dict(each.conditions), each.actions, each.rule))
+    return [bucket for buckets in groups.values() for bucket in buckets]
+
+
+def _merge_condition(filters, key, max_length):
+    """
+    Combines filters with the same actions whose conditions only differ
+    by the value of key, into filters no longer than max_length.
+    """
+    groups = OrderedDict()
+    for each in filters:
+        if key not in each.conditions or not each.actions:
+            groups[id(each)] = [each]
+            continue
+        signature = (
+            frozenset(
+                (other_key, value)
+                for other_key, value in each.conditions.items()
+                if other_key != key
+            ),
+            frozenset(each.actions.items()),
+        )
+        groups.setdefault(signature, []).append(each)
+
+    joiner = " AND " if key == "doesNotHaveTheWord" else " OR "
+    merged = []
+    for group in groups.values():
+        if len(group) == 1:
+            merged.extend(group)
+            continue
+        chunk = []
+        length = 2  # for the enclosing parentheses
+        for each in group:
+            operand = _operand(each.conditions[key])
+            if chunk and length + len(joiner) + len(operand) > max_length:
+                merged.append(_combined(group[0], key, chunk, joiner))
+                chunk = []
+                length = 2
+            chunk.append(operand)
+            length += len(operand) + (len(joiner) if len(chunk) > 1 else 0)
+        merged.append(_combined(group[0], key, chunk, joiner))
+    return merged
+
+
+def _combined(template, key, values, joiner):
+    if len(values) == 1:
+        value = values[0]
+    else:
+        value = RuleCondition.joined_by(joiner, key, values).value
+    return _Filter(dict(template.conditions, **{key: value}), template.actions)
+
+
+def compact_ruleset(ruleset, max_length=MAX_CRITERION_LENGTH):
+    """
+    Returns a new RuleSet which applies the same actions to the same
+    messages as ruleset, using as few filters as it easily can:
+
+    - rules with the same criteria are combined, unless their actions
+      conflict (e.g. they have different labels);
+    - rules with the same actions, whose criteria only differ in one
+      condition, are combined by OR'ing that condition's values together
+      (or AND'ing them, for doesNotHaveTheWord), up to max_length characters.
+
+    Rules which aren't combined with any other are kept as they are.
+
+    >>> ruleset = RuleSet.from_object([
+    ...     {'from': 'alice', 'archive': True},
+    ...     {'from': 'bob', 'archive': True},
+    ...     {'from': 'carol', 'label': 'friends'},
+    ...     {'from': 'carol', 'label': 'family'},
+    ...     {'from': 'carol', 'star': True},
+    ... ])
+    >>> for rule in compact_ruleset(ruleset):
+    ...     print(sorted((c.key, c.value) for c in rule.flatten().values()))
+    [('from', '(alice OR bob)'), ('shouldArchive', 'true')]
+    [('from', 'carol'), ('label', 'friends'), ('shouldStar', 'true')]
+    [('from', 'carol'), ('label', 'family')]
+    """
+    filters = [_Filter.from_rule(rule) for rule in ruleset]
+    while True:
+        count = len(filters)
+        filters = _merge_actions(filters)
+        for key in MERGEABLE_CONDITIONS:
+            filters = _merge_condition(filters, key, max_length)
+        if len(filters) == count:
+            break
+
+    compacted = RuleSet()
+    for each in filters:
+        compacted.add(each.to_rule())
+    return compacted
+
+
+def count_filters(ruleset):
+    """Returns how many Gmail filters a ruleset becomes."""
+    return sum(1 for rule in ruleset if rule.publishable)
+
+
+def report_compaction(before, after, file=None):
+    file = file or sys.stderr
+    print(
+        "Compacted {0} filters into {1}".format(
+            count_filters(before), count_filters(after)
+        ),
+        file=file,
+    )
@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+
+import json
+import sys
+from functools import partial
+
+from .upload import (
+    GmailFilters,
+    GmailLabels,
+    RequestBatcher,
+    _removed_from,
+    fake_label,
+    rule_to_resource,
+)
+
+"""
+Works out which labels and filters need to be created or deleted without
+changing anything, so that the plan can be reviewed (and saved to a file)
+before it is applied.
+"""
+
+
+class Plan(object):
+    """
+    A list of labels to create, filters to create and filters to delete.
+
+    Filters which use a label that doesn't exist yet refer to it by the id
+    of its fake_label(), which is replaced by the real id when the plan is
+    applied.
+    """
+
+    version = 1
+
+    def __init__(self, labels=(), create=(), delete=()):
+        #: Names of labels to create
+        self.labels = list(labels)
+        #: Filter resources to create
+        self.create = list(create)
+        #: Filter resources (with ids) to delete
+        self.delete = list(delete)
+
+    def __len__(self):
+        return len(self.labels) + len(self.create) + len(self.delete)
+
+    def __eq__(self, other):
+        return isinstance(other, Plan) and self.as_dict() == other.as_dict()
+
+    def as_dict(self):
+        return {
+            "version": self.version,
+            "labels": self.labels,
+            "create": self.create,
+            "delete": self.delete,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        if data.get("version") != cls.version:
+            raise ValueError(
+                "unsupported plan version: {0!r}".format(data.get("version"))
+            )
+        return cls(data["labels"], data["create"], data["delete"])
+
+    def dump(self, outputf):
+        json.dump(self.as_dict(), outputf, separators=(",", ":"), sort_keys=True)
+        outputf.write("\n")
+
+    @classmethod
+    def load(cls, inputf):
+        return cls.from_dict(json.load(inputf))
+
+    def report(self, file=None):
+        file = file or sys.stderr
+        for name in self.labels:
+            print("Creating label", name, file=file)
+        for filter_data in self.create:
+            print("Creating", filter_data["criteria"], filter_data["action"], file=file)
+        for filter_data in self.delete:
+            print("Deleting", filter_data, file=file)
+        print(
+            "Plan: {0} labels to create, {1} filters to create, "
+            "{2} filters to delete".format(
+                len(self.labels), len(self.create), len(self.delete)
+            ),
+            file=file,
+        )
+
+
+class _PlannedLabels(GmailLabels):
+    """
+    Resolves label names like GmailLabels, but remembers the names of
+    labels which don't exist yet instead of creating them.
+    """
+
+    def __init__(self, gmail, cache=None):
+        self.missing = {}
+        super(_PlannedLabels, self).__init__(gmail, dry_run=True, cache=cache)
+
+    def get_or_create(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            self[name] = label = fake_label(name)
+            self.missing[label["id"]] = name
+            return label
+
+
+def make_plan(ruleset, service, upload=True, prune=True, cache=None):
+    """
+    Compares the ruleset with the account's labels and filters, and returns
+    a Plan which would make them match: with upload, filters for rules which
+    don't exist yet are created; with prune, filters which aren't in the
+    ruleset are deleted.
+    """
+    labels = _PlannedLabels(service, cache=cache)
+    filters = GmailFilters(service, cache=cache)
+    wanted = []
+    create = []
+
+    for rule in ruleset:
+        filter_data = rule_to_resource(rule, labels)
+        wanted.append(filter_data)
+        if upload and rule.publishable and not filters.exists(filter_data):
+            filter_data = {
+                "criteria": dict(filter_data["criteria"]),
+                "action": dict(filter_data["action"]),
+            }
+            filters.add(filter_data)
+            create.append(filter_data)
+
+    # only create labels which are used by a filter we're going to create
+    new_labels = []
+    for filter_data in create:
+        for key in ("addLabelIds", "removeLabelIds"):
+            for label_id in filter_data["action"].get(key, ()):
+                name = labels.missing.pop(label_id, None)
+                if name is not None:
+                    new_labels.append(name)
+
+    delete = filters.prunable(wanted) if prune else []
+    if cache:
+        cache.save()
+    return Plan(new_labels, create, delete)
+
+
+def apply_plan(plan, service, dry_run=False, batch_size=1, cache=None, file=None):
+    """
+    Makes exactly the changes in the plan, without listing labels or filters,
+    and prints each change to file (by default, sys.stderr).
+    """
+    file = file or sys.stderr
+    label_ids = {}
+
+    def label_created(name, created):
+        label_ids[fake_label(name)["id"]] = created["id"]
+        if cache:
+            cache.add("labels", created)
+
+    batcher = RequestBatcher(service, batch_size, phase_name="create label", file=file)
+    for name in plan.labels:
+        print("Creating label", name, file=file)
+        request = service.users().labels().create(userId="me", body={"name": name})
+        if not dry_run:
+            batcher.add(
+                request,
+                description=name,
+                on_success=lambda created, name=name: label_created(name, created),
+            )
+    batcher.flush()
+
+    batcher = RequestBatcher(service, batch_size, phase_name="create filter", file=file)
+    filter_created = partial(cache.add, "filters") if cache else None
+    for filter_data in plan.create:
+        action = {
+            key: (
+                [label_ids.get(label_id, label_id) for label_id in values]
+                if key.endswith("LabelIds")
+                else values
+            )
+            for key, values in filter_data["action"].items()
+        }
+        body = {"criteria": filter_data["criteria"], "action": action}
+        print("Creating", body["criteria"], body["action"], file=file)
+        request = service.users().settings().filters().create(userId="me", body=body)
+        if not dry_run:
+            batcher.add(request, description=body, on_success=filter_created)
+    batcher.flush()
+
+    batcher = RequestBatcher(service, batch_size, phase_name="delete filter", file=file)
+    for filter_data in plan.delete:
+        print("Deleting", filter_data, file=file)
+        request = (
+            service.users()
+            .settings()
+            .filters()
+            .delete(userId="me", id=filter_data["id"])
+        )
+        if not dry_run:
+            batcher.add(
+                request,
+                description=filter_data,
+                on_success=_removed_from(cache, "filters", filter_data["id"]),
+            )
+    batcher.flush()
+
+    if cache:
+        cache.save()
@@ -0,0 +1,550 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import print_function, unicode_literals
+
+import re
+from functools import lru_cache
+
+"""
+Parses the Gmail search queries used in filter criteria into a tree of
+Term, And, Or and Not nodes, so that they can be evaluated (or otherwise
+reasoned about) without treating them as opaque strings.
+
+See https://support.google.com/mail/answer/7190
+"""
+
+
+#: Search operators which are recognised before a colon; anything else
+#: with a colon in it (like a URL or a time) is an ordinary word
+OPERATORS = frozenset(
+    [
+        "after",
+        "bcc",
+        "before",
+        "category",
+        "cc",
+        "deliveredto",
+        "filename",
+        "from",
+        "has",
+        "in",
+        "is",
+        "label",
+        "larger",
+        "list",
+        "newer",
+        "newer_than",
+        "older",
+        "older_than",
+        "rfc822msgid",
+        "size",
+        "smaller",
+        "subject",
+        "to",
+    ]
+)
+
+#: How many distinct queries to keep parsed; conditions built from templates
+#: often share values, and rules are compared by their parsed criteria
+PARSE_CACHE_SIZE = 1 << 16
+
+#: The operator each flattened condition key applies to its value
+CONDITION_OPERATORS = {
+    "from": "from",
+    "to": "to",
+    "subject": "subject",
+    "hasTheWord": None,
+    "doesNotHaveTheWord": None,
+}
+
+
+class _Node(object):
+    __slots__ = ()
+    _fields = ()
+
+    def _key(self):
+        return tuple(getattr(self, name) for name in self._fields)
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self._key() == other._key()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((type(self).__name__,) + self._key())
+
+    def __repr__(self):
+        return "{0}({1})".format(
+            type(self).__name__, ", ".join(repr(value) for value in self._key())
+        )
+
+    def __getstate__(self):
+        return self._key()
+
+    def __setstate__(self, state):
+        for name, value in zip(self._fields, state):
+            setattr(self, name, value)
+
+
+class Term(_Node):
+    """
+    A word or "quoted phrase", optionally restricted by an operator
+    (e.g. `from`), which is None for words that can appear anywhere.
+    """
+
+    __slots__ = _fields = ("operator", "value", "phrase")
+
+    def __init__(self, operator, value, phrase=False):
+        self.operator = operator
+        self.value = value
+        self.phrase = phrase
+
+
+class And(_Node):
+    __slots__ = _fields = ("operands",)
+
+    def __init__(self, operands):
+        self.operands = tuple(operands)
+
+
+class Or(_Node):
+    __slots__ = _fields = ("operands",)
+
+    def __init__(self, operands):
+        self.operands = tuple(operands)
+
+
+class Not(_Node):
+    __slots__ = _fields = ("operand",)
+
+    def __init__(self, operand):
+        self.operand = operand
+
+
+class Raw(_Node):
+    """
+    Query text which is used as it is, rather than parsed, such as a
+    condition whose {placeholders} are yet to be filled in by for_each.
+    """
+
+    __slots__ = _fields = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+
+#: Whitespace, punctuation, a negation, a "quoted phrase" (which might not be
+#: closed) or a word, in the order they're tried
+_TOKEN = re.compile(r'\s+|([(){}])|(-)(?=\S)|"([^"]*)("?)|([^\s(){}"]+)')
+
+#: A query which is just a word without an operator, or a quoted phrase
+_SIMPLE = re.compile(r'(?:[^\s(){}"\-:][^\s(){}":]*|"[^"]*")\Z')
+
+
+def tokenize(text):
+    """
+    Splits a query into (kind, value) tokens, where kind is one of
+    "(", ")", "{", "}", "-", "OR", "AND", "AROUND", "operator", "word",
+    "phrase" or "unclosed" (a phrase without a closing quote).
+
+    >>> [value for kind, value in tokenize('from:(a OR b) -"c d"')]
+    ['from', '(', 'a', 'OR', 'b', ')', '-', 'c d']
+    """
+    tokens = []
+    for match in _TOKEN.finditer(text):
+        punctuation, negation, phrase, closed, word = match.groups()
+        if punctuation:
+            tokens.append((punctuation, punctuation))
+        elif negation:
+            tokens.append(("-", negation))
+        elif phrase is not None:
+            tokens.append(("phrase" if closed else "unclosed", phrase))
+        elif word:
+            name, colon, rest = word.partition(":")
+            if colon and name.lower() in OPERATORS:
+                tokens.append(("operator", name.lower()))
+                if rest:
+                    tokens.append(("word", rest))
+            elif word in ("OR", "|"):
+                tokens.append(("OR", word))
+            elif word in ("AND", "AROUND"):
+                tokens.append((word, word))
+            else:
+                tokens.append(("word", word))
+    return tokens
+
+
+class _Parser(object):
+    """
+    A recursive descent parser for Gmail queries. As in Gmail, OR binds
+    more tightly than AND (whether it's written or implied by a space),
+    so `a b OR c` means `a AND (b OR c)`.
+
+    It is lenient about mistakes like unbalanced parentheses, and doesn't
+    model AROUND (which it treats as a word), so `exact` is set to False
+    if the tree it returns leaves out anything in the query.
+    """
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.position = 0
+        self.exact = True
+
+    def peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position][0]
+        return None
+
+    def next(self):
+        token = self.tokens[self.position]
+        self.position += 1
+        return token
+
+    def parse(self, operator=None):
+        node = self.conjunction(operator, closing=None)
+        # be lenient about unbalanced parentheses
+        while self.peek() is not None:
+            self.next()
+            self.exact = False
+            node = And([node, self.conjunction(operator, closing=None)])
+        return node
+
+    def conjunction(self, operator, closing):
+        operands = []
+        while self.peek() not in (None, closing):
+            if self.peek() in ("AND", "OR"):
+                self.next()
+                # an AND between two operands is the same as a space, but
+                # a leading, trailing or doubled AND or OR is a mistake
+                if self.peek() in (None, closing, ")", "}", "AND", "OR"):
+                    self.exact = False
+                elif self.tokens[self.position - 1][0] == "OR" or not operands:
+                    self.exact = False
+                continue
+            if self.peek() in (")", "}"):
+                break
+            operands.append(self.disjunction(operator, closing))
+        if not operands:
+            self.exact = False
+        return operands[0] if len(operands) == 1 else And(operands)
+
+    def disjunction(self, operator, closing):
+        operands = [self.unary(operator, closing)]
+        while self.peek() == "OR":
+            self.next()
+            if self.peek() in (None, closing, ")", "}", "AND", "OR"):
+                self.exact = False
+                break
+            operands.append(self.unary(operator, closing))
+        return operands[0] if len(operands) == 1 else Or(operands)
+
+    def unary(self, operator, closing):
+        if self.peek() == "-":
+            self.next()
+            if self.peek() in (None, closing, ")", "}"):
+                self.exact = False
+                return Term(operator, "-")
+            return Not(self.unary(operator, closing))
+        return self.primary(operator, closing)
+
+    def primary(self, operator, closing):
+        kind, value = self.next()
+        if kind == "operator":
+            if self.peek() in (None, ")", "}", "OR", "AND"):
+                self.exact = False
+                return Term(None, value + ":")
+            return self.unary(value, closing)
+        if kind == "(":
+            node = self.conjunction(operator, ")")
+            if self.peek() == ")":
+                self.next()
+            else:
+                self.exact = False
+            return node
+        if kind == "{":
+            operands = []
+            while self.peek() not in (None, "}"):
+                if self.peek() in ("OR", "AND", ")"):
+                    self.next()
+                    self.exact = False
+                    continue
+                operands.append(self.unary(operator, "}"))
+            if self.peek() == "}":
+                self.next()
+            else:
+                self.exact = False
+            if not operands:
+                self.exact = False
+            return operands[0] if len(operands) == 1 else Or(operands)
+        if kind in ("AROUND", "unclosed") or value == "-":
+            self.exact = False
+        return Term(operator, value, phrase=(kind in ("phrase", "unclosed")))
+
+
+def parse(text, operator=None):
+    """
+    Parses a query into a tree of nodes. If operator is given, it applies
+    to every term that doesn't have its own (as in the `from` criterion of
+    a filter). Results are cached, so they must not be modified.
+
+    >>> parse('list:(a OR b) -"great discount" c')
+    And((Or((Term('list', 'a', False), Term('list', 'b', False))),
+         Not(Term(None, 'great discount', True)),
+         Term(None, 'c', False)))
+    >>> parse('alice bob', operator='from')
+    And((Term('from', 'alice', False), Term('from', 'bob', False)))
+    """
+    return _parse(text, operator)[0]
+
+
+def parse_exact(text, operator=None):
+    """
+    Like parse(), but returns Raw(text) if the tree would leave out anything
+    in the query, such as AROUND or an unclosed parenthesis or quote, so
+    that to_text() of the result always means the same as the query.
+
+    >>> parse_exact('"a b" OR c')
+    Or((Term(None, 'a b', True), Term(None, 'c', False)))
+    >>> parse_exact('(a AROUND 5 b)')
+    Raw('(a AROUND 5 b)')
+    """
+    node, exact = _parse(text, operator)
+    return node if exact else Raw(text)
+
+
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
+def _parse(text, operator):
+    """Returns (parse(text, operator), whether it leaves nothing out)."""
+    if _SIMPLE.match(text) and text not in ("OR", "|", "AND", "AROUND"):
+        # most conditions are a single address or word, or a quoted phrase
+        if text.startswith('"'):
+            return Term(operator, text[1:-1], phrase=True), True
+        return Term(operator, text), True
+    parser = _Parser(tokenize(text))
+    node = parser.parse(operator)
+    return node, parser.exact
+
+
+def criteria_query(criteria):
+    """
+    Returns a single query node which matches the same messages as a filter
+    with the given flattened criteria, i.e. {condition key: value}.
+
+    >>> criteria_query({'from': 'alice', 'doesNotHaveTheWord': 'spam'})
+    And((Term('from', 'alice', False), Not(Term(None, 'spam', False))))
+    """
+    operands = []
+    for key, value in criteria.items():
+        node = parse(str(value), CONDITION_OPERATORS[key])
+        if key == "doesNotHaveTheWord":
+            node = Not(node)
+        operands.append(node)
+    return operands[0] if len(operands) == 1 else And(operands)
+
+
+def rule_criteria(rule):
+    """Returns a rule's flattened conditions as {key: value}."""
+    return {
+        key: construct.value
+        for key, construct in rule.flatten().items()
+        if key in CONDITION_OPERATORS
+    }
+
+
+def is_single_term(value):
+    """
+    Returns True if query text doesn't need parentheses to be combined with
+    others by OR or AND, i.e. it has no spaces outside quotes or parentheses.
+
+    >>> is_single_term('"great discount"'), is_single_term('-(a OR b)')
+    (True, True)
+    >>> is_single_term('foo "bar baz"'), is_single_term('(a) AND (b)')
+    (False, False)
+    """
+    depth = 0
+    quoted = False
+    for char in value:
+        if char == '"':
+            quoted = not quoted
+        elif quoted:
+            continue
+        elif char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+        elif char.isspace() and depth == 0:
+            return False
+    return True
+
+
+def count_terms(node):
+    """
+    Returns the number of terms (and Raw text) in a query.
+
+    >>> count_terms(parse('a (b OR -c) a'))
+    4
+    """
+    if isinstance(node, (And, Or)):
+        return sum(count_terms(operand) for operand in node.operands)
+    if isinstance(node, Not):
+        return count_terms(node.operand)
+    return 1
+
+
+def canonicalize(node):
+    """
+    Returns a query which matches the same messages as node, in a canonical
+    form, so that queries which only differ in how they're written are equal:
+
+    - nested ANDs and ORs are flattened into their parents, and parentheses
+      around a single term are dropped;
+    - the operands of each AND and OR are sorted, without duplicates;
+    - operands which are absorbed by another are removed, e.g.
+      `a (a OR b)` is just `a`, and `a OR (a b)` is also `a`;
+    - double negations are removed.
+
+    Quoted words are kept distinct from unquoted ones, since Gmail only
+    matches them exactly.
+
+    >>> canonicalize(parse('-(-b) a (a)')) == canonicalize(parse('(a AND b)'))
+    True
+    >>> canonicalize(parse('(x OR y) (y OR x OR z) x'))
+    Term(None, 'x', False)
+    """
+    return _canonical(node)[0]
+
+
+def canonical_form(node):
+    """
+    Returns (canonicalize(node), to_text() of that), working both out at once.
+
+    >>> canonical_form(parse('b a'))
+    (And((Term(None, 'a', False), Term(None, 'b', False))), 'a AND b')
+    """
+    return _canonical(node)[:2]
+
+
+def _canonical(node):
+    """
+    Returns (canonical node, its text, operands), where operands is a list
+    of the same for each operand of an And or Or, and None otherwise. The
+    text is worked out along the way, since operands are sorted by it.
+    """
+    node_type = type(node)
+    if node_type is Term:
+        value = '"' + node.value + '"' if node.phrase else node.value
+        return node, (node.operator + ":" + value if node.operator else value), None
+    if node_type is Raw:
+        return node, node.value, None
+    if node_type is Not:
+        canonical = _canonical(node.operand)
+        if type(canonical[0]) is Not:
+            return _canonical(canonical[0].operand)
+        return Not(canonical[0]), "-" + _grouped(canonical), None
+    unique = {}
+    for operand in node.operands:
+        canonical = _canonical(operand)
+        if type(canonical[0]) is node_type:
+            for each in canonical[2]:
+                unique.setdefault(each[1], each)
+        else:
+            unique.setdefault(canonical[1], canonical)
+    # a AND (a OR b) is a, and a OR (a AND b) is a; the operands of the
+    # inner AND or OR are never themselves ANDs or ORs (they've been
+    # flattened), so the operand which absorbs another is never removed
+    absorbing = And if node_type is Or else Or
+    for text, (operand, _, parts) in list(unique.items()):
+        if type(operand) is absorbing and any(part[1] in unique for part in parts):
+            del unique[text]
+    operands = [unique[text] for text in sorted(unique)]
+    if len(operands) == 1:
+        return operands[0]
+    joiner = " OR " if node_type is Or else " AND "
+    text = joiner.join([_grouped(each) for each in operands])
+    return node_type([each[0] for each in operands]), text, operands
+
+
+def _grouped(canonical):
+    """Returns the text of a (node, text, operands) from _canonical as an operand."""
+    node, text, operands = canonical
+    if operands is not None and len(operands) > 1:
+        return "({0})".format(text)
+    if type(node) is Raw and not is_single_term(text):
+        return "({0})".format(text)
+    return text
+
+
+def to_text(node, grouped=False):
+    """
+    Returns query text for a node, with parentheses only where needed, or
+    around the whole query too if it's an AND or OR and grouped is True (as
+    the values of conditions which combine others conventionally are).
+
+    >>> to_text(canonicalize(parse('subject:("weekly report" OR digest) -(-"b")')))
+    '"b" AND (subject:"weekly report" OR subject:digest)'
+    >>> to_text(parse('a OR b'), grouped=True)
+    '(a OR b)'
+    """
+    if isinstance(node, Term):
+        value = '"{0}"'.format(node.value) if node.phrase else node.value
+        return "{0}:{1}".format(node.operator, value) if node.operator else value
+    if isinstance(node, Raw):
+        return node.value
+    if isinstance(node, Not):
+        return "-" + _parenthesized(node.operand, to_text(node.operand))
+    joiner = " OR " if isinstance(node, Or) else " AND "
+    text = joiner.join(
+        _parenthesized(operand, to_text(operand)) for operand in node.operands
+    )
+    return _parenthesized(node, text) if grouped else text
+
+
+def _parenthesized(node, text):
+    if isinstance(node, (And, Or)) and len(node.operands) > 1:
+        return "({0})".format(text)
+    if isinstance(node, Raw) and not is_single_term(text):
+        return "({0})".format(text)
+    return text
+
+
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
+def canonical_text(text, operator=None):
+    """
+    Returns the canonical text of a query (see canonicalize()).
+
+    >>> canonical_text('(bob OR alice) OR (alice)', 'from')
+    'from:alice OR from:bob'
+    """
+    return _canonical(parse(text, operator))[1]
+
+
+def canonical_criteria(criteria):
+    """
+    Returns the canonical text of a query which matches the same messages
+    as a filter with the given criteria, as (condition key, value) pairs,
+    so that filters whose criteria are written differently, or split
+    differently between conditions, have the same canonical criteria if
+    they're equivalent. Returns None if any of them can't be parsed
+    exactly (see parse_exact()), or if any contain {placeholders} still to
+    be formatted, since they can't be compared reliably.
+
+    >>> canonical_criteria([('from', 'alice'), ('hasTheWord', 'list:(x)')])
+    'from:alice AND list:x'
+    >>> canonical_criteria([('hasTheWord', 'list:x from:(alice)')])
+    'from:alice AND list:x'
+    >>> canonical_criteria([('hasTheWord', 'a AROUND 3 b')]) is None
+    True
+    >>> canonical_criteria([('to', '{user}@example.com')]) is None
+    True
+    """
+    operands = []
+    for key, value in criteria:
+        text = str(value)
+        if "{" in text or "}" in text:
+            return None
+        node, exact = _parse(text, CONDITION_OPERATORS[key])
+        if not exact:
+            return None
+        operands.append(Not(node) if key == "doesNotHaveTheWord" else node)
+    return _canonical(And(operands))[1]
@@ -2,15 +2,35 @@
 # -*- coding: utf-8 -*-
 from __future__ import print_function, unicode_literals
 
-from collections import OrderedDict
+import json
+import os
+import re
+import tempfile
+from collections import deque
 from collections.abc import Iterable
+from concurrent.futures import ProcessPoolExecutor
 from datetime import date, datetime
-from functools import total_ordering
-from itertools import chain
+from functools import lru_cache, partial, total_ordering
+from hashlib import blake2b
+from itertools import chain, islice
 from operator import attrgetter
+from string import Formatter
+from weakref import ref as weakref
 
 from lxml import etree
 
+from .query import (
+    And,
+    Not,
+    Or,
+    Raw,
+    canonical_criteria,
+    canonical_form,
+    canonicalize,
+    count_terms,
+    parse_exact,
+)
+
 
 def quote_value_if_necessary(value):
     """
@@ -56,6 +76,9 @@ class InvalidRuleType(ValueError):
 
 @total_ordering
 class _RuleConstruction(object):
+    # there can be millions of these, so don't give each one a __dict__
+    __slots__ = ("key", "_value")
+
     #: Maps kwargs and YAML keys to Google values
     identifier_map = None
 
@@ -96,8 +119,47 @@ class _RuleConstruction(object):
         return value  # pragma: no cover
 
     def apply_format(self, **format_vars):
+        """
+        Formats this construction's value in place. Don't use this on
+        constructions which may be shared (see interned()); use with_value().
+        """
         self._value = self._value.format(**format_vars)
 
+    @classmethod
+    def interned(cls, key, value, validate_value=True):
+        """
+        Returns a construction equal to cls(key, value, validate_value), which
+        may be shared with anything else that asked for the same one, so that
+        identical constructions are only built and validated once.
+        Interned constructions must never be changed.
+
+        >>> RuleAction.interned('archive', True) is RuleAction.interned('archive', True)
+        True
+        """
+        return _interned(cls, key, value, validate_value)
+
+    @classmethod
+    def from_validated(cls, key, value):
+        """
+        Returns a construction from a key and value which were already
+        validated (e.g. taken from another construction), without checking them.
+        Like interned(), the result may be shared.
+        """
+        return _interned_validated(cls, key, value)
+
+    @classmethod
+    def _from_validated(cls, key, value):
+        construction = cls.__new__(cls)
+        construction.key = key
+        construction._value = value
+        return construction
+
+    def with_value(self, value):
+        """
+        Returns a copy of this construction with a different (already validated) value.
+        """
+        return self._from_validated(self.key, value)
+
     def __hash__(self):
         return hash((self.key, self.value))
 
@@ -220,12 +282,29 @@ class RuleCondition(_RuleConstruction):
         "smaller": _search_operator("smaller"),
     }
 
+    __slots__ = ("negate",)
+
     def __init__(self, key, value, validate_value=True, negate=False):
         super(RuleCondition, self).__init__(key, value, validate_value=validate_value)
         self.negate = negate
 
+    @classmethod
+    def _from_validated(cls, key, value):
+        condition = super(RuleCondition, cls)._from_validated(key, value)
+        condition.negate = False
+        return condition
+
+    def with_value(self, value):
+        clone = super(RuleCondition, self).with_value(value)
+        clone.negate = self.negate
+        return clone
+
+    @classmethod
+    def interned(cls, key, value, validate_value=True, negate=False):
+        return _interned(cls, key, value, validate_value, negate)
+
     def negated(self):
-        return self.__class__(
+        return self.interned(
             self.key, self.value, validate_value=False, negate=(not self.negate)
         )
 
@@ -245,7 +324,25 @@ class RuleCondition(_RuleConstruction):
     def joined_by(cls, joiner, key, values):
         validated = [cls.validate_value(key, value) for value in sorted(values)]
         joined = "({0})".format(joiner.join(validated))
-        return cls(key, joined, validate_value=False)
+        return cls.interned(key, joined, validate_value=False)
+
+    @classmethod
+    def from_query(cls, key, query):
+        """
+        Returns a condition whose value is the text of a query (see the
+        query module), once it has been simplified.
+
+        >>> RuleCondition.from_query('from', parse_exact('bob OR (alice OR bob)'))
+        RuleCondition(u'from', u'(alice OR bob)')
+        >>> RuleCondition.from_query('list', Not(parse_exact('x')))
+        RuleCondition(u'hasTheWord', u'-list:(x)')
+        """
+        query, text = canonical_form(query)
+        if isinstance(query, Not):
+            return cls.from_query(key, query.operand).negated()
+        if isinstance(query, (And, Or)) and len(query.operands) > 1:
+            text = "({0})".format(text)
+        return cls.interned(key, text, validate_value=False)
 
     @classmethod
     def and_(cls, key, values):
@@ -262,6 +359,8 @@ class RuleAction(_RuleConstruction):
     RuleAction(u'shouldAlwaysMarkAsImportant', u'true')
     """
 
+    __slots__ = ()
+
     identifier_map = {
         "label": "label",
         "important": "shouldAlwaysMarkAsImportant",
@@ -286,6 +385,66 @@ class RuleAction(_RuleConstruction):
             return value
 
 
+#: How many distinct constructions are kept to be shared between rules
+INTERN_CACHE_SIZE = 1 << 16
+
+
+@lru_cache(maxsize=INTERN_CACHE_SIZE)
+def _interned(cls, key, value, *options):
+    return cls(key, value, *options)
+
+
+@lru_cache(maxsize=INTERN_CACHE_SIZE)
+def _interned_validated(cls, key, value):
+    return cls._from_validated(key, value)
+
+
+@lru_cache(maxsize=INTERN_CACHE_SIZE)
+def _construction_for(key, value):
+    """
+    Returns the (shared) RuleCondition or, failing that, RuleAction
+    for a key and value from a configuration file.
+    """
+    try:
+        return RuleCondition(key, value)
+    except InvalidIdentifier:
+        return RuleAction(key, value)
+
+
+def _condition_query(value):
+    """
+    Returns a condition's value as a query. Values which might still have
+    {placeholders} in them, or which can't be parsed exactly, are kept as
+    they are (see query.parse_exact), since braces mean OR to Gmail.
+    """
+    text = str(value)
+    if "{" in text or "}" in text:
+        return Raw(text)
+    return parse_exact(text)
+
+
+#: A word or "quoted phrase" (perhaps with an operator or negated), which
+#: there's nothing to simplify in
+_SINGLE_TERM = re.compile(r'-?(?:[^\s(){}"]+|"[^"]*")+\Z')
+
+
+def _simplified(condition, values, combine=And):
+    """
+    Returns a condition which means the same as the given one, which combines
+    values with AND (or OR, if given ``combine=Or``), once it has been
+    simplified; or the condition itself if
+    simplifying it wouldn't leave out any of their terms, so that conditions
+    which can't be simplified are written as they always have been.
+    """
+    if len(values) == 1 and _SINGLE_TERM.match(str(values[0])):
+        return condition
+    query = combine(_condition_query(value) for value in values)
+    terms = count_terms(query)
+    if terms == 1 or count_terms(canonicalize(query)) == terms:
+        return condition
+    return RuleCondition.from_query(condition.key, query)
+
+
 def build_compound_conditions(key, compound):
     """
     Create an "any" or "all" (or combination thereof).
@@ -309,7 +468,7 @@ def build_compound_conditions(key, compound):
     [RuleCondition(u'hasTheWord', u'(bar AND foo)'), RuleCondition(u'hasTheWord', u'-(baz OR blitz)')]
     """
     if isinstance(compound, str):
-        return [RuleCondition(key, compound)]
+        return [RuleCondition.interned(key, compound)]
 
     invalid_keys = set(compound) - set(["any", "all", "not"])
     if invalid_keys:
@@ -393,13 +552,36 @@ class Rule(object):
     ... })
     >>> rule.flatten()
     {u'to': RuleCondition(u'to', u'((satya@msft.com) AND -(bill@msft.com OR steve@msft.com))')}
+
+    Conditions which repeat others, or are implied by them, are left out:
+
+    >>> rule = Rule({'from': {'all': ['alice', 'alice'], 'any': ['alice', 'bob']}})
+    >>> rule.flatten()
+    {u'from': RuleCondition(u'from', u'alice')}
     """
 
+    __slots__ = (
+        "_conditions",
+        "_actions",
+        "_cache",
+        "_dependents",
+        "_base_rule",
+        "__weakref__",
+    )
+
     def __init__(self, data=None, base_rule=None):
-        # Maps the canonical Google rule key (e.g. hasTheWord) to a list of values (AND'd)
+        # Maps the canonical Google rule key (e.g. hasTheWord) to a tuple of
+        # distinct values (AND'd); tuples are much smaller than sets
         self._conditions = {}
-        # Maps the canonical Google rule key (e.g. hasTheWord) to a list of values (AND'd)
+        # Maps the canonical Google rule key (e.g. hasTheWord) to a tuple of
+        # distinct values (AND'd)
         self._actions = {}
+        # Derived views (data, flattened constructs, etc.) computed on first access
+        self._cache = {}
+        # Weak references to rules which use this one as their base
+        # (a list is only made for rules which have any)
+        self._dependents = ()
+        self._base_rule = None
         self.base_rule = base_rule
         if data:
             self.update(data)
@@ -412,14 +594,72 @@ class Rule(object):
         return "{0}({1})".format(self.__class__.__name__, ", ".join(sorted(rule_reprs)))
 
     def __hash__(self):
-        return hash(self.sortable_data)
+        return self._cached("hash", lambda: int(self.fingerprint[:16], 16))
 
     def __eq__(self, other):
-        return self.sortable_data == other.sortable_data
+        return self is other or self.fingerprint == other.fingerprint
 
     def __lt__(self, other):
         return self.sortable_data < other.sortable_data
 
+    def __getstate__(self):
+        # weak references can't be pickled, so leave out _dependents
+        return (self._conditions, self._actions, self._cache, self._base_rule)
+
+    def __setstate__(self, state):
+        self._conditions, self._actions, self._cache, base_rule = state
+        self._dependents = ()
+        self._base_rule = None
+        if base_rule is not None:
+            self._base_rule = base_rule
+            base_rule._add_dependent(self)
+
+    @property
+    def base_rule(self):
+        return self._base_rule
+
+    @base_rule.setter
+    def base_rule(self, base_rule):
+        if self._base_rule is not None:
+            self._base_rule._dependents = [
+                dependent_ref
+                for dependent_ref in self._base_rule._dependents
+                if dependent_ref() is not None and dependent_ref() is not self
+            ]
+        self._base_rule = base_rule
+        if base_rule is not None:
+            base_rule._add_dependent(self)
+        self._invalidate()
+
+    def _add_dependent(self, rule):
+        if not self._dependents:
+            self._dependents = []
+        self._dependents.append(weakref(rule))
+
+    def _cached(self, name, compute):
+        try:
+            return self._cache[name]
+        except KeyError:
+            value = self._cache[name] = compute()
+            return value
+
+    def _invalidate(self):
+        """
+        Discards derived views of this rule and of any rules based on it.
+        """
+        # A dependent can only have cached anything if we have too,
+        # since computing its data requires computing ours first.
+        if not self._cache:
+            return
+        self._cache.clear()
+        live_dependents = []
+        for dependent_ref in self._dependents:
+            dependent = dependent_ref()
+            if dependent is not None:
+                dependent._invalidate()
+                live_dependents.append(dependent_ref)
+        self._dependents = live_dependents
+
     def update(self, data):
         for key, value in dict(data).items():
             self.add(key, value)
@@ -440,20 +680,23 @@ class Rule(object):
             raise InvalidRuleType(type(value))
 
     def add_construction(self, key, value):
-        try:
-            self.add_condition(RuleCondition(key, value))
-        except InvalidIdentifier:
-            self.add_action(RuleAction(key, value))
+        construction = _construction_for(key, value)
+        if isinstance(construction, RuleCondition):
+            self.add_condition(construction)
+        else:
+            self.add_action(construction)
 
     def add_compound_conditions(self, key, compound):
         for condition in build_compound_conditions(key, compound):
             self.add_condition(condition)
 
     def add_condition(self, condition):
-        self._conditions.setdefault(condition.key, set()).add(condition)
+        _add_to(self._conditions, condition)
+        self._invalidate()
 
     def add_action(self, action):
-        self._actions.setdefault(action.key, set()).add(action)
+        _add_to(self._actions, action)
+        self._invalidate()
 
     @property
     def publishable(self):
@@ -468,10 +711,18 @@ class Rule(object):
         """
         Returns a single dictionary representing all of
         the rule's conditions and actions, including its base.
+
+        The result is cached until the rule (or its base) changes,
+        so callers should not modify it.
         """
+        return self._cached("data", self._build_data)
+
+    def _build_data(self):
         data = {}
         if self.base_rule:
-            data.update(self.base_rule.data)
+            # copy the lists, since the base rule's data is cached
+            for key, values in self.base_rule.data.items():
+                data[key] = list(values)
         for condition in list(chain.from_iterable(self._conditions.values())):
             data.setdefault(condition.key, []).append(condition)
         for action in list(chain.from_iterable(self._actions.values())):
@@ -480,24 +731,98 @@ class Rule(object):
 
     @property
     def sortable_data(self):
-        return _sortable(self.data)
+        return self._cached("sortable_data", self._build_sortable_data)
+
+    def _build_sortable_data(self):
+        return tuple(
+            (key, tuple(sorted(constructs)))
+            for key, constructs in sorted(self.data.items())
+        )
+
+    @property
+    def fingerprint(self):
+        """
+        Returns a hex digest of the rule's conditions and actions.
+        Unlike hash(), this is the same in every process, so it can be
+        used to identify a rule across runs.
+
+        >>> Rule({'from': 'alice', 'archive': True}).fingerprint
+        'cdf3f81c3154c685716bb967076ba3be'
+        """
+        return self._cached("fingerprint", self._build_fingerprint)
+
+    def _build_fingerprint(self):
+        canonical = json.dumps(
+            [
+                [key, sorted(str(construct.value) for construct in constructs)]
+                for key, constructs in sorted(self.data.items())
+            ],
+            ensure_ascii=False,
+            separators=(",", ":"),
+        )
+        return blake2b(canonical.encode("utf-8"), digest_size=16).hexdigest()
+
+    @property
+    def canonical_key(self):
+        """
+        Returns a hex digest of the rule's actions and the canonical form of
+        its criteria (see query.canonical_criteria), which is the same for
+        rules that are written differently but match the same messages.
+
+        Criteria which can't be parsed exactly are compared as they're
+        written instead.
+
+        >>> a = Rule({'from': {'any': ['bob', 'alice']}, 'archive': True})
+        >>> b = Rule({'match': '(from:alice OR from:bob)', 'archive': True})
+        >>> a.fingerprint == b.fingerprint, a.canonical_key == b.canonical_key
+        (False, True)
+        """
+        return self._cached("canonical_key", self._build_canonical_key)
+
+    def _build_canonical_key(self):
+        criteria = []
+        actions = []
+        for key, constructs in self.data.items():
+            for construct in constructs:
+                if isinstance(construct, RuleCondition):
+                    criteria.append((key, construct.value))
+                else:
+                    actions.append([key, str(construct.value)])
+        canonical_text = canonical_criteria(criteria)
+        canonical = json.dumps(
+            [
+                sorted(criteria) if canonical_text is None else canonical_text,
+                sorted(actions),
+            ],
+            ensure_ascii=False,
+            separators=(",", ":"),
+        )
+        return blake2b(canonical.encode("utf-8"), digest_size=16).hexdigest()
 
     @property
     def conditions(self):
         """Returns a list of this rule's conditions."""
-        return self._separated_constructs(RuleCondition)
+        return list(
+            self._cached(
+                "conditions", lambda: self._separated_constructs(RuleCondition)
+            )
+        )
 
     @property
     def actions(self):
         """Returns a list of all this rule's conditions."""
-        return self._separated_constructs(RuleAction)
+        return list(
+            self._cached("actions", lambda: self._separated_constructs(RuleAction))
+        )
 
     def _separated_constructs(self, construct_class):
-        return sorted(
-            data_value
-            for data_key, data_values in self.data.items()
-            for data_value in data_values
-            if isinstance(data_value, construct_class)
+        return tuple(
+            sorted(
+                data_value
+                for data_key, data_values in self.data.items()
+                for data_value in data_values
+                if isinstance(data_value, construct_class)
+            )
         )
 
     def flatten(self):
@@ -505,44 +830,109 @@ class Rule(object):
         Combine all conditions or actions which share the same key,
         and return a single dict of constructs that can be serialized.
         """
+        return dict(self._cached("flattened", self._build_flattened))
+
+    def _build_flattened(self):
         flattened = {}
         for key, constructs in self.data.items():
             construct_class = constructs[0].__class__  # we shouldn't ever mix
             if len(constructs) == 1:
-                flattened[key] = construct_class(
-                    key, constructs[0].value, validate_value=False
+                construct = construct_class.from_validated(key, constructs[0].value)
+            elif key == "doesNotHaveTheWord":
+                # Gmail negates the whole value, so -(a OR b) excludes both
+                construct = construct_class.or_(
+                    key, sorted(c.value for c in constructs)
                 )
             else:
-                flattened[key] = construct_class.and_(
+                construct = construct_class.and_(
                     key, sorted(c.value for c in constructs)
                 )
+            if construct_class is RuleCondition:
+                construct = _simplified(
+                    construct,
+                    [c.value for c in constructs],
+                    Or if key == "doesNotHaveTheWord" else And,
+                )
+            flattened[key] = construct
         return flattened
 
+    @classmethod
+    def from_constructions(cls, conditions, actions, base_rule=None):
+        """
+        Builds a rule directly from RuleCondition and RuleAction instances.
+        """
+        rule = cls(base_rule=base_rule)
+        for condition in conditions:
+            _add_to(rule._conditions, condition)
+        for action in actions:
+            _add_to(rule._actions, action)
+        return rule
+
+    def compact(self):
+        """
+        Returns this rule's conditions and actions (including those of its
+        base), its flattened form, fingerprint and canonical key as a tuple of
+        strings, which can be stored cheaply and turned back into an equal
+        rule by from_compact().
+        """
+        return (
+            tuple((c.key, c.value) for c in self.conditions),
+            tuple((a.key, a.value) for a in self.actions),
+            tuple((key, c.value) for key, c in self.flatten().items()),
+            self.fingerprint,
+            self.canonical_key,
+        )
+
+    @classmethod
+    def from_compact(cls, compact):
+        """
+        Returns a rule (without a base rule) from the result of compact().
+
+        >>> rule = Rule({'from': ['alice', 'bob'], 'archive': True})
+        >>> copy = Rule.from_compact(rule.compact())
+        >>> copy == rule, copy.flatten() == rule.flatten()
+        (True, True)
+        """
+        conditions, actions, flattened, fingerprint, canonical_key = compact
+        rule = cls.from_constructions(
+            [RuleCondition.from_validated(key, value) for key, value in conditions],
+            [RuleAction.from_validated(key, value) for key, value in actions],
+        )
+        construct_class = {key: RuleCondition for key, _ in conditions}
+        construct_class.update((key, RuleAction) for key, _ in actions)
+        rule._cache["flattened"] = {
+            key: construct_class[key].from_validated(key, value)
+            for key, value in flattened
+        }
+        rule._cache["fingerprint"] = fingerprint
+        rule._cache["canonical_key"] = canonical_key
+        return rule
+
     def apply_format(self, **format_vars):
         """Uses the same semantics as str.format to interpolate variables into
         the values of conditions and actions.
         """
         for construction_dict in (self._actions, self._conditions):
             for construction_key, construction_objs in construction_dict.items():
-                for construction in construction_objs:
-                    construction.apply_format(**format_vars)
+                # constructions may be shared with other rules, so replace them
+                construction_dict[construction_key] = tuple(
+                    set(
+                        construction.with_value(
+                            construction._value.format(**format_vars)
+                        )
+                        for construction in construction_objs
+                    )
+                )
+        self._invalidate()
 
 
-def _sortable(obj):
+def _add_to(construction_dict, construction):
     """
-    >>> _sortable(1)
-    1
-    >>> _sortable({1, 2, 3})
-    (1, 2, 3)
-    >>> _sortable({1: 2, 3: 4})
-    ((1, 2), (3, 4))
+    Adds a construction to a Rule's _conditions or _actions, unless it's already there.
     """
-    if isinstance(obj, dict):
-        return tuple(sorted((key, _sortable(value)) for (key, value) in obj.items()))
-    elif isinstance(obj, (tuple, list, set)):
-        return tuple(obj)
-    else:
-        return obj
+    existing = construction_dict.get(construction.key, ())
+    if construction not in existing:
+        construction_dict[construction.key] = existing + (construction,)
 
 
 class RuleSet(object):
@@ -557,7 +947,7 @@ class RuleSet(object):
     foreach_rule_key = "rule"
 
     def __init__(self):
-        self._rules = OrderedDict()
+        self._rules = {}
 
     def __len__(self):
         return len(self._rules)
@@ -566,7 +956,9 @@ class RuleSet(object):
         yield from self._rules.values()
 
     def add(self, rule):
-        self._rules[hash(rule)] = rule
+        # rules which are written differently but are equivalent (see
+        # Rule.canonical_key) only become one filter, written the first way
+        self._rules.setdefault(rule.canonical_key, rule)
 
     def update(self, ruleset):
         for rule in ruleset.rules:
@@ -577,12 +969,18 @@ class RuleSet(object):
         return self._rules.values()
 
     @classmethod
-    def from_object(cls, obj, base_rule=None):
-        """Returns a RuleSet from a dictionary or list of rules."""
+    def from_object(cls, obj, base_rule=None, jobs=1, cache=None):
+        """
+        Returns a RuleSet from a dictionary or list of rules.
+
+        If jobs is greater than one, each item of a list is built
+        in a pool of that many worker processes. If a RuleCache is given,
+        items of a list which were built before are loaded from it.
+        """
         if isinstance(obj, dict):
             return cls.from_dict(obj, base_rule=base_rule)
         elif isinstance(obj, Iterable):
-            return cls.from_iterable(obj, base_rule=base_rule)
+            return cls.from_iterable(obj, base_rule=base_rule, jobs=jobs, cache=cache)
         else:
             raise ValueError("Cannot build {0} from {1}".format(cls, type(obj)))
 
@@ -608,59 +1006,278 @@ class RuleSet(object):
         return ruleset
 
     @classmethod
-    def from_iterable(cls, iterable, base_rule=None):
+    def from_iterable(cls, iterable, base_rule=None, jobs=1, cache=None):
         ruleset = cls()
-        for data in iterable:
-            ruleset.update(cls.from_object(data, base_rule=base_rule))
+        rules = cls.iter_from_iterable(
+            iterable, base_rule=base_rule, jobs=jobs, cache=cache
+        )
+        for rule in rules:
+            ruleset.add(rule)
         return ruleset
 
+    @classmethod
+    def iter_from_iterable(cls, iterable, base_rule=None, jobs=1, cache=None):
+        """
+        Yields each unique rule built from the given items as soon as it is
+        built, in the same order that iterating from_iterable() would.
+
+        If jobs is greater than one, items are built in that many worker
+        processes; the results are still yielded in order.
+
+        If a RuleCache is given, items which were built before are loaded
+        from it instead of being built again.
+        """
+        build_all = partial(cls._build_all, base_rule=base_rule, jobs=jobs)
+        if cache is not None:
+            rulesets = cache.build(iterable, build_all, base_rule=base_rule)
+        else:
+            rulesets = build_all(iterable)
+
+        seen = set()
+        for ruleset in rulesets:
+            for rule in ruleset:
+                if rule.canonical_key not in seen:
+                    seen.add(rule.canonical_key)
+                    yield rule
+
+    @classmethod
+    def _build_all(cls, iterable, base_rule=None, jobs=1):
+        build = partial(cls.from_object, base_rule=base_rule)
+        if jobs > 1:
+            return _map_in_processes(build, iterable, jobs)
+        return map(build, iterable)
+
     @classmethod
     def from_foreach_dict(cls, data, base_rule=None):
         if set(data.keys()) != set([cls.foreach_key, cls.foreach_rule_key]):
             raise InvalidIdentifier(data.keys())
 
         ruleset = cls()
+        template = None
         for index, item in enumerate(data[cls.foreach_key]):
-            item_ruleset = cls.from_object(
-                data[cls.foreach_rule_key], base_rule=base_rule
-            )
-            for rule in item_ruleset:
-                if isinstance(item, dict):
-                    rule.apply_format(index=index, **item)
-                else:
-                    rule.apply_format(index=index, item=item)
-            ruleset.update(item_ruleset)
+            if template is None:
+                template = RuleTemplate(
+                    cls.from_object(data[cls.foreach_rule_key], base_rule=base_rule),
+                    base_rule=base_rule,
+                )
+            if isinstance(item, dict):
+                format_vars = dict(index=index, **item)
+            else:
+                format_vars = dict(index=index, item=item)
+            for rule in template.instantiate(format_vars):
+                ruleset.add(rule)
 
         return ruleset
 
 
-def ruleset_to_etree(ruleset):
-    xml = etree.Element(
-        "feed",
-        nsmap={
-            None: "http://www.w3.org/2005/Atom",
-            "apps": "http://schemas.google.com/apps/2006",
-        },
+class RuleTemplate(object):
+    """
+    Holds the rules built from the `rule` of a `for_each` loop, along with which
+    of their values need formatting, so that each item in the loop can get
+    its own copy of the rules without building and validating them again.
+
+    >>> template = RuleTemplate(RuleSet.from_object({'from': '{item}', 'star': True}))
+    >>> [rule.flatten()['from'] for rule in template.instantiate({'item': 'alice'})]
+    [RuleCondition(u'from', u'alice')]
+    """
+
+    def __init__(self, rules, base_rule=None):
+        #: Every rule built from the template (including ones only used as the base of
+        #: another), ordered so that a rule's base always comes before it.
+        self._compiled = []
+        self._positions = {}
+        self._base_rule = base_rule
+        self._outputs = [self._compile(rule) for rule in rules]
+
+    def _compile(self, rule):
+        if id(rule) in self._positions:
+            return self._positions[id(rule)]
+        base_position = None
+        if rule.base_rule is not None and rule.base_rule is not self._base_rule:
+            base_position = self._compile(rule.base_rule)
+        self._compiled.append(
+            (
+                base_position,
+                [
+                    _compile_construction(construction)
+                    for constructions in rule._conditions.values()
+                    for construction in constructions
+                ],
+                [
+                    _compile_construction(construction)
+                    for constructions in rule._actions.values()
+                    for construction in constructions
+                ],
+            )
+        )
+        position = self._positions[id(rule)] = len(self._compiled) - 1
+        return position
+
+    def instantiate(self, format_vars):
+        """
+        Returns a list of new rules with the given variables interpolated
+        into their values, using the same semantics as str.format.
+        """
+        rules = []
+        for base_position, conditions, actions in self._compiled:
+            rules.append(
+                Rule.from_constructions(
+                    _format_constructions(conditions, format_vars),
+                    _format_constructions(actions, format_vars),
+                    base_rule=(
+                        self._base_rule
+                        if base_position is None
+                        else rules[base_position]
+                    ),
+                )
+            )
+        return [rules[position] for position in self._outputs]
+
+
+def _compile_construction(construction):
+    """
+    Returns (construction, needs_format). If formatting could not change
+    the construction's value, needs_format is False and the construction
+    can be shared as-is by every instance of the template.
+    """
+    parsed = list(Formatter().parse(construction._value))
+    if any(field_name is not None for (_, field_name, _, _) in parsed):
+        return (construction, True)
+    literal = "".join(literal_text for (literal_text, _, _, _) in parsed)
+    if literal != construction._value:  # i.e. escaped braces like "{{"
+        construction = construction.with_value(literal)
+    return (construction, False)
+
+
+def _format_constructions(compiled, format_vars):
+    return [
+        (
+            construction.with_value(construction._value.format_map(format_vars))
+            if needs_format
+            else construction
+        )
+        for (construction, needs_format) in compiled
+    ]
+
+
+def _map_in_processes(func, iterable, jobs, chunksize=16):
+    """
+    Like map(), but calls func in a pool of worker processes. Only a few chunks
+    of the iterable are in flight at once, so it is consumed lazily.
+    """
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        pending = deque()
+        iterator = iter(iterable)
+        while True:
+            chunk = list(islice(iterator, chunksize))
+            if chunk:
+                pending.append(executor.submit(_map_chunk, func, chunk))
+            if pending and (not chunk or len(pending) >= jobs * 2):
+                yield from pending.popleft().result()
+            elif not chunk:
+                return
+
+
+def _map_chunk(func, chunk):
+    return [func(item) for item in chunk]
+
+
+ATOM_NAMESPACE = "http://www.w3.org/2005/Atom"
+APPS_NAMESPACE = "http://schemas.google.com/apps/2006"
+FEED_NSMAP = {None: ATOM_NAMESPACE, "apps": APPS_NAMESPACE}
+
+
+def _atom(tag):
+    return "{%s}%s" % (ATOM_NAMESPACE, tag)
+
+
+def add_entry(feed, rule):
+    """
+    Adds an <entry> element describing a single rule to a feed, and returns it.
+    """
+    entry = etree.SubElement(feed, _atom("entry"))
+    etree.SubElement(entry, _atom("category"), term="filter")
+    etree.SubElement(entry, _atom("title")).text = "Mail Filter"
+    etree.SubElement(entry, _atom("id")).text = (
+        "tag:mail.google.com,2008:filter:{0}".format(int(rule.fingerprint, 16))
     )
-    etree.SubElement(xml, "title").text = "Mail Filters"
+    etree.SubElement(entry, _atom("updated")).text = (
+        datetime.now().replace(microsecond=0).isoformat() + "Z"
+    )
+    etree.SubElement(entry, _atom("content"))
+    for construct in sorted(rule.flatten().values(), key=attrgetter("key")):
+        etree.SubElement(
+            entry,
+            "{%s}property" % APPS_NAMESPACE,
+            name=construct.key,
+            value=str(construct.value),
+        )
+    return entry
+
+
+def ruleset_to_etree(ruleset):
+    xml = etree.Element(_atom("feed"), nsmap=FEED_NSMAP)
+    etree.SubElement(xml, _atom("title")).text = "Mail Filters"
     for rule in ruleset:
         if not rule.publishable:
             continue
-        entry = etree.SubElement(xml, "entry")
-        etree.SubElement(entry, "category", term="filter")
-        etree.SubElement(entry, "title").text = "Mail Filter"
-        etree.SubElement(entry, "id").text = (
-            "tag:mail.google.com,2008:filter:{0}".format(abs(hash(rule)))
+        add_entry(xml, rule)
+    return xml
+
+
+def write_ruleset_xml(rules, output, pretty_print=True, encoding="utf8"):
+    """
+    Writes an XML feed of the given rules to a file (or file-like object)
+    one <entry> at a time, so that output begins before all rules are built
+    and the whole document is never held in memory. The output is the same
+    as serializing ruleset_to_etree().
+
+    If output is a path, the feed is written to a temporary file beside it
+    which only replaces it once every rule has been written, so a rule which
+    fails to build never leaves a truncated file in place of the old one.
+    """
+    if not hasattr(output, "write"):
+        directory = os.path.dirname(os.path.abspath(output))
+        with tempfile.NamedTemporaryFile(
+            "wb", dir=directory, suffix=".tmp", delete=False
+        ) as outputf:
+            try:
+                write_ruleset_xml(rules, outputf, pretty_print, encoding)
+            except BaseException:
+                outputf.close()
+                os.remove(outputf.name)
+                raise
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(outputf.name, 0o666 & ~umask)  # as open() would have created it
+        os.replace(outputf.name, output)
+        return
+
+    # Each entry is serialized as the only entry in the feed, and cut out
+    # of it, so that it uses the namespaces declared by the <feed> element
+    # rather than declaring them again (which lxml.etree.xmlfile would do).
+    feed = ruleset_to_etree([])
+
+    def serialize(xml_declaration=False):
+        return etree.tostring(
+            feed,
+            xml_declaration=xml_declaration,
+            encoding=encoding,
+            pretty_print=pretty_print,
         )
-        etree.SubElement(entry, "updated").text = (
-            datetime.now().replace(microsecond=0).isoformat() + "Z"
+
+    empty = serialize(xml_declaration=True)
+    footer = "</feed>{0}".format("\n" if pretty_print else "").encode(encoding)
+    if not empty.endswith(footer):
+        raise ValueError(
+            "unexpected end of serialized XML feed: {0!r}".format(empty[-20:])
         )
-        etree.SubElement(entry, "content")
-        for construct in sorted(rule.flatten().values(), key=attrgetter("key")):
-            etree.SubElement(
-                entry,
-                "{http://schemas.google.com/apps/2006}property",
-                name=construct.key,
-                value=str(construct.value),
-            )
-    return xml
+    output.write(empty[: -len(footer)])
+    start = len(serialize()) - len(footer)
+    for rule in rules:
+        if not rule.publishable:
+            continue
+        entry = add_entry(feed, rule)
+        output.write(serialize()[start : -len(footer)])
+        feed.remove(entry)
+    output.write(footer)
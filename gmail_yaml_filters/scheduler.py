@@ -0,0 +1,432 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+
+import json
+import random
+import sys
+import threading
+import time
+from weakref import WeakKeyDictionary
+
+import googleapiclient.errors
+
+"""
+Sends every Gmail API request through a per-account scheduler, which keeps
+within Gmail's per-user rate limit and retries requests that were throttled
+or hit a server error.
+
+See https://developers.google.com/gmail/api/reference/quota
+"""
+
+
+#: Quota units used by each method we call
+QUOTA_UNITS = {
+    "gmail.users.labels.list": 1,
+    "gmail.users.labels.create": 5,
+    "gmail.users.labels.delete": 5,
+    "gmail.users.settings.filters.list": 1,
+    "gmail.users.settings.filters.create": 5,
+    "gmail.users.settings.filters.delete": 5,
+}
+
+#: Quota units assumed for any other request
+DEFAULT_QUOTA_UNITS = 5
+
+#: Gmail allows each user 250 quota units per second (as a moving average)
+DEFAULT_UNITS_PER_SECOND = 250
+
+#: HTTP statuses which are worth retrying
+RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+
+#: Methods which have the same effect however many times they are sent, so
+#: they can be sent again after a failure which may mean they were applied
+IDEMPOTENT_METHODS = frozenset(
+    [
+        "gmail.users.labels.list",
+        "gmail.users.labels.get",
+        "gmail.users.labels.delete",
+        "gmail.users.settings.filters.list",
+        "gmail.users.settings.filters.get",
+        "gmail.users.settings.filters.delete",
+    ]
+)
+
+
+class MissingResponseError(Exception):
+    """
+    A request in a batch got no response at all, which happens if the batch
+    response was cut short. It is retried like a server error.
+    """
+
+
+def _same_label(body, label):
+    return label.get("name", "").lower() == body.get("name", "").lower()
+
+
+def _same_filter(body, existing):
+    def action(filter_dict):
+        return {
+            key: values if isinstance(values, str) else sorted(values)
+            for key, values in filter_dict.get("action", {}).items()
+        }
+
+    return existing.get("criteria") == body.get("criteria") and action(
+        existing
+    ) == action(body)
+
+
+#: For each create method whose result can be looked for, a function which
+#: returns a request to list the existing resources, the key of the list in
+#: its response, and a function which says if one of them matches a body
+CREATED_RESOURCES = {
+    "gmail.users.labels.create": (
+        lambda service: service.users().labels().list(userId="me"),
+        "labels",
+        _same_label,
+    ),
+    "gmail.users.settings.filters.create": (
+        lambda service: service.users().settings().filters().list(userId="me"),
+        "filter",
+        _same_filter,
+    ),
+}
+
+
+def _method_id(request):
+    return getattr(request, "methodId", None)
+
+
+def _request_body(request):
+    body = getattr(request, "body", None)
+    if isinstance(body, (bytes, str)):
+        body = json.loads(body)
+    return body if isinstance(body, dict) else None
+
+
+def quota_units(request):
+    """
+    >>> from unittest.mock import MagicMock
+    >>> quota_units(MagicMock(methodId="gmail.users.labels.list"))
+    1
+    """
+    return QUOTA_UNITS.get(getattr(request, "methodId", None), DEFAULT_QUOTA_UNITS)
+
+
+class TokenBucket(object):
+    """
+    Allows `rate` units per second on average, with bursts of up to
+    `capacity` units. A caller which takes more units than are available
+    reserves them anyway and is told how long to wait, so callers in
+    different threads are served in the order they arrive.
+    """
+
+    def __init__(self, rate, capacity=None, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.clock = clock
+        self._tokens = self.capacity
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def reserve(self, units):
+        """
+        Takes units from the bucket and returns how many seconds the caller
+        should wait before using them.
+
+        >>> bucket = TokenBucket(10, clock=lambda: 0.0)
+        >>> bucket.reserve(8), bucket.reserve(4), bucket.reserve(5)
+        (0.0, 0.2, 0.7)
+        """
+        with self._lock:
+            now = self.clock()
+            self._tokens = min(
+                self.capacity, self._tokens + (now - self._updated) * self.rate
+            )
+            self._updated = now
+            self._tokens -= units
+            return round(max(0.0, -self._tokens / self.rate), 6)
+
+
+class SchedulerStats(object):
+    def __init__(self):
+        self.requests = 0
+        self.quota_units = 0
+        #: Requests which were rejected because of rate limits
+        self.throttled = 0
+        #: Requests which failed with a server error (5xx)
+        self.server_errors = 0
+        self.retries = 0
+        #: Time spent waiting for the token bucket
+        self.waited_seconds = 0.0
+        #: Time spent backing off before retries
+        self.backoff_seconds = 0.0
+
+    def as_dict(self):
+        return dict(self.__dict__)
+
+    def report(self, file=None):
+        file = file or sys.stderr
+        print(
+            "{0} requests ({1} quota units), {2} throttled, {3} server errors, "
+            "{4} retries; waited {5:.1f}s for quota and {6:.1f}s backing off".format(
+                self.requests,
+                self.quota_units,
+                self.throttled,
+                self.server_errors,
+                self.retries,
+                self.waited_seconds,
+                self.backoff_seconds,
+            ),
+            file=file,
+        )
+
+
+class RequestScheduler(object):
+    """
+    Executes requests for one account, waiting when needed to keep within
+    `rate` quota units per second (or not at all, if rate is None), and
+    retrying rate-limited requests and server errors up to max_retries times
+    with exponential backoff and full jitter (or after the delay the server
+    asked for). Requests which aren't idempotent are only retried after a
+    server error once it's clear they weren't applied (see should_retry()).
+    Safe to use from several threads at once.
+    """
+
+    def __init__(
+        self,
+        rate=DEFAULT_UNITS_PER_SECOND,
+        capacity=None,
+        max_retries=5,
+        base_delay=1.0,
+        max_delay=32.0,
+        sleep=time.sleep,
+        random=random.random,
+    ):
+        self.bucket = TokenBucket(rate, capacity) if rate else None
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.sleep = sleep
+        self.random = random
+        self.stats = SchedulerStats()
+        self._lock = threading.Lock()
+
+    def _count(self, **increments):
+        with self._lock:
+            for name, value in increments.items():
+                setattr(self.stats, name, getattr(self.stats, name) + value)
+
+    def _wait_for_quota(self, requests):
+        units = sum(quota_units(request) for request in requests)
+        self._count(requests=len(requests), quota_units=units)
+        if self.bucket is None:
+            return
+        wait = self.bucket.reserve(units)
+        if wait > 0:
+            self._count(waited_seconds=wait)
+            self.sleep(wait)
+
+    @staticmethod
+    def _failure(exception):
+        """
+        Returns "throttled" if the exception means the request was rejected
+        because of rate limits, "server" if the server failed (or its response
+        was lost), in which case the request may or may not have been applied,
+        and None otherwise.
+        """
+        if isinstance(exception, MissingResponseError):
+            return "server"
+        if not isinstance(exception, googleapiclient.errors.HttpError):
+            return None
+        status = getattr(exception.resp, "status", None)
+        content = exception.content if isinstance(exception.content, bytes) else b""
+        if status == 429 or (status == 403 and b"ateLimitExceeded" in content):
+            return "throttled"
+        if status in RETRY_STATUSES:
+            return "server"
+        return None
+
+    def should_retry(self, exception, request=None, service=None):
+        """
+        Returns True if the exception means the request may succeed if retried,
+        and counts it. Throttled requests are always retried, since they were
+        never applied. After a server error, the request may have been applied
+        anyway, so it is only retried if it is idempotent, or if it is a create
+        whose result can be looked for first with service (see find_created());
+        a request which isn't given is assumed to be idempotent.
+        """
+        failure = self._failure(exception)
+        if failure == "throttled":
+            self._count(throttled=1)
+            return True
+        if failure == "server":
+            self._count(server_errors=1)
+            return (
+                request is None
+                or _method_id(request) in IDEMPOTENT_METHODS
+                or (
+                    service is not None
+                    and _method_id(request) in CREATED_RESOURCES
+                    and _request_body(request) is not None
+                )
+            )
+        return False
+
+    def find_created(self, service, requests, http=None):
+        """
+        Returns a dict of the index of each create request (which failed after
+        it may have been applied) to the label or filter it created, if that
+        exists, listing each kind of resource once.
+        """
+        found = {}
+        listed = {}
+        for index, request in enumerate(requests):
+            body = _request_body(request)
+            if body is None or _method_id(request) not in CREATED_RESOURCES:
+                continue
+            list_request, key, matches = CREATED_RESOURCES[_method_id(request)]
+            if key not in listed:
+                response = self.execute(list_request(service), http=http)
+                listed[key] = response.get(key, [])
+            for existing in listed[key]:
+                if matches(body, existing):
+                    found[index] = existing
+                    break
+        return found
+
+    def _check_created(self, service, requests, exceptions, http=None):
+        """
+        Returns find_created() for the requests which must be looked for
+        before they are retried: creates which failed with a server error.
+        """
+        unsure = {
+            index: request
+            for index, (request, exception) in enumerate(zip(requests, exceptions))
+            if _method_id(request) not in IDEMPOTENT_METHODS
+            and self._failure(exception) == "server"
+        }
+        if not unsure:
+            return {}
+        indexes = list(unsure)
+        found = self.find_created(service, [unsure[index] for index in indexes], http)
+        return {indexes[position]: created for position, created in found.items()}
+
+    def _backoff(self, attempt, exceptions):
+        delay = self.random() * min(self.max_delay, self.base_delay * 2**attempt)
+        for exception in exceptions:
+            try:
+                delay = max(delay, float(exception.resp.get("retry-after")))
+            except (AttributeError, TypeError, ValueError):
+                pass
+        self._count(retries=len(exceptions), backoff_seconds=delay)
+        self.sleep(delay)
+
+    def execute(self, request, service=None, **kwargs):
+        """
+        Executes a single request, retrying it if necessary, and returns
+        its response or raises its last exception. Given the service, a
+        create which fails with a server error is only sent again if what
+        it would have created doesn't exist, which is returned otherwise.
+        """
+        attempt = 0
+        while True:
+            self._wait_for_quota([request])
+            try:
+                return request.execute(**kwargs)
+            except googleapiclient.errors.HttpError as exc:
+                if attempt >= self.max_retries or not self.should_retry(
+                    exc, request, service
+                ):
+                    raise
+                self._backoff(attempt, [exc])
+                attempt += 1
+                created = self._check_created(
+                    service, [request], [exc], kwargs.get("http")
+                )
+                if created:
+                    return created[0]
+
+    def execute_batch(self, service, requests, http=None):
+        """
+        Executes requests in a batch HTTP request and returns a
+        (response, exception) pair for each. Requests which are worth
+        retrying (see should_retry()) are retried together in another batch,
+        except for creates which turn out to have been applied after all.
+        """
+        results = [(None, None)] * len(requests)
+        pending = list(range(len(requests)))
+        attempt = 0
+        while pending:
+            self._wait_for_quota([requests[index] for index in pending])
+            outcomes = {}
+
+            def callback(request_id, response, exception):
+                outcomes[int(request_id)] = (response, exception)
+
+            batch = service.new_batch_http_request(callback=callback)
+            for index in pending:
+                batch.add(requests[index], request_id=str(index))
+            try:
+                batch.execute(http=http)
+            except googleapiclient.errors.HttpError as exc:
+                outcomes = {index: (None, exc) for index in pending}
+
+            retry = []
+            for index in pending:
+                try:
+                    response, exception = outcomes[index]
+                except KeyError:
+                    response, exception = None, MissingResponseError(
+                        "no response for request {0} in batch".format(index)
+                    )
+                results[index] = (response, exception)
+                if (
+                    exception is not None
+                    and attempt < self.max_retries
+                    and self.should_retry(exception, requests[index], service)
+                ):
+                    retry.append(index)
+            if retry:
+                exceptions = [results[index][1] for index in retry]
+                self._backoff(attempt, exceptions)
+                created = self._check_created(
+                    service, [requests[index] for index in retry], exceptions, http
+                )
+                for position, response in created.items():
+                    results[retry[position]] = (response, None)
+                retry = [
+                    index
+                    for position, index in enumerate(retry)
+                    if position not in created
+                ]
+            pending = retry
+            attempt += 1
+        return results
+
+
+_schedulers = WeakKeyDictionary()
+_schedulers_lock = threading.Lock()
+
+
+def scheduler_for(service):
+    """
+    Returns the RequestScheduler for a Gmail service object, creating
+    one with the default settings if use_scheduler() wasn't called for it.
+    Each account has its own service, and so its own quota.
+    """
+    with _schedulers_lock:
+        try:
+            return _schedulers[service]
+        except KeyError:
+            scheduler = _schedulers[service] = RequestScheduler()
+            return scheduler
+
+
+def use_scheduler(service, scheduler):
+    """
+    Sets the RequestScheduler used for requests made with the given service.
+    """
+    with _schedulers_lock:
+        _schedulers[service] = scheduler
+    return scheduler
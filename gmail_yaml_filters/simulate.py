@@ -0,0 +1,655 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import print_function, unicode_literals
+
+import email
+import email.errors
+import email.header
+import email.policy
+import email.utils
+import mmap
+import os
+import re
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+from .query import And, Not, Or, Term, criteria_query, rule_criteria
+
+"""
+Works out which messages in a local mbox file or Maildir each rule would
+match, without talking to Gmail, by evaluating the rules' criteria against
+the messages' headers (and bodies, only if a rule searches them).
+
+Matching is an approximation of Gmail's: words match whole words or
+addresses, case-insensitively, and operators which depend on the state
+of the mailbox (like `is:unread` or `label:`) never match.
+"""
+
+
+#: Headers searched by each operator
+OPERATOR_HEADERS = {
+    "from": ("from",),
+    "to": ("to", "cc", "bcc"),
+    "cc": ("cc",),
+    "bcc": ("bcc",),
+    "subject": ("subject",),
+    "list": ("list-id",),
+    "deliveredto": ("delivered-to",),
+    "rfc822msgid": ("message-id",),
+    "after": ("date",),
+    "before": ("date",),
+    "older": ("date",),
+    "newer": ("date",),
+    "older_than": ("date",),
+    "newer_than": ("date",),
+}
+
+#: Headers searched by words without an operator, besides the body
+TEXT_HEADERS = ("subject", "from", "to", "cc")
+
+#: Operators which depend on a message's body or attachments
+BODY_OPERATORS = frozenset(["has", "filename"])
+
+#: Operators which depend on things a mail file doesn't record, so never match
+UNSUPPORTED_OPERATORS = frozenset(["in", "is", "label", "category", "around"])
+
+#: What each has: value looks for in a message's body
+HAS_LINKS = {
+    "drive": "drive.google.com",
+    "document": "docs.google.com/document",
+    "spreadsheet": "docs.google.com/spreadsheets",
+    "presentation": "docs.google.com/presentation",
+    "youtube": "youtube.com",
+}
+
+#: Operators whose terms are indexed by the tokens of the headers they search
+INDEXED_OPERATORS = frozenset(
+    ["from", "to", "cc", "bcc", "subject", "list", "deliveredto", "rfc822msgid"]
+)
+
+_TOKEN = re.compile(r"\w+")
+_SIZE_UNITS = {"": 1, "k": 1024, "m": 1024**2, "g": 1024**3}
+_AGE_UNITS = {"d": 1, "m": 30, "y": 365}
+
+
+class Message(object):
+    """
+    The parts of a message that rules need: some of its headers (with names
+    and values in lower case), its size, and optionally its text and the
+    names of its attachments.
+    """
+
+    __slots__ = ("headers", "size", "body", "attachments")
+
+    def __init__(self, headers, size, body="", attachments=()):
+        self.headers = headers
+        self.size = size
+        self.body = body
+        self.attachments = attachments
+
+
+def _decode_header(value):
+    if "=?" in value:
+        try:
+            value = str(email.header.make_header(email.header.decode_header(value)))
+        except (LookupError, ValueError, email.errors.HeaderParseError):
+            pass
+    return value
+
+
+def parse_headers(data, names):
+    """
+    Returns {name: value} for just the given (lower case) header names in a
+    block of raw headers, joining folded lines and repeated headers.
+
+    >>> parse_headers(b'From: Alice <a@x>\\nSubject: hello\\n  world\\nTo: b@x\\n', {'subject'})
+    {'subject': 'hello world'}
+    """
+    headers = {}
+    current = None
+    for line in data.decode("utf-8", "replace").splitlines():
+        if line[:1] in (" ", "\t"):
+            if current is not None:
+                headers[current] += " " + line.strip()
+            continue
+        name, colon, value = line.partition(":")
+        name = name.strip().lower()
+        if colon and name in names:
+            if name in headers:
+                headers[name] += ", " + value.strip()
+            else:
+                headers[name] = value.strip()
+            current = name
+        else:
+            current = None
+    return {name: _decode_header(value).lower() for name, value in headers.items()}
+
+
+def _body_and_attachments(data):
+    message = email.message_from_bytes(data, policy=email.policy.compat32)
+    texts = []
+    attachments = []
+    for part in message.walk():
+        if part.is_multipart():
+            continue
+        filename = part.get_filename()
+        if filename or part.get_content_disposition() == "attachment":
+            attachments.append((filename or "").lower())
+        elif part.get_content_maintype() == "text":
+            payload = part.get_payload(decode=True) or b""
+            charset = part.get_content_charset() or "utf-8"
+            try:
+                texts.append(payload.decode(charset, "replace"))
+            except LookupError:
+                texts.append(payload.decode("utf-8", "replace"))
+    return "\n".join(texts).lower(), tuple(attachments)
+
+
+def parse_message(data, needs, start=0, end=None):
+    """
+    Returns a Message from the raw bytes of a message (or the part of
+    data between start and end, such as a message in a memory-mapped mbox),
+    parsing only the headers in needs.headers, and only reading the body
+    if needs.body.
+    """
+    end = len(data) if end is None else end
+    headers_end = data.find(b"\n\n", start, end)
+    if headers_end == -1:
+        headers_end = end
+    # a CRLF blank line, if the message uses them, comes first
+    crlf_end = data.find(b"\r\n\r\n", start, headers_end)
+    if crlf_end != -1:
+        headers_end = crlf_end
+    message = Message(
+        parse_headers(data[start:headers_end], needs.headers), end - start
+    )
+    if needs.body:
+        message.body, message.attachments = _body_and_attachments(data[start:end])
+    return message
+
+
+class Needs(object):
+    """Which headers, and whether the body, are needed to evaluate some queries."""
+
+    def __init__(self, headers=(), body=False):
+        self.headers = frozenset(headers)
+        self.body = body
+
+    @classmethod
+    def of(cls, queries):
+        headers = set()
+        body = False
+        for term in _terms(queries):
+            if term.operator is None:
+                headers.update(TEXT_HEADERS)
+                body = True
+            elif term.operator in BODY_OPERATORS:
+                body = True
+            else:
+                headers.update(OPERATOR_HEADERS.get(term.operator, ()))
+        return cls(headers, body)
+
+
+def _terms(nodes):
+    stack = list(nodes)
+    while stack:
+        node = stack.pop()
+        if isinstance(node, Term):
+            yield node
+        elif isinstance(node, Not):
+            stack.append(node.operand)
+        else:
+            stack.extend(node.operands)
+
+
+def is_supported(query):
+    """
+    Returns False if the query uses operators which can't be evaluated
+    against a mail file, so its matches are only approximate.
+    """
+    return not any(term.operator in UNSUPPORTED_OPERATORS for term in _terms([query]))
+
+
+def _word_pattern(value):
+    words = [re.escape(word) for word in value.lower().split()]
+    if not words:
+        return None
+    return re.compile(r"(?<!\w)" + r"\s+".join(words) + r"(?!\w)")
+
+
+def parse_size(value):
+    """
+    Returns the number of bytes in a size like `10M`, or None.
+
+    >>> parse_size('10M'), parse_size('1kb'), parse_size('big')
+    (10485760, 1024, None)
+    """
+    match = re.match(r"^(\d+)\s*([kmg]?)b?$", value.strip().lower())
+    if not match:
+        return None
+    return int(match.group(1)) * _SIZE_UNITS[match.group(2)]
+
+
+def parse_date(value):
+    """Returns the (UTC) datetime of a date like `2024/05/01`, or None."""
+    value = value.strip()
+    if value.isdigit():
+        return datetime.fromtimestamp(int(value), timezone.utc)
+    for fmt in ("%Y/%m/%d", "%Y-%m-%d", "%m/%d/%Y"):
+        try:
+            return datetime.strptime(value, fmt).replace(tzinfo=timezone.utc)
+        except ValueError:
+            pass
+    return None
+
+
+def parse_age(value, now):
+    """Returns the datetime an age like `2d` or `1y` before now, or None."""
+    match = re.match(r"^(\d+)([dmy])$", value.strip().lower())
+    if not match:
+        return None
+    return now - timedelta(days=int(match.group(1)) * _AGE_UNITS[match.group(2)])
+
+
+def message_date(message):
+    """Returns the datetime in a message's Date header, or None."""
+    try:
+        date = email.utils.parsedate_to_datetime(message.headers["date"])
+    except (KeyError, TypeError, ValueError, IndexError):
+        return None
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return date
+
+
+def _never(message):
+    return False
+
+
+def _compile_term(term, now):
+    operator = term.operator
+    value = term.value
+    if operator in UNSUPPORTED_OPERATORS:
+        return _never
+
+    if operator in ("larger", "size", "smaller"):
+        size = parse_size(value)
+        if size is None:
+            return _never
+        if operator == "smaller":
+            return lambda message: message.size < size
+        return lambda message: message.size > size
+
+    if operator in ("after", "before", "older", "newer", "older_than", "newer_than"):
+        if operator.endswith("_than"):
+            cutoff = parse_age(value, now)
+        else:
+            cutoff = parse_date(value)
+        if cutoff is None:
+            return _never
+        later = operator in ("after", "newer", "newer_than")
+
+        def dated(message):
+            date = message_date(message)
+            if date is None:
+                return False
+            return date >= cutoff if later else date < cutoff
+
+        return dated
+
+    if operator == "has":
+        value = value.lower()
+        if value == "attachment":
+            return lambda message: bool(message.attachments)
+        link = HAS_LINKS.get(value)
+        if link is None:
+            return _never
+        return lambda message: link in message.body
+
+    pattern = _word_pattern(value)
+    if pattern is None:
+        return _never
+    search = pattern.search
+
+    if operator == "filename":
+        return lambda message: any(search(name) for name in message.attachments)
+
+    if operator is None:
+        headers = TEXT_HEADERS
+
+        def anywhere(message):
+            return bool(search(message.body)) or any(
+                search(message.headers.get(name, "")) for name in headers
+            )
+
+        return anywhere
+
+    headers = OPERATOR_HEADERS.get(operator, ())
+    # most messages don't contain the first word at all, and `in` is much
+    # cheaper than the regular expression, so check that first
+    needle = value.lower().split()[0]
+
+    if len(headers) == 1:
+        (name,) = headers
+
+        def in_header(message):
+            text = message.headers.get(name)
+            return text is not None and needle in text and bool(search(text))
+
+        return in_header
+
+    def in_headers(message):
+        for name in headers:
+            text = message.headers.get(name)
+            if text is not None and needle in text and search(text):
+                return True
+        return False
+
+    return in_headers
+
+
+def compile_query(node, now=None):
+    """
+    Returns a function which takes a Message and returns True if the
+    query matches it.
+    """
+    now = now or datetime.now(timezone.utc)
+    if isinstance(node, Term):
+        return _compile_term(node, now)
+    if isinstance(node, Not):
+        operand = compile_query(node.operand, now)
+        return lambda message: not operand(message)
+    operands = [compile_query(operand, now) for operand in node.operands]
+    if len(operands) == 1:
+        return operands[0]
+    if isinstance(node, Or):
+        return lambda message: any(operand(message) for operand in operands)
+    assert isinstance(node, And)
+    return lambda message: all(operand(message) for operand in operands)
+
+
+def _guard(node):
+    """
+    Returns a set of (field, token) keys, at least one of which a message
+    must contain for node to match it, or None if there's no such set (as
+    for a negation). A field is a header name, or "*" for any header in
+    TEXT_HEADERS or the body.
+
+    >>> sorted(_guard(criteria_query({'from': '(alice OR bob@example.com)'})))
+    [('from', 'alice'), ('from', 'example')]
+    """
+    if isinstance(node, Term):
+        if node.operator in UNSUPPORTED_OPERATORS:
+            return frozenset()  # never matches
+        if node.operator is None:
+            fields = ("*",)
+        elif node.operator in INDEXED_OPERATORS:
+            fields = OPERATOR_HEADERS[node.operator]
+        else:
+            return None
+        # a word matches whole words, so each of its tokens must be one of
+        # the message's; the longest is likely the least common
+        tokens = _TOKEN.findall(node.value.lower())
+        if not tokens:
+            return None
+        token = max(tokens, key=len)
+        return frozenset((field, token) for field in fields)
+    if isinstance(node, Not):
+        return None
+    guards = [_guard(operand) for operand in node.operands]
+    if isinstance(node, Or):
+        if any(guard is None for guard in guards):
+            return None
+        return frozenset().union(*guards)
+    # every operand of an And must match, so any of their guards will do
+    guards = [guard for guard in guards if guard is not None]
+    if not guards:
+        return None
+    # prefer fewer keys, then longer tokens
+    return min(
+        guards,
+        key=lambda guard: (len(guard), -min((len(t) for _, t in guard), default=0)),
+    )
+
+
+class RuleIndex(object):
+    """
+    An inverted index of queries by the tokens which messages must contain
+    for them to match, so that each message is only tested against the
+    queries it could match, rather than all of them.
+    """
+
+    def __init__(self, queries, now=None):
+        self.matchers = [compile_query(query, now) for query in queries]
+        #: queries which have to be tested against every message
+        self.unindexed = []
+        #: {field: {token: [query index, ...]}}
+        self.postings = {}
+        for index, query in enumerate(queries):
+            guard = _guard(query)
+            if guard is None:
+                self.unindexed.append(index)
+                continue
+            for field, token in guard:
+                self.postings.setdefault(field, {}).setdefault(token, []).append(index)
+
+    def candidates(self, message):
+        """Returns the indexes of the queries which might match message."""
+        candidates = set(self.unindexed)
+        for field, tokens in self.postings.items():
+            if field == "*":
+                texts = [message.body] + [
+                    message.headers.get(name, "") for name in TEXT_HEADERS
+                ]
+                text = "\n".join(texts)
+            else:
+                text = message.headers.get(field)
+                if not text:
+                    continue
+            for token in set(_TOKEN.findall(text)):
+                indexes = tokens.get(token)
+                if indexes:
+                    candidates.update(indexes)
+        return candidates
+
+    def matches(self, message):
+        """Returns the indexes of the queries which match message."""
+        matchers = self.matchers
+        return [index for index in self.candidates(message) if matchers[index](message)]
+
+    def match_all(self, message):
+        """
+        Returns the indexes of the queries which match message, testing
+        every one of them; the result is the same as matches().
+        """
+        return [
+            index for index, matcher in enumerate(self.matchers) if matcher(message)
+        ]
+
+
+def iter_mbox(data, start=0, end=None):
+    """
+    Yields the (start, end) offsets of each message in an mbox (or a memory
+    map of one) whose "From " line is between the offsets start and end,
+    not including that line. start must be at the start of a "From " line.
+
+    >>> mbox = b"From a\\nSubject: one\\n\\nhi\\nFrom b\\nSubject: two\\n\\n"
+    >>> [mbox[start:end] for start, end in iter_mbox(mbox)]
+    [b'Subject: one\\n\\nhi\\n', b'Subject: two\\n\\n']
+    """
+    end = len(data) if end is None else end
+    position = start
+    while position < end:
+        next_message = data.find(b"\nFrom ", position)
+        message_end = len(data) if next_message == -1 else next_message + 1
+        if data[position : position + 5] == b"From ":
+            line_end = data.find(b"\n", position, message_end)
+            yield (message_end if line_end == -1 else line_end + 1), message_end
+        else:  # text before the first "From " line
+            yield position, message_end
+        position = message_end
+
+
+def _mbox_shards(path, count):
+    """
+    Splits an mbox file into about count (path, start, end) byte ranges,
+    each starting at a "From " line.
+    """
+    size = os.path.getsize(path)
+    if size == 0:
+        return []
+    with open(path, "rb") as inputf:
+        with mmap.mmap(inputf.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            offsets = [0]
+            for n in range(1, count):
+                found = data.find(b"\nFrom ", max(offsets[-1], size * n // count))
+                if found == -1:
+                    break
+                if found + 1 > offsets[-1]:
+                    offsets.append(found + 1)
+    offsets.append(size)
+    return [
+        ("mbox", path, start, end)
+        for start, end in zip(offsets, offsets[1:])
+        if start < end
+    ]
+
+
+def _maildir_shards(path, count):
+    filenames = []
+    for subdir in ("cur", "new"):
+        directory = os.path.join(path, subdir)
+        if os.path.isdir(directory):
+            filenames.extend(
+                os.path.join(directory, name)
+                for name in sorted(os.listdir(directory))
+                if not name.startswith(".")
+            )
+    size = max(1, -(-len(filenames) // max(1, count)))
+    return [
+        ("maildir", filenames[start : start + size], None, None)
+        for start in range(0, len(filenames), size)
+    ]
+
+
+def _iter_shard(shard):
+    """
+    Yields (data, start, end) for each message in a shard.
+    """
+    kind, path, start, end = shard
+    if kind == "mbox":
+        with open(path, "rb") as inputf:
+            with mmap.mmap(inputf.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                for message_start, message_end in iter_mbox(data, start, end):
+                    yield data, message_start, message_end
+    else:
+        for filename in path:
+            with open(filename, "rb") as inputf:
+                data = inputf.read()
+            yield data, 0, len(data)
+
+
+def iter_messages(path, needs):
+    """
+    Yields each message in an mbox file or Maildir as a Message, with the
+    parts of it in needs.
+    """
+    for shard in shards_for(path, 1):
+        for data, start, end in _iter_shard(shard):
+            yield parse_message(data, needs, start, end)
+
+
+def _scan_shard(shard, queries, now):
+    """
+    Returns (messages scanned, matches for each query) for one shard.
+    """
+    needs = Needs.of(queries)
+    index = RuleIndex(queries, now)
+    counts = [0] * len(queries)
+    messages = 0
+    for data, start, end in _iter_shard(shard):
+        message = parse_message(data, needs, start, end)
+        messages += 1
+        for matched in index.matches(message):
+            counts[matched] += 1
+    return messages, counts
+
+
+def shards_for(path, count):
+    """
+    Returns the shards which a mailbox is scanned in: byte ranges of an
+    mbox file, or lists of files in a Maildir.
+    """
+    if os.path.isdir(path):
+        if not any(os.path.isdir(os.path.join(path, d)) for d in ("cur", "new")):
+            raise ValueError("{0} is not a Maildir".format(path))
+        return _maildir_shards(path, count)
+    return _mbox_shards(path, count)
+
+
+class Simulation(object):
+    """
+    How many of the messages in a mailbox each rule matched.
+    """
+
+    def __init__(self, rules, counts, messages, seconds=0.0):
+        self.rules = list(rules)
+        self.counts = list(counts)
+        self.messages = messages
+        self.seconds = seconds
+
+    def report(self, file=None):
+        file = file or sys.stdout
+        for rule, count in zip(self.rules, self.counts):
+            criteria = rule_criteria(rule)
+            approximate = not is_supported(criteria_query(criteria))
+            print(
+                "{0:>10}{1}  {2}".format(
+                    count,
+                    "~" if approximate else " ",
+                    " ".join(
+                        "{0}:{1}".format(key, value)
+                        for key, value in sorted(criteria.items())
+                    ),
+                ),
+                file=file,
+            )
+        print(
+            "Scanned {0} messages in {1:.1f}s".format(self.messages, self.seconds),
+            file=file,
+        )
+
+
+def simulate(ruleset, path, jobs=1, now=None):
+    """
+    Counts the messages in an mbox file or Maildir which each publishable
+    rule in the ruleset would match, scanning it in `jobs` processes.
+    Returns a Simulation.
+    """
+    started = time.perf_counter()
+    now = now or datetime.now(timezone.utc)
+    rules = [rule for rule in ruleset if rule.publishable]
+    queries = [criteria_query(rule_criteria(rule)) for rule in rules]
+    # a few shards per process, so that one slow shard doesn't hold up the rest
+    shards = shards_for(path, jobs * 4 if jobs > 1 else 1)
+
+    messages = 0
+    counts = [0] * len(queries)
+    if jobs > 1 and len(shards) > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            results = list(
+                executor.map(
+                    _scan_shard,
+                    shards,
+                    [queries] * len(shards),
+                    [now] * len(shards),
+                )
+            )
+    else:
+        results = [_scan_shard(shard, queries, now) for shard in shards]
+    for shard_messages, shard_counts in results:
+        messages += shard_messages
+        counts = [total + count for total, count in zip(counts, shard_counts)]
+    return Simulation(rules, counts, messages, time.perf_counter() - started)
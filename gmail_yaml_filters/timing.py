@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+
+import sys
+import threading
+import tracemalloc
+from collections import OrderedDict
+from contextlib import contextmanager
+from time import perf_counter
+
+try:
+    from contextlib import nullcontext
+except ImportError:  # Python 3.6
+
+    @contextmanager
+    def nullcontext():
+        yield
+
+
+"""
+Collects wall time, call counts and peak memory for each phase of a run
+(loading YAML, building rules, talking to the Gmail API, etc.)
+
+Code which wants to be measured wraps itself in phase(); this costs almost
+nothing unless a collector is active (see collect()).
+"""
+
+
+class PhaseStats(object):
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        #: Time spent in this phase, excluding any phases nested inside it
+        self.seconds = 0.0
+        #: Highest traced memory seen while in this phase (None if not tracing)
+        self.peak_bytes = None
+
+    def __repr__(self):
+        return "{0}({1!r}, calls={2}, seconds={3:.6f}, peak_bytes={4})".format(
+            self.__class__.__name__,
+            self.name,
+            self.calls,
+            self.seconds,
+            self.peak_bytes,
+        )
+
+    def as_dict(self):
+        return {
+            "calls": self.calls,
+            "seconds": self.seconds,
+            "peak_bytes": self.peak_bytes,
+        }
+
+
+class _Frame(object):
+    def __init__(self, stats, started):
+        self.stats = stats
+        self.started = started
+        self.peak = 0
+
+
+class Timings(object):
+    """
+    Accumulates PhaseStats by name. Time spent in a nested phase is only
+    counted towards the innermost phase, so the times of all phases add up
+    to the total. Memory is traced with tracemalloc if trace_memory is True,
+    which makes everything quite a bit slower.
+    """
+
+    def __init__(self, trace_memory=False):
+        self.phases = OrderedDict()
+        self.trace_memory = trace_memory
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @property
+    def _stack(self):
+        try:
+            return self._local.stack
+        except AttributeError:
+            self._local.stack = []
+            return self._local.stack
+
+    def _stats(self, name):
+        with self._lock:
+            try:
+                return self.phases[name]
+            except KeyError:
+                stats = self.phases[name] = PhaseStats(name)
+                return stats
+
+    def _traced_peak(self):
+        if not (self.trace_memory and tracemalloc.is_tracing()):
+            return 0
+        return tracemalloc.get_traced_memory()[1]
+
+    def _reset_peak(self):
+        # tracemalloc.reset_peak() was added in Python 3.9
+        if self.trace_memory and hasattr(tracemalloc, "reset_peak"):
+            tracemalloc.reset_peak()
+
+    @contextmanager
+    def phase(self, name):
+        stats = self._stats(name)
+        stack = self._stack
+        now = perf_counter()
+        if stack:
+            parent = stack[-1]
+            parent.stats.seconds += now - parent.started
+            parent.peak = max(parent.peak, self._traced_peak())
+        self._reset_peak()
+        frame = _Frame(stats, now)
+        stack.append(frame)
+        try:
+            yield stats
+        finally:
+            now = perf_counter()
+            stack.pop()
+            peak = max(frame.peak, self._traced_peak())
+            with self._lock:
+                stats.calls += 1
+                stats.seconds += now - frame.started
+                if self.trace_memory:
+                    stats.peak_bytes = max(stats.peak_bytes or 0, peak)
+            if stack:
+                stack[-1].started = now
+                stack[-1].peak = max(stack[-1].peak, peak)
+
+    def as_dict(self):
+        return {name: stats.as_dict() for name, stats in self.phases.items()}
+
+    def report(self, file=None):
+        file = file or sys.stderr
+        print(
+            "{0:<20} {1:>8} {2:>10} {3:>12}".format(
+                "phase", "calls", "seconds", "peak KiB"
+            ),
+            file=file,
+        )
+        for stats in self.phases.values():
+            print(
+                "{0:<20} {1:>8} {2:>10.3f} {3:>12}".format(
+                    stats.name,
+                    stats.calls,
+                    stats.seconds,
+                    "-" if stats.peak_bytes is None else stats.peak_bytes // 1024,
+                ),
+                file=file,
+            )
+
+
+_active = None
+
+
+@contextmanager
+def collect(timings=None, trace_memory=False):
+    """
+    Records phases run inside this block (in any thread) into a Timings
+    instance, which is created if not given, and yields it.
+
+    >>> with collect() as timings:
+    ...     with phase("example"):
+    ...         pass
+    >>> timings.phases["example"].calls
+    1
+    """
+    global _active
+    timings = timings or Timings(trace_memory=trace_memory)
+    previous = _active
+    started_tracing = timings.trace_memory and not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    _active = timings
+    try:
+        yield timings
+    finally:
+        _active = previous
+        if started_tracing:
+            tracemalloc.stop()
+
+
+def phase(name):
+    """
+    Returns a context manager which records time spent inside it
+    under the given name, if a collector is active.
+    """
+    if _active is None:
+        return nullcontext()
+    return _active.phase(name)
+
+
+def timed_iter(name, iterable):
+    """
+    Yields from iterable, recording the time spent producing each item
+    under the given name.
+    """
+    iterator = iter(iterable)
+    while True:
+        with phase(name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
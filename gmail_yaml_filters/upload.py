@@ -3,9 +3,12 @@
 from __future__ import print_function
 
 import argparse
+import asyncio
 import os
 import sys
+import threading
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from operator import itemgetter
 
 import apiclient.discovery
@@ -15,6 +18,9 @@ import oauth2client.client
 import oauth2client.file
 import oauth2client.tools
 
+from .scheduler import scheduler_for
+from .timing import phase
+
 """
 Pushes auto-generated mail filters to the Gmail API.
 """
@@ -63,6 +69,85 @@ def _rule_to_actions(rule):
     return result
 
 
+#: Gmail accepts up to 100 requests in one batch, but recommends no more than 50.
+#: See https://developers.google.com/gmail/api/guides/batch
+DEFAULT_BATCH_SIZE = 50
+
+
+class RequestBatcher(object):
+    """
+    Collects Gmail API requests and executes them in batch HTTP requests of up
+    to batch_size at a time (or one at a time, if batch_size is 1).
+
+    If a request fails, on_error is called with its description and the
+    exception. If on_error is not given, the exception is raised instead;
+    for a batch, that happens once the whole batch has been executed, and
+    every failure in it is printed to file (by default, sys.stderr) first.
+    """
+
+    def __init__(
+        self, service, batch_size=1, on_error=None, phase_name="request", file=None
+    ):
+        self.service = service
+        self.batch_size = max(1, batch_size)
+        self.on_error = on_error
+        self.phase_name = phase_name
+        self.file = file
+        self._queue = []
+
+    def add(self, request, description=None, on_success=None):
+        """
+        Queues a request. If it succeeds, on_success is called with the response.
+        """
+        self._queue.append((request, description, on_success))
+        if len(self._queue) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        queue, self._queue = self._queue, []
+        if not queue:
+            return
+        with phase(self.phase_name):
+            if self.batch_size == 1:
+                for item in queue:
+                    self._execute_one(*item)
+            else:
+                self._execute_batch(queue)
+
+    def _execute_one(self, request, description, on_success):
+        try:
+            response = scheduler_for(self.service).execute(request, self.service)
+        except googleapiclient.errors.HttpError as exc:
+            self._failed(description, exc)
+        else:
+            if on_success:
+                on_success(response)
+
+    def _execute_batch(self, queue):
+        errors = []
+        results = scheduler_for(self.service).execute_batch(
+            self.service, [request for request, _, _ in queue]
+        )
+        for (_, description, on_success), (response, exception) in zip(queue, results):
+            if exception is not None:
+                errors.append((description, exception))
+            elif on_success:
+                on_success(response)
+
+        for description, exception in errors:
+            if self.on_error:
+                self.on_error(description, exception)
+        if errors and not self.on_error:
+            for description, exception in errors:
+                print("Failed:", description, exception, file=self.file or sys.stderr)
+            raise errors[0][1]
+
+    def _failed(self, description, exception):
+        if not self.on_error:
+            raise exception
+        self.on_error(description, exception)
+
+
 def fake_label(name):
     return {
         "id": "FakeLabel_{}".format(name.replace(" ", "-")),
@@ -84,13 +169,22 @@ class GmailLabels(object):
     See https://developers.google.com/gmail/api/v1/reference/users/labels
     """
 
-    def __init__(self, gmail, dry_run=False):
+    def __init__(self, gmail, dry_run=False, cache=None):
         self.gmail = gmail
         self.dry_run = dry_run
+        self.cache = cache
         self.reload()
 
     def reload(self):
-        self.labels = self.gmail.users().labels().list(userId="me").execute()["labels"]
+        cached = self.cache.get("labels") if self.cache else None
+        if cached is not None:
+            self.labels = list(cached)
+        else:
+            with phase("list labels"):
+                request = self.gmail.users().labels().list(userId="me")
+                self.labels = scheduler_for(self.gmail).execute(request)["labels"]
+            if self.cache:
+                self.cache.put("labels", self.labels)
         self.by_lower_name = {label["name"].lower(): label for label in self.labels}
 
     def __iter__(self):
@@ -126,53 +220,81 @@ class GmailLabels(object):
             request = (
                 self.gmail.users().labels().create(userId="me", body={"name": name})
             )
-            created = request.execute()
+            with phase("create label"):
+                created = scheduler_for(self.gmail).execute(request, self.gmail)
+            if self.cache:
+                self.cache.add("labels", created)
             self[name] = created
             return self[name]
 
 
-def _simplify_filter(filter_dict):
-    return {
-        "criteria": filter_dict["criteria"],
-        "action": {
-            key: set(values) for key, values in filter_dict.get("action", {}).items()
-        },
-    }
+def filter_key(filter_dict):
+    """
+    Returns a hashable key which is the same for any two filters with the same
+    criteria and actions, regardless of the order of their label ids.
+
+    >>> one = {"criteria": {"from": "alice"}, "action": {"addLabelIds": ["a", "b"]}}
+    >>> two = {"criteria": {"from": "alice"}, "action": {"addLabelIds": ["b", "a"]}}
+    >>> filter_key(one) == filter_key(two)
+    True
+    """
+    return (
+        frozenset(filter_dict["criteria"].items()),
+        frozenset(
+            (key, values if isinstance(values, str) else frozenset(values))
+            for key, values in filter_dict.get("action", {}).items()
+        ),
+    )
 
 
 class GmailFilters(object):
-    def __init__(self, gmail):
+    def __init__(self, gmail, cache=None):
         self.gmail = gmail
+        self.cache = cache
         self.reload()
 
     def reload(self):
-        self.filters = (
-            self.gmail.users()
-            .settings()
-            .filters()
-            .list(userId="me")
-            .execute()
-            .get("filter", [])
-        )
-        self.matchable_filters = [
-            _simplify_filter(existing) for existing in self.filters
-        ]
+        cached = self.cache.get("filters") if self.cache else None
+        if cached is not None:
+            self.filters = list(cached)
+        else:
+            with phase("list filters"):
+                request = self.gmail.users().settings().filters().list(userId="me")
+                self.filters = (
+                    scheduler_for(self.gmail).execute(request).get("filter", [])
+                )
+            if self.cache:
+                self.cache.put("filters", self.filters)
+        self.keys = [filter_key(existing) for existing in self.filters]
+        self.index = set(self.keys)
+
+    def add(self, filter_dict):
+        """
+        Records a filter which has been (or is about to be) created.
+        """
+        key = filter_key(filter_dict)
+        self.filters.append(filter_dict)
+        self.keys.append(key)
+        self.index.add(key)
 
     def exists(self, other):
-        return _simplify_filter(other) in iter(
-            _simplify_filter(f) for f in self.filters
-        )
+        return filter_key(other) in self.index
 
     def prunable(self, filter_dicts):
-        matchable = [_simplify_filter(filter_dict) for filter_dict in filter_dicts]
+        keep = set(filter_key(filter_dict) for filter_dict in filter_dicts)
         return [
             prunable
-            for prunable in self.filters
-            if _simplify_filter(prunable) not in matchable
+            for (prunable, key) in zip(self.filters, self.keys)
+            if key not in keep
         ]
 
 
 def rule_to_resource(rule, labels):
+    with phase("resolve labels"):
+        return _rule_to_resource(rule, labels)
+
+
+def _rule_to_resource(rule, labels):
     actions = _rule_to_actions(rule)
 
     for key in ("addLabelIds", "removeLabelIds"):
@@ -187,65 +309,317 @@ def rule_to_resource(rule, labels):
     }
 
 
-def upload_ruleset(ruleset, service=None, dry_run=False):
+#: How many HTTP requests the command line has in flight at once by default
+DEFAULT_CONCURRENCY = 4
+
+
+def _running_loop():
+    """Returns the event loop running in this thread, if there is one."""
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        return None
+    except AttributeError:  # Python 3.6
+        return asyncio._get_running_loop()
+
+
+def _run_in_new_loop(coroutine):
+    """Runs a coroutine to completion in a new event loop, like asyncio.run()."""
+    if hasattr(asyncio, "run"):
+        return asyncio.run(coroutine)
+    loop = asyncio.new_event_loop()  # Python 3.6
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+class RequestQueue(object):
+    """
+    Executes Gmail API requests on behalf of coroutines, in a pool of threads,
+    with at most `concurrency` HTTP requests in flight at once. Requests which
+    are waiting at the same time are sent together in batch HTTP requests of
+    up to batch_size (timed under the phase name of the first one).
+
+    httplib2 isn't thread-safe, so when concurrency is more than one,
+    http_factory is required; it should return a new authorized
+    httplib2.Http, and each thread calls it once and uses the result for all
+    of its requests.
+    """
+
+    def __init__(self, service, concurrency=1, batch_size=1, http_factory=None):
+        if concurrency > 1 and http_factory is None:
+            raise ValueError(
+                "concurrency of more than one needs an http_factory, since "
+                "threads can't share an httplib2.Http"
+            )
+        self.service = service
+        self.concurrency = max(1, concurrency)
+        self.batch_size = max(1, batch_size)
+        self.http_factory = http_factory
+        self._local = threading.local()
+        self._queue = None
+        self._executor = None
+
+    def run(self, coroutine):
+        """
+        Runs the coroutine (which may call execute()) to completion in a new
+        event loop and returns its result. If this thread is already running
+        an event loop, the new one runs in another thread while this one
+        waits; coroutines should await the *_async functions instead.
+        """
+        if _running_loop() is None:
+            return _run_in_new_loop(self._run(coroutine))
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            return executor.submit(_run_in_new_loop, self._run(coroutine)).result()
+
+    async def _run(self, coroutine):
+        self._queue = asyncio.Queue()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as self._executor:
+            workers = [
+                asyncio.ensure_future(self._worker()) for _ in range(self.concurrency)
+            ]
+            try:
+                return await coroutine
+            finally:
+                for worker in workers:
+                    worker.cancel()
+                await asyncio.gather(*workers, return_exceptions=True)
+
+    async def execute(self, request, phase_name="request"):
+        """
+        Queues a request and returns its response once it has been executed.
+        """
+        future = asyncio.get_event_loop().create_future()
+        self._queue.put_nowait((request, phase_name, future))
+        return await future
+
+    async def _worker(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            items = [await self._queue.get()]
+            while len(items) < self.batch_size and not self._queue.empty():
+                items.append(self._queue.get_nowait())
+            results = await loop.run_in_executor(self._executor, self._execute, items)
+            for (_, _, future), (response, exception) in zip(items, results):
+                if future.cancelled():
+                    continue
+                if exception is not None:
+                    future.set_exception(exception)
+                else:
+                    future.set_result(response)
+
+    def _http(self):
+        if self.http_factory is None:
+            return None
+        try:
+            return self._local.http
+        except AttributeError:
+            self._local.http = self.http_factory()
+            return self._local.http
+
+    def _execute(self, items):
+        """
+        Executes requests in this thread and returns a (response, exception)
+        pair for each of them.
+        """
+        scheduler = scheduler_for(self.service)
+        with phase(items[0][1]):
+            http = self._http()
+            if len(items) == 1:
+                try:
+                    response = scheduler.execute(items[0][0], self.service, http=http)
+                    return [(response, None)]
+                except Exception as exc:
+                    return [(None, exc)]
+            try:
+                return scheduler.execute_batch(
+                    self.service, [request for request, _, _ in items], http=http
+                )
+            except Exception as exc:
+                return [(None, exc)] * len(items)
+
+
+def _raise_failures(outcomes, descriptions):
+    """
+    Prints each exception among the results of asyncio.gather(return_exceptions=True)
+    and raises the first one, if there were any.
+    """
+    failures = [
+        (description, outcome)
+        for description, outcome in zip(descriptions, outcomes)
+        if isinstance(outcome, BaseException)
+    ]
+    for description, exception in failures:
+        print("Failed:", description, exception, file=sys.stderr)
+    if failures:
+        raise failures[0][1]
+
+
+def upload_ruleset(
+    ruleset,
+    service=None,
+    dry_run=False,
+    batch_size=1,
+    cache=None,
+    concurrency=1,
+    http_factory=None,
+):
     service = service or get_gmail_service()
-    known_labels = GmailLabels(service, dry_run=dry_run)
-    known_filters = GmailFilters(service)
+    requests = RequestQueue(service, concurrency, batch_size, http_factory)
+    requests.run(upload_ruleset_async(ruleset, requests, dry_run=dry_run, cache=cache))
 
-    for rule in ruleset:
-        if not rule.publishable:
-            continue
+
+async def upload_ruleset_async(ruleset, requests, dry_run=False, cache=None):
+    """
+    Creates a filter for each publishable rule which doesn't exist yet,
+    creating any labels it needs first. Each filter waits only for its own
+    labels, so filters and labels are created concurrently (up to the
+    RequestQueue's concurrency). If any request fails, the rest carry on
+    and the first error is raised at the end.
+    """
+    service = requests.service
+    known_labels = GmailLabels(service, dry_run=dry_run, cache=cache)
+    known_filters = GmailFilters(service, cache=cache)
+    creating_labels = {}
+
+    async def create_label(name):
+        print("Creating label", name, file=sys.stderr)
+        if dry_run:
+            label = fake_label(name)
+        else:
+            request = service.users().labels().create(userId="me", body={"name": name})
+            label = await requests.execute(request, "create label")
+            if cache:
+                cache.add("labels", label)
+        known_labels[name] = label
+        return label["id"]
+
+    def label_id(name):
+        """Returns the label's id, or a task which creates it and returns its id."""
+        try:
+            return known_labels[name]["id"]
+        except KeyError:
+            pass
+        # match labels being created the same way as existing ones
+        for possible_name in known_labels._possible_names(name):
+            if possible_name in creating_labels:
+                return creating_labels[possible_name]
+        task = creating_labels[name.lower()] = asyncio.ensure_future(create_label(name))
+        return task
+
+    async def create_filter(rule):
+        actions = _rule_to_actions(rule)
+        for key in ("addLabelIds", "removeLabelIds"):
+            if key in actions:
+                # start creating any missing labels before waiting for one
+                pending = [label_id(name) for name in actions[key]]
+                label_ids = set()
+                for label in pending:
+                    if isinstance(label, asyncio.Future):
+                        label = await label
+                    label_ids.add(label)
+                actions[key] = list(label_ids)
 
         # See https://developers.google.com/gmail/api/v1/reference/users/settings/filters#resource
-        filter_data = rule_to_resource(rule, known_labels)
-
-        if not known_filters.exists(filter_data):
-            filter_data["action"] = dict(filter_data["action"])
-            filter_data["criteria"] = dict(filter_data["criteria"])
-            print(
-                "Creating",
-                filter_data["criteria"],
-                filter_data["action"],
-                file=sys.stderr,
-            )
-            # Strip out defaultdict and set; they won't be JSON-serializable
-            request = (
-                service.users()
-                .settings()
-                .filters()
-                .create(userId="me", body=filter_data)
-            )
-            if not dry_run:
-                request.execute()
+        filter_data = {
+            "criteria": _rule_conditions_to_dict(rule),
+            "action": dict(actions),
+        }
+        if known_filters.exists(filter_data):
+            return
+        known_filters.add(filter_data)
+        print(
+            "Creating", filter_data["criteria"], filter_data["action"], file=sys.stderr
+        )
+        if dry_run:
+            return
+        request = (
+            service.users().settings().filters().create(userId="me", body=filter_data)
+        )
+        created = await requests.execute(request, "create filter")
+        if cache:
+            cache.add("filters", created)
+
+    rules = [rule for rule in ruleset if rule.publishable]
+    outcomes = await asyncio.gather(
+        *(create_filter(rule) for rule in rules), return_exceptions=True
+    )
+    if cache:
+        cache.save()
+    _raise_failures(outcomes, rules)
 
 
-def find_filters_not_in_ruleset(ruleset, service, dry_run):
-    known_labels = GmailLabels(service, dry_run=dry_run)
-    known_filters = GmailFilters(service)
+def find_filters_not_in_ruleset(ruleset, service, dry_run, cache=None):
+    known_labels = GmailLabels(service, dry_run=dry_run, cache=cache)
+    known_filters = GmailFilters(service, cache=cache)
     ruleset_filters = [rule_to_resource(rule, known_labels) for rule in ruleset]
 
     for prunable_filter in known_filters.prunable(ruleset_filters):
         yield prunable_filter
 
 
-def prune_filters_not_in_ruleset(ruleset, service, dry_run=False):
-    prunable_filters = find_filters_not_in_ruleset(ruleset, service, dry_run)
-    for prunable_filter in prunable_filters:
+def prune_filters_not_in_ruleset(
+    ruleset,
+    service,
+    dry_run=False,
+    batch_size=1,
+    cache=None,
+    concurrency=1,
+    http_factory=None,
+):
+    requests = RequestQueue(service, concurrency, batch_size, http_factory)
+    requests.run(
+        prune_filters_not_in_ruleset_async(
+            ruleset, requests, dry_run=dry_run, cache=cache
+        )
+    )
+
+
+async def prune_filters_not_in_ruleset_async(
+    ruleset, requests, dry_run=False, cache=None
+):
+    """
+    Deletes every filter which isn't in the ruleset, concurrently.
+    """
+    service = requests.service
+    prunable_filters = list(
+        find_filters_not_in_ruleset(ruleset, service, dry_run, cache)
+    )
+
+    async def delete_filter(prunable_filter):
         print("Deleting", prunable_filter, file=sys.stderr)
+        if dry_run:
+            return
         request = (
             service.users()
             .settings()
             .filters()
             .delete(userId="me", id=prunable_filter["id"])
         )
-        if not dry_run:
-            request.execute()
+        await requests.execute(request, "delete filter")
+        if cache:
+            cache.remove("filters", prunable_filter["id"])
+
+    outcomes = await asyncio.gather(
+        *(delete_filter(prunable) for prunable in prunable_filters),
+        return_exceptions=True,
+    )
+    if cache:
+        cache.save()
+    _raise_failures(outcomes, prunable_filters)
 
 
 def prune_labels_not_in_ruleset(
-    ruleset, service, match=None, dry_run=False, continue_on_http_error=False
+    ruleset,
+    service,
+    match=None,
+    dry_run=False,
+    continue_on_http_error=False,
+    batch_size=1,
+    cache=None,
 ):
-    known_labels = GmailLabels(service, dry_run=dry_run)
+    known_labels = GmailLabels(service, dry_run=dry_run, cache=cache)
     ruleset_filters = [rule_to_resource(rule, known_labels) for rule in ruleset]
 
     used_label_ids = set(
@@ -257,12 +631,22 @@ def prune_labels_not_in_ruleset(
 
     unused_labels = [
         label
-        for label in GmailLabels(service, dry_run=dry_run)
+        for label in known_labels
         if label["id"] not in used_label_ids
         and label["type"] == "user"
         and (match is None or match(label["name"]))
     ]
 
+    def report_error(label_name, exception):
+        print("Failed to delete label", label_name, exception, file=sys.stderr)
+
+    batcher = RequestBatcher(
+        service,
+        batch_size,
+        on_error=(report_error if continue_on_http_error else None),
+        phase_name="delete label",
+    )
+
     for unused_label in sorted(unused_labels, key=itemgetter("name")):
         print(
             "Deleting label",
@@ -272,11 +656,22 @@ def prune_labels_not_in_ruleset(
         )
         request = service.users().labels().delete(userId="me", id=unused_label["id"])
         if not dry_run:
-            try:
-                request.execute()
-            except googleapiclient.errors.HttpError:
-                if not continue_on_http_error:
-                    raise
+            batcher.add(
+                request,
+                description=unused_label["name"],
+                on_success=_removed_from(cache, "labels", unused_label["id"]),
+            )
+
+    batcher.flush()
+    if cache:
+        cache.save()
+
+
+def _removed_from(cache, kind, item_id):
+    """Returns a callback which records that an item was deleted, if using a cache."""
+    if not cache:
+        return None
+    return lambda response: cache.remove(kind, item_id)
 
 
 def get_gmail_service(credentials):
@@ -284,6 +679,13 @@ def get_gmail_service(credentials):
     return apiclient.discovery.build("gmail", "v1", http=http)
 
 
+def http_factory(credentials):
+    """
+    Returns a function which makes a new authorized Http, for RequestQueue.
+    """
+    return lambda: credentials.authorize(httplib2.Http())
+
+
 def get_gmail_credentials(
     scopes=[
         "https://www.googleapis.com/auth/gmail.settings.basic",
@@ -294,6 +696,7 @@ def get_gmail_credentials(
     credential_store=os.path.join(
         os.path.expanduser("~"), ".credentials", "gmail_yaml_filters.json"
     ),
+    interactive=True,
 ):  # pragma: no cover
     if not os.path.exists(os.path.dirname(os.path.abspath(credential_store))):
         os.makedirs(os.path.dirname(os.path.abspath(credential_store)))
@@ -301,6 +704,8 @@ def get_gmail_credentials(
     store = oauth2client.file.Storage(os.path.abspath(credential_store))
     credentials = store.get()
     if not credentials or credentials.invalid:
+        if not interactive:
+            raise ValueError("No valid credentials in {0}".format(credential_store))
         flow = oauth2client.client.flow_from_clientsecrets(client_secret_path, scopes)
         flow.user_agent = application_name
         flags_parser = argparse.ArgumentParser(parents=[oauth2client.tools.argparser])
@@ -0,0 +1,131 @@
+"""
+An in-memory stand-in for the Gmail API service object returned by
+gmail_yaml_filters.upload.get_gmail_service, supporting just the calls
+that module makes. Unlike a MagicMock, it keeps state, so creating a label
+or filter makes it show up in later list() calls.
+"""
+
+import itertools
+import json
+
+import googleapiclient.errors
+
+
+class FakeRequest(object):
+    def __init__(self, method_id, func, body=None):
+        self.methodId = method_id
+        self._func = func
+        # like googleapiclient's HttpRequest, which holds the body as JSON
+        self.body = None if body is None else json.dumps(body)
+
+    def execute(self, http=None, num_retries=0):
+        return self._func()
+
+
+class FakeBatch(object):
+    def __init__(self, callback=None):
+        self._callback = callback
+        self._requests = []
+
+    def add(self, request, callback=None, request_id=None):
+        request_id = request_id or str(len(self._requests))
+        self._requests.append((request_id, request, callback or self._callback))
+
+    def execute(self, http=None):
+        for request_id, request, callback in self._requests:
+            try:
+                response, exception = request.execute(), None
+            except googleapiclient.errors.HttpError as exc:
+                response, exception = None, exc
+            if callback:
+                callback(request_id, response, exception)
+
+
+class _Resource(object):
+    """Stores dicts by id and hands out FakeRequests for list/create/delete."""
+
+    def __init__(self, service, name, list_key, items):
+        self.service = service
+        self.name = name
+        self.list_key = list_key
+        self.items = {}
+        for item in items:
+            self._store(dict(item))
+
+    def _store(self, body):
+        body.setdefault("id", "{0}_{1}".format(self.name, next(self.service.ids)))
+        self.items[body["id"]] = body
+        return body
+
+    def list(self, userId):
+        return FakeRequest(
+            "gmail.users.{0}.list".format(self.name),
+            lambda: {self.list_key: list(self.items.values())},
+        )
+
+    def create(self, userId, body):
+        return FakeRequest(
+            "gmail.users.{0}.create".format(self.name),
+            lambda: self._store(dict(body)),
+            body,
+        )
+
+    def delete(self, userId, id):
+        return FakeRequest(
+            "gmail.users.{0}.delete".format(self.name),
+            lambda: self.items.pop(id) and "",
+        )
+
+
+class _Settings(object):
+    def __init__(self, filters):
+        self._filters = filters
+
+    def filters(self):
+        return self._filters
+
+
+class _Users(object):
+    def __init__(self, labels, settings):
+        self._labels = labels
+        self._settings = settings
+
+    def labels(self):
+        return self._labels
+
+    def settings(self):
+        return self._settings
+
+
+SYSTEM_LABELS = ("INBOX", "UNREAD", "IMPORTANT", "STARRED", "TRASH", "SPAM")
+
+
+class FakeGmail(object):
+    def __init__(self, labels=(), filters=()):
+        self.ids = itertools.count(1)
+        self.labels = _Resource(
+            self,
+            "labels",
+            "labels",
+            [{"id": name, "name": name, "type": "system"} for name in SYSTEM_LABELS]
+            + list(labels),
+        )
+        self.filters = _Resource(self, "settings.filters", "filter", filters)
+        self._users = _Users(self.labels, _Settings(self.filters))
+
+    def users(self):
+        return self._users
+
+    def new_batch_http_request(self, callback=None):
+        return FakeBatch(callback=callback)
+
+
+def user_label(name):
+    return {"name": name, "type": "user"}
+
+
+def remote_filter(n):
+    return {
+        "criteria": {"from": "remote{0}@example.com".format(n)},
+        "action": {"addLabelIds": ["Label_remote"], "removeLabelIds": ["INBOX"]},
+    }
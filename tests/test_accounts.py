@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from io import StringIO
+
+import pytest
+from fake_gmail import FakeGmail, remote_filter
+
+from gmail_yaml_filters.accounts import (
+    Account,
+    build_account_rulesets,
+    load_manifest,
+    report,
+    sync_accounts,
+)
+from gmail_yaml_filters.main import create_parser, run_accounts
+from gmail_yaml_filters.ruleset import RuleSet
+
+
+@pytest.fixture
+def manifest(tmp_path):
+    (tmp_path / "common.yaml").write_text("- from: boss\n  star: true\n")
+    (tmp_path / "alice.yaml").write_text("- to: alice\n  archive: true\n")
+    path = tmp_path / "accounts.yaml"
+    path.write_text(
+        """
+        - name: alice
+          credential_store: alice.json
+          filters: [common.yaml, alice.yaml]
+        - credential_store: creds/bob.json
+          filters: common.yaml
+        """
+    )
+    return path
+
+
+def test_load_manifest(manifest, tmp_path):
+    assert load_manifest(str(manifest)) == [
+        Account(
+            "alice",
+            str(tmp_path / "alice.json"),
+            [str(tmp_path / "common.yaml"), str(tmp_path / "alice.yaml")],
+        ),
+        Account(
+            "bob", str(tmp_path / "creds" / "bob.json"), [str(tmp_path / "common.yaml")]
+        ),
+    ]
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "credential_store: alice.json",
+        "- filters: common.yaml",
+        "- credential_store: a/bob.json\n- credential_store: b/bob.json",
+    ],
+)
+def test_load_manifest_errors(tmp_path, text):
+    path = tmp_path / "accounts.yaml"
+    path.write_text(text)
+    with pytest.raises(ValueError):
+        load_manifest(str(path))
+
+
+def test_shared_files_built_once():
+    built = []
+
+    def build_file(filename):
+        built.append(filename)
+        return RuleSet.from_object([{"from": filename, "archive": True}])
+
+    accounts = [
+        Account("alice", "alice.json", ["common", "alice"]),
+        Account("bob", "bob.json", ["common"]),
+    ]
+    rulesets = build_account_rulesets(accounts, build_file)
+    assert built == ["common", "alice"]
+    assert len(rulesets["alice"]) == 2
+    assert len(rulesets["bob"]) == 1
+
+
+def test_sync_accounts():
+    accounts = [Account(name, name, []) for name in ("alice", "bob", "carol")]
+    services = {
+        "alice": FakeGmail(filters=[remote_filter(1)]),
+        "bob": FakeGmail(),
+    }
+    ruleset = RuleSet.from_object([{"from": "boss", "star": True}])
+    rulesets = {account.name: ruleset for account in accounts}
+
+    results = sync_accounts(
+        accounts, rulesets, lambda account: services[account.name], workers=2
+    )
+    assert [result.account.name for result in results] == ["alice", "bob", "carol"]
+    assert [result.ok for result in results] == [True, True, False]
+    assert isinstance(results[2].error, KeyError)
+    for service in services.values():
+        assert [f["criteria"] for f in service.filters.items.values()] == [
+            {"from": "boss"}
+        ]
+    assert (len(results[0].plan.create), len(results[0].plan.delete)) == (1, 1)
+
+    output = StringIO()
+    report(results, file=output)
+    lines = output.getvalue().splitlines()
+    assert lines[1].split()[:4] == ["alice", "0", "1", "1"]
+    assert "failed" in lines[3]
+
+
+def test_run_accounts(manifest, capsys):
+    services = {"alice": FakeGmail(), "bob": FakeGmail()}
+    args = create_parser().parse_args(["--sync", "--accounts", str(manifest)])
+    assert run_accounts(args, connect=lambda account: services[account.name])
+    assert len(services["alice"].filters.items) == 2
+    assert len(services["bob"].filters.items) == 1
+    assert "bob" in capsys.readouterr().out
+
+
+def test_run_accounts_dry_run(manifest):
+    services = {"alice": FakeGmail(), "bob": FakeGmail()}
+    args = create_parser().parse_args(["--sync", "-n", "--accounts", str(manifest)])
+    assert run_accounts(args, connect=lambda account: services[account.name])
+    assert not any(service.filters.items for service in services.values())
+
+
+def test_files_which_fail_to_build_only_fail_their_accounts():
+    def build_file(filename):
+        if filename == "broken":
+            raise ValueError(filename)
+        return RuleSet.from_object([{"from": filename, "archive": True}])
+
+    accounts = [
+        Account("alice", "alice.json", ["common", "broken"]),
+        Account("bob", "bob.json", ["common"]),
+    ]
+    errors = {}
+    rulesets = build_account_rulesets(accounts, build_file, errors)
+    assert list(rulesets) == ["bob"]
+    assert list(errors) == ["alice"]
+    with pytest.raises(ValueError):
+        build_account_rulesets(accounts, build_file)
+
+
+def test_run_accounts_reports_broken_configuration(manifest, tmp_path, capsys):
+    (tmp_path / "alice.yaml").write_text("- to: alice\n  bogus: true\n")
+    services = {"alice": FakeGmail(), "bob": FakeGmail()}
+    args = create_parser().parse_args(["--sync", "--accounts", str(manifest)])
+    assert not run_accounts(args, connect=lambda account: services[account.name])
+    assert not services["alice"].filters.items
+    assert len(services["bob"].filters.items) == 1
+    lines = capsys.readouterr().out.splitlines()
+    assert "failed" in lines[1] and "bogus" in lines[1]
+    assert lines[2].split()[-1] == "ok"
+
+
+def test_run_accounts_prefixes_changes_with_account(manifest, capsys):
+    services = {"alice": FakeGmail(), "bob": FakeGmail()}
+    args = create_parser().parse_args(
+        ["--sync", "--workers", "2", "--accounts", str(manifest)]
+    )
+    assert run_accounts(args, connect=lambda account: services[account.name])
+    err = capsys.readouterr().err.splitlines()
+    assert len([line for line in err if line.startswith("alice: Creating")]) == 2
+    assert len([line for line in err if line.startswith("bob: Creating")]) == 1
+    assert all(line.startswith(("alice: ", "bob: ")) for line in err)
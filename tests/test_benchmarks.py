@@ -0,0 +1,55 @@
+"""
+Smoke tests to make sure the benchmark suite keeps working as the code changes.
+"""
+
+import pytest
+from fake_gmail import FakeGmail, user_label
+
+from benchmarks import generators
+from benchmarks.suite import benchmarks, compare, measure
+from gmail_yaml_filters.ruleset import RuleSet
+from gmail_yaml_filters.upload import prune_filters_not_in_ruleset, upload_ruleset
+
+
+@pytest.mark.parametrize("benchmark", benchmarks(scale=0.01), ids=lambda b: b.name)
+def test_benchmark_runs(benchmark):
+    seconds, peak = measure(benchmark, repeat=1)
+    assert seconds > 0
+    assert peak > 0
+
+
+@pytest.mark.parametrize(
+    "data",
+    [
+        generators.flat_rules(10),
+        generators.deep_more(3, 2),
+        generators.wide_foreach(10),
+        generators.big_any_all(10, 3),
+        generators.sender_rules(10),
+    ],
+)
+def test_generators(data):
+    assert len(RuleSet.from_object(data)) >= 10
+
+
+def test_fake_gmail_keeps_state():
+    gmail = FakeGmail(labels=[user_label("one")])
+    ruleset = RuleSet.from_object([{"from": "alice", "label": "two"}])
+    upload_ruleset(ruleset, service=gmail)
+    assert {label["name"] for label in gmail.labels.items.values()} >= {"one", "two"}
+    assert len(gmail.filters.items) == 1
+
+    upload_ruleset(ruleset, service=gmail)
+    assert len(gmail.filters.items) == 1
+
+    prune_filters_not_in_ruleset(RuleSet(), service=gmail)
+    assert len(gmail.filters.items) == 0
+
+
+def test_compare():
+    baseline = {"a": {"seconds": 1.0, "peak_bytes": 100}}
+    assert compare({"a": {"seconds": 1.1, "peak_bytes": 100}}, baseline, 0.25) == []
+    assert compare({"a": {"seconds": 2.0, "peak_bytes": 100}}, baseline, 0.25) == [
+        "a seconds: 1 -> 2 (+100%)"
+    ]
+    assert compare({"b": {"seconds": 2.0, "peak_bytes": 100}}, baseline, 0.25) == []
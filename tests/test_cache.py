@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import os
+
+from gmail_yaml_filters import cache as cache_module
+from gmail_yaml_filters.cache import RuleCache, SnapshotCache
+from gmail_yaml_filters.ruleset import RuleSet
+
+
+def test_round_trip(tmpdir):
+    path = str(tmpdir.join("cache.json"))
+    cache = SnapshotCache(path)
+    cache.put("labels", [{"id": "Label_1", "name": "one"}])
+    cache.save()
+    assert SnapshotCache(path).get("labels") == [{"id": "Label_1", "name": "one"}]
+    assert SnapshotCache(path).get("filters") is None
+
+
+def test_expired(tmpdir):
+    path = str(tmpdir.join("cache.json"))
+    cache = SnapshotCache(path)
+    cache.put("labels", [])
+    cache.save()
+    assert SnapshotCache(path, ttl=-1).get("labels") is None
+
+
+def test_refresh_ignores_file(tmpdir):
+    path = str(tmpdir.join("cache.json"))
+    cache = SnapshotCache(path)
+    cache.put("labels", [])
+    cache.save()
+    assert SnapshotCache(path, refresh=True).get("labels") is None
+
+
+def test_add_and_remove(tmpdir):
+    cache = SnapshotCache(str(tmpdir.join("cache.json")))
+    cache.put("filters", [{"id": "a"}, {"id": "b"}])
+    cache.add("filters", {"id": "c"})
+    cache.remove("filters", "a")
+    assert cache.get("filters") == [{"id": "b"}, {"id": "c"}]
+
+
+def test_changes_without_save_remove_file(tmpdir):
+    path = str(tmpdir.join("cache.json"))
+    cache = SnapshotCache(path)
+    cache.put("filters", [{"id": "a"}])
+    cache.save()
+    cache = SnapshotCache(path)
+    cache.remove("filters", "a")
+    assert not os.path.exists(path)
+
+
+def test_unreadable_file_is_ignored(tmpdir):
+    path = tmpdir.join("cache.json")
+    path.write("not json")
+    assert SnapshotCache(str(path)).get("labels") is None
+
+
+def test_for_account(tmpdir):
+    one = SnapshotCache.for_account(str(tmpdir), "/one.json")
+    two = SnapshotCache.for_account(str(tmpdir), "/two.json")
+    assert one.path != two.path
+    assert os.path.dirname(one.path) == str(tmpdir)
+
+
+CONFIG = [
+    {"from": "alice", "label": "friends", "more": [{"to": "bob", "star": True}]},
+    {"for_each": ["x", "y"], "rule": {"list": "{item}", "archive": True}},
+    {"from": "alice", "label": "friends"},
+]
+
+
+def test_rule_cache_returns_equal_rules(tmpdir):
+    path = str(tmpdir.join("rules.sqlite3"))
+    expected = RuleSet.from_object(CONFIG)
+    assert list(RuleSet.from_object(CONFIG, cache=RuleCache(path))) == list(expected)
+    cache = RuleCache(path)
+    cached = RuleSet.from_object(CONFIG, cache=cache)
+    assert (cache.hits, cache.misses) == (3, 0)
+    assert list(cached) == list(expected)
+    assert [rule.flatten() for rule in cached] == [rule.flatten() for rule in expected]
+
+
+def test_rule_cache_only_builds_changed_entries(tmpdir):
+    path = str(tmpdir.join("rules.sqlite3"))
+    RuleSet.from_object(CONFIG, cache=RuleCache(path))
+    changed = CONFIG[:2] + [{"from": "carol", "label": "friends"}]
+    cache = RuleCache(path)
+    ruleset = RuleSet.from_object(changed, cache=cache)
+    assert list(ruleset) == list(RuleSet.from_object(changed))
+    assert (cache.hits, cache.misses) == (2, 1)
+
+
+def test_rule_cache_builds_duplicate_entries_once(tmpdir):
+    cache = RuleCache(str(tmpdir.join("rules.sqlite3")))
+    ruleset = RuleSet.from_object(CONFIG + CONFIG, cache=cache)
+    assert len(ruleset) == len(RuleSet.from_object(CONFIG))
+    assert (cache.hits, cache.misses) == (3, 3)
+
+
+def test_rule_cache_keyed_by_version(tmpdir):
+    path = str(tmpdir.join("rules.sqlite3"))
+    RuleSet.from_object(CONFIG, cache=RuleCache(path, version="1.0"))
+    cache = RuleCache(path, version="2.0")
+    RuleSet.from_object(CONFIG, cache=cache)
+    assert cache.hits == 0
+
+
+def test_rule_cache_prune(tmpdir):
+    path = str(tmpdir.join("rules.sqlite3"))
+    RuleSet.from_object(CONFIG, cache=RuleCache(path))
+    cache = RuleCache(path)
+    RuleSet.from_object(CONFIG[:1], cache=cache)
+    cache.prune()
+    cache = RuleCache(path)
+    RuleSet.from_object(CONFIG, cache=cache)
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+def test_rule_cache_prune_after_start(tmpdir):
+    path = str(tmpdir.join("rules.sqlite3"))
+    cache = RuleCache(path)
+    RuleSet.from_object(CONFIG[:1], cache=cache)
+    cache.start()
+    RuleSet.from_object(CONFIG[1:], cache=cache)
+    cache.prune()
+    cache = RuleCache(path)
+    RuleSet.from_object(CONFIG, cache=cache)
+    assert (cache.hits, cache.misses) == (2, 1)
+
+
+def test_rule_cache_with_jobs(tmpdir):
+    cache = RuleCache(str(tmpdir.join("rules.sqlite3")))
+    expected = list(RuleSet.from_object(CONFIG))
+    assert list(RuleSet.from_object(CONFIG, jobs=2, cache=cache)) == expected
+    assert list(RuleSet.from_object(CONFIG, jobs=2, cache=cache)) == expected
+    assert cache.hits == 3
+
+
+def test_package_version_changes_with_source(tmp_path, monkeypatch):
+    package = tmp_path / "package"
+    package.mkdir()
+    (package / "cache.py").write_text("")
+    monkeypatch.setattr(cache_module, "__file__", str(package / "cache.py"))
+    before = cache_module.package_version()
+    (package / "ruleset.py").write_text("# changed")
+    assert cache_module.package_version() != before
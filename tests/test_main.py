@@ -1,8 +1,22 @@
 from io import StringIO
 
 import pytest
+import yaml
+from fake_gmail import FakeGmail, remote_filter
 
-from gmail_yaml_filters.main import load_data_from_args
+from gmail_yaml_filters import timing
+from gmail_yaml_filters.main import (
+    Session,
+    _file_stamp,
+    create_parser,
+    iter_yaml_rules,
+    load_data_from_args,
+    main,
+    run,
+    wait_for_change,
+    watch,
+)
+from gmail_yaml_filters.ruleset import InvalidIdentifier, RuleSet
 
 
 @pytest.fixture
@@ -44,3 +58,225 @@ def test_load_data_from_filename(tmpconfig):
 def test_load_data_fails_without_filename():
     with pytest.raises(ValueError):
         load_data_from_args("upload", "")
+
+
+def test_load_data_from_multiple_documents(tmp_path):
+    fpath = tmp_path / "tmp.yaml"
+    fpath.write_text(
+        "- to: alice\n"
+        "  label: foo\n"
+        "---\n"
+        "to: bob\n"
+        "label: bar\n"
+        "---\n"
+        "- to: carol\n"
+        "  label: baz\n"
+    )
+    assert load_data_from_args("upload", fpath) == [
+        {"to": "alice", "label": "foo"},
+        {"to": "bob", "label": "bar"},
+        {"to": "carol", "label": "baz"},
+    ]
+
+
+def test_load_data_from_empty_file(tmp_path):
+    fpath = tmp_path / "tmp.yaml"
+    fpath.write_text("")
+    assert load_data_from_args("upload", fpath) == []
+
+
+def test_iter_yaml_rules_resolves_aliases():
+    stream = StringIO("- &base {to: alice, label: foo}\n- *base\n")
+    assert list(iter_yaml_rules(stream)) == [
+        {"to": "alice", "label": "foo"},
+        {"to": "alice", "label": "foo"},
+    ]
+
+
+def test_iter_yaml_rules_is_lazy():
+    rules = iter_yaml_rules(StringIO("- to: alice\n- to: [unterminated\n"))
+    assert next(rules) == {"to": "alice"}
+    with pytest.raises(yaml.YAMLError):
+        next(rules)
+
+
+def test_invalid_rule_leaves_previous_output(tmp_path, monkeypatch):
+    config = tmp_path / "tmp.yaml"
+    config.write_text("- to: alice\n  archive: true\n- to: bob\n  bogus: true\n")
+    output = tmp_path / "out.xml"
+    output.write_text("previous")
+    monkeypatch.setattr(
+        "sys.argv", ["gmail-yaml-filters", "-o", str(output), str(config)]
+    )
+    with pytest.raises(InvalidIdentifier):
+        main()
+    assert output.read_text() == "previous"
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["out.xml", "tmp.yaml"]
+
+
+def test_main_reports_timings(tmpconfig, tmp_path, monkeypatch, capsys):
+    output = tmp_path / "out.xml"
+    profile = tmp_path / "out.pstats"
+    monkeypatch.setattr(
+        "sys.argv",
+        [
+            "gmail-yaml-filters",
+            "--timings",
+            "--profile",
+            str(profile),
+            "-o",
+            str(output),
+            str(tmpconfig),
+        ],
+    )
+    main()
+    err = capsys.readouterr().err
+    for phase in ("load", "build", "serialize"):
+        assert phase in err
+    assert output.read_text().count("<entry") == 2
+    assert profile.exists()
+
+
+def test_plan_needs_gmail_action(tmpconfig, tmp_path, monkeypatch):
+    monkeypatch.setattr(
+        "sys.argv",
+        ["gmail-yaml-filters", "--plan", str(tmp_path / "plan.json"), str(tmpconfig)],
+    )
+    with pytest.raises(SystemExit):
+        main()
+
+
+def test_apply_requires_no_file():
+    assert load_data_from_args("apply", None) == []
+
+
+def test_main_with_cache_dir(tmpconfig, tmp_path, monkeypatch):
+    outputs = []
+    for n in range(2):
+        output = tmp_path / "out{0}.xml".format(n)
+        monkeypatch.setattr(
+            "sys.argv",
+            [
+                "gmail-yaml-filters",
+                "--cache-dir",
+                str(tmp_path / "cache"),
+                "-o",
+                str(output),
+                str(tmpconfig),
+            ],
+        )
+        main()
+        outputs.append(output.read_text())
+    assert (tmp_path / "cache" / "rules.sqlite3").exists()
+    assert outputs[0] == outputs[1]
+
+
+def test_wait_for_change_debounces(tmp_path):
+    config = tmp_path / "config.yaml"
+    config.write_text("- from: alice\n  archive: true\n")
+    stamp = _file_stamp(str(config))
+    edits = ["- from: bob\n", "- from: bob\n  archive: true\n"]
+    sleeps = []
+
+    def sleep(seconds):
+        sleeps.append(seconds)
+        if edits:
+            config.write_text(edits.pop(0))
+
+    new_stamp = wait_for_change(str(config), stamp, 1.0, 0.1, sleep=sleep)
+    assert new_stamp == _file_stamp(str(config))
+    # one poll, then a debounce which saw the second edit, then one which didn't
+    assert sleeps == [0.1, 1.0, 1.0]
+
+
+def test_watch_reruns_on_change(tmp_path, capsys):
+    config = tmp_path / "config.yaml"
+    config.write_text("- from: alice\n  archive: true\n")
+    output = tmp_path / "out.xml"
+    args = create_parser().parse_args(["--watch", "-o", str(output), str(config)])
+
+    def sleep(seconds):
+        if "bob" not in config.read_text():
+            config.write_text(config.read_text() + "- from: bob\n  star: true\n")
+
+    watch(args, Session(args, keep_warm=True), sleep=sleep, max_runs=2)
+    assert output.read_text().count("<entry") == 2
+    assert "Watching" in capsys.readouterr().err
+
+
+def test_watch_prunes_rules_from_earlier_edits(tmp_path):
+    config = tmp_path / "config.yaml"
+    config.write_text("- from: alice\n  archive: true\n")
+    output = tmp_path / "out.xml"
+    args = create_parser().parse_args(["--watch", "-o", str(output), str(config)])
+    session = Session(args, keep_warm=True)
+
+    def sleep(seconds):
+        if "alice" in config.read_text():
+            config.write_text("- from: bob\n  archive: true\n")
+
+    watch(args, session, sleep=sleep, max_runs=2)
+    with session.rule_cache() as rule_cache:
+        RuleSet.from_object([{"from": "alice", "archive": True}], cache=rule_cache)
+    # alice and bob were each built once by watch(), and alice was pruned
+    assert rule_cache.misses == 3
+
+
+def test_watch_reports_errors_and_continues(tmp_path, capsys):
+    config = tmp_path / "config.yaml"
+    config.write_text("- bogus: true\n")
+    output = tmp_path / "out.xml"
+    args = create_parser().parse_args(["--watch", "-o", str(output), str(config)])
+
+    def sleep(seconds):
+        if "bogus" in config.read_text():
+            config.write_text("- from: alice\n  archive: true\n")
+
+    watch(args, Session(args, keep_warm=True), sleep=sleep, max_runs=2)
+    assert "Error:" in capsys.readouterr().err
+    assert output.read_text().count("<entry") == 1
+
+
+def test_watch_only_lists_gmail_once(tmp_path):
+    config = tmp_path / "config.yaml"
+    config.write_text("- from: alice\n  archive: true\n")
+    args = create_parser().parse_args(["--watch", "--sync", str(config)])
+    gmail = FakeGmail(filters=[remote_filter(1)])
+
+    def sleep(seconds):
+        if "alice" in config.read_text():
+            config.write_text("- from: bob\n  archive: true\n")
+
+    with timing.collect() as timings:
+        watch(args, Session(args, keep_warm=True, gmail=gmail), sleep=sleep, max_runs=2)
+    assert timings.phases["list filters"].calls == 1
+    assert [f["criteria"] for f in gmail.filters.items.values()] == [{"from": "bob"}]
+
+
+def test_session_reports_requests(tmp_path, capsys):
+    config = tmp_path / "config.yaml"
+    config.write_text("- from: alice\n  archive: true\n")
+    args = create_parser().parse_args(["--upload", str(config)])
+    gmail = FakeGmail()
+    session = Session(args, gmail=gmail)
+    run(args, load_data_from_args("upload", str(config)), session)
+    session.report_requests()
+    assert "requests" not in capsys.readouterr().err
+    session.report_requests(verbose=True)
+    assert "3 requests (7 quota units)" in capsys.readouterr().err
+
+
+def test_main_compacts_rules(tmp_path, monkeypatch, capsys):
+    config = tmp_path / "config.yaml"
+    config.write_text(
+        "- from: alice\n  archive: true\n- from: bob\n  archive: true\n"
+        "- from: carol\n  star: true\n"
+    )
+    output = tmp_path / "out.xml"
+    monkeypatch.setattr(
+        "sys.argv",
+        ["gmail-yaml-filters", "--compact", "-o", str(output), str(config)],
+    )
+    main()
+    assert output.read_text().count("<entry") == 2
+    assert "Compacted 3 filters into 2" in capsys.readouterr().err
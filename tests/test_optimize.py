@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from io import StringIO
+
+from gmail_yaml_filters.optimize import (
+    compact_ruleset,
+    count_filters,
+    report_compaction,
+)
+from gmail_yaml_filters.ruleset import RuleSet
+
+
+def flattened(ruleset):
+    return [
+        {key: construct.value for key, construct in rule.flatten().items()}
+        for rule in ruleset
+    ]
+
+
+def test_combines_rules_differing_in_one_condition():
+    ruleset = RuleSet.from_object(
+        [
+            {"from": "alice", "subject": "hi", "archive": True},
+            {"from": "bob", "subject": "hi", "archive": True},
+            {"from": "carol", "subject": "hi", "archive": True},
+        ]
+    )
+    assert flattened(compact_ruleset(ruleset)) == [
+        {"from": "(alice OR bob OR carol)", "subject": "hi", "shouldArchive": "true"}
+    ]
+
+
+def test_ands_does_not_have_the_word():
+    ruleset = RuleSet.from_object(
+        [
+            {"to": "me", "missing": "spam", "star": True},
+            {"to": "me", "missing": "junk", "star": True},
+        ]
+    )
+    assert flattened(compact_ruleset(ruleset)) == [
+        {"to": "me", "doesNotHaveTheWord": "(junk AND spam)", "shouldStar": "true"}
+    ]
+
+
+def test_keeps_rules_with_different_actions_or_other_conditions():
+    ruleset = RuleSet.from_object(
+        [
+            {"from": "alice", "archive": True},
+            {"from": "bob", "star": True},
+            {"from": "carol", "to": "me", "archive": True},
+        ]
+    )
+    compacted = compact_ruleset(ruleset)
+    assert list(compacted) == list(ruleset)
+    assert all(a is b for a, b in zip(compacted, ruleset))
+
+
+def test_combines_actions_of_rules_with_same_criteria():
+    ruleset = RuleSet.from_object(
+        [
+            {"from": "alice", "archive": True},
+            {"from": "alice", "label": "friends"},
+            {"from": "bob", "archive": True, "label": "friends"},
+        ]
+    )
+    assert flattened(compact_ruleset(ruleset)) == [
+        {"from": "(alice OR bob)", "shouldArchive": "true", "label": "friends"}
+    ]
+
+
+def test_does_not_combine_conflicting_actions():
+    ruleset = RuleSet.from_object(
+        [
+            {"from": "alice", "label": "friends"},
+            {"from": "alice", "label": "family"},
+            {"from": "bob", "important": True},
+            {"from": "bob", "not_important": True},
+        ]
+    )
+    assert count_filters(compact_ruleset(ruleset)) == 4
+
+
+def test_parenthesizes_values_with_spaces():
+    ruleset = RuleSet.from_object(
+        [
+            {"match": 'foo "bar baz"', "archive": True},
+            {"match": "great discount", "archive": True},
+        ]
+    )
+    assert flattened(compact_ruleset(ruleset)) == [
+        {"hasTheWord": '("great discount" OR (foo "bar baz"))', "shouldArchive": "true"}
+    ]
+
+
+def test_splits_long_conditions():
+    ruleset = RuleSet.from_object(
+        [
+            {"from": "sender{0}@example.com".format(n), "archive": True}
+            for n in range(50)
+        ]
+    )
+    compacted = compact_ruleset(ruleset, max_length=200)
+    assert 1 < len(compacted) < 50
+    values = [rule.flatten()["from"].value for rule in compacted]
+    assert all(len(value) <= 200 for value in values)
+    assert sum(value.count("@") for value in values) == 50
+
+
+def test_leaves_unpublishable_rules_alone():
+    ruleset = RuleSet.from_object([{"from": "alice"}, {"from": "bob"}])
+    assert list(compact_ruleset(ruleset)) == list(ruleset)
+
+
+def test_report_compaction():
+    ruleset = RuleSet.from_object(
+        [{"from": "alice", "archive": True}, {"from": "bob", "archive": True}]
+    )
+    output = StringIO()
+    report_compaction(ruleset, compact_ruleset(ruleset), file=output)
+    assert output.getvalue() == "Compacted 2 filters into 1\n"
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from io import StringIO
+
+import pytest
+from fake_gmail import FakeGmail, user_label
+from mock import MagicMock
+
+from gmail_yaml_filters.plan import Plan, apply_plan, make_plan
+from gmail_yaml_filters.ruleset import RuleSet
+
+
+def remote_filters(gmail):
+    return sorted(
+        (f["criteria"]["from"], sorted(f["action"].get("addLabelIds", [])))
+        for f in gmail.filters.items.values()
+    )
+
+
+@pytest.fixture
+def ruleset():
+    return RuleSet.from_object(
+        [
+            {"from": "alice", "label": "existing"},
+            {"from": "bob", "label": "new"},
+            {"from": "carol", "archive": True},
+        ]
+    )
+
+
+@pytest.fixture
+def gmail():
+    gmail = FakeGmail(labels=[user_label("existing")])
+    gmail.filters.create(
+        "me", {"criteria": {"from": "dave"}, "action": {"removeLabelIds": ["INBOX"]}}
+    ).execute()
+    gmail.filters.create(
+        "me", {"criteria": {"from": "carol"}, "action": {"removeLabelIds": ["INBOX"]}}
+    ).execute()
+    return gmail
+
+
+def test_make_plan_does_not_change_anything(gmail, ruleset):
+    before = remote_filters(gmail)
+    plan = make_plan(ruleset, gmail)
+    assert plan.labels == ["new"]
+    assert [f["criteria"]["from"] for f in plan.create] == ["alice", "bob"]
+    assert [f["criteria"]["from"] for f in plan.delete] == ["dave"]
+    assert remote_filters(gmail) == before
+
+
+def test_make_plan_upload_only(gmail, ruleset):
+    plan = make_plan(ruleset, gmail, prune=False)
+    assert plan.delete == []
+    plan = make_plan(ruleset, gmail, upload=False)
+    assert plan.labels == plan.create == []
+
+
+def test_apply_plan(gmail, ruleset):
+    plan = make_plan(ruleset, gmail)
+    buf = StringIO()
+    plan.dump(buf)
+    buf.seek(0)
+    apply_plan(Plan.load(buf), gmail, batch_size=10)
+
+    label_ids = {label["name"]: label["id"] for label in gmail.labels.items.values()}
+    assert len(label_ids) == len(gmail.labels.items)
+    assert remote_filters(gmail) == [
+        ("alice", [label_ids["existing"]]),
+        ("bob", [label_ids["new"]]),
+        ("carol", []),
+    ]
+    assert make_plan(ruleset, gmail) == Plan()
+
+
+def test_apply_plan_does_not_list(gmail, ruleset):
+    plan = make_plan(ruleset, gmail)
+    gmail.labels.list = MagicMock()
+    gmail.filters.list = MagicMock()
+    apply_plan(plan, gmail)
+    assert not gmail.labels.list.called
+    assert not gmail.filters.list.called
+
+
+def test_apply_plan_dry_run(gmail, ruleset):
+    before = remote_filters(gmail)
+    apply_plan(make_plan(ruleset, gmail), gmail, dry_run=True)
+    assert remote_filters(gmail) == before
+
+
+def test_load_rejects_other_versions():
+    with pytest.raises(ValueError):
+        Plan.load(StringIO('{"version": 99}'))
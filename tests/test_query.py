@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import pytest
+
+from gmail_yaml_filters.query import (
+    And,
+    Not,
+    Or,
+    Raw,
+    Term,
+    canonical_criteria,
+    canonical_text,
+    canonicalize,
+    parse,
+    parse_exact,
+    to_text,
+)
+
+
+def test_parse_precedence():
+    # OR binds more tightly than AND
+    assert parse("a b OR c") == And(
+        [Term(None, "a"), Or([Term(None, "b"), Term(None, "c")])]
+    )
+    assert parse("a AND b | c") == parse("a b OR c")
+
+
+def test_parse_is_lenient():
+    assert parse("a (b") == And([Term(None, "a"), Term(None, "b")])
+    assert parse("a) b") == And([Term(None, "a"), Term(None, "b")])
+    assert parse('"a b') == Term(None, "a b", phrase=True)
+    assert parse("from:") == Term(None, "from:")
+
+
+def test_parse_caches_results():
+    assert parse("x OR y", "from") is parse("x OR y", "from")
+
+
+@pytest.mark.parametrize(
+    "text, expected",
+    [
+        ("b a", "a AND b"),
+        ("(a (b c))", "a AND b AND c"),
+        ("a OR (b OR a)", "a OR b"),
+        ("--a", "a"),
+        ("-(-(a OR b))", "a OR b"),
+        ('"b c" "a"', '"a" AND "b c"'),
+        ("{b a} c", "(a OR b) AND c"),
+        ("-(b a) c", "-(a AND b) AND c"),
+        ("from:(b OR a) subject:x", "(from:a OR from:b) AND subject:x"),
+    ],
+)
+def test_canonical_text(text, expected):
+    assert canonical_text(text) == expected
+
+
+def test_canonical_text_is_stable():
+    for text in ("a OR (b c)", '-"x y" z', "list:(a OR b) -{c d}"):
+        canonical = canonical_text(text)
+        assert canonical_text(canonical) == canonical
+
+
+def test_canonicalize_keeps_meaningful_differences():
+    assert canonicalize(parse("a b")) != canonicalize(parse("a OR b"))
+    assert canonicalize(parse('"a b"')) != canonicalize(parse("a b"))
+    assert canonicalize(parse("-a")) != canonicalize(parse("a"))
+    assert canonical_text("alice", "from") != canonical_text("alice", "to")
+
+
+def test_to_text_parenthesizes_groups():
+    node = And([Not(Or([Term(None, "a"), Term(None, "b")])), Term("from", "c d", True)])
+    assert to_text(node) == '-(a OR b) AND from:"c d"'
+    assert parse(to_text(node)) == node
+
+
+def test_canonical_criteria_combines_conditions():
+    split = [("from", "alice"), ("hasTheWord", "has:attachment")]
+    combined = [("hasTheWord", "has:attachment from:alice")]
+    assert canonical_criteria(split) == canonical_criteria(combined)
+    assert canonical_criteria([("doesNotHaveTheWord", "spam")]) == "-spam"
+    assert canonical_criteria([("hasTheWord", "-spam")]) == "-spam"
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "(foo AROUND 5 bar)",
+        "a (b",
+        "a) b",
+        '"unclosed',
+        'a "b c',
+        "a OR",
+        "OR a",
+        "a AND AND b",
+        "()",
+        "{a b",
+        "from:",
+    ],
+)
+def test_parse_exact_keeps_what_it_cannot_model(text):
+    assert parse_exact(text) == Raw(text)
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        '"cat"',
+        "from:(a OR b) -subject:x",
+        'a AND "b c" OR d',
+        "{a b} -(c d)",
+        "larger:(10M)",
+        "around:x",
+    ],
+)
+def test_parse_exact_round_trips(text):
+    node = parse_exact(text)
+    assert not isinstance(node, Raw)
+    assert parse_exact(to_text(node)) == node
+
+
+def test_quoted_words_are_not_unquoted():
+    assert to_text(canonicalize(parse('"cat" c'))) == '"cat" AND c'
+    assert canonical_text('"cat"') != canonical_text("cat")
+
+
+def test_around_is_not_an_operator():
+    assert parse("around:x") == Term(None, "around:x")
+
+
+def test_canonical_criteria_of_inexact_criteria():
+    assert canonical_criteria([("hasTheWord", "a)")]) is None
+    assert canonical_criteria([("from", "a"), ("hasTheWord", "a")]) is not None
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import pickle
 from datetime import date
 
 import pytest
@@ -8,6 +9,7 @@ import pytest
 from gmail_yaml_filters.ruleset import (
     InvalidIdentifier,
     InvalidRuleType,
+    Rule,
     RuleAction,
     RuleCondition,
     RuleSet,
@@ -269,3 +271,313 @@ def test_foreach_dict_within_nested_condition():
             )
         ],
     ]
+
+
+def test_rule_views_are_cached():
+    rule_obj = RuleSet.from_object({"from": "alice", "archive": True}).rules
+    (rule_obj,) = rule_obj
+    assert rule_obj.data is rule_obj.data
+    assert rule_obj.flatten() == rule_obj.flatten()
+    assert rule_obj.flatten() is not rule_obj.flatten()
+
+
+def test_rule_cache_invalidated_by_changes():
+    base = Rule({"from": "alice"})
+    child = Rule({"archive": True}, base_rule=base)
+    assert child.flatten() == {
+        "from": RuleCondition("from", "alice"),
+        "shouldArchive": RuleAction("shouldArchive", "true"),
+    }
+    old_hash = hash(child)
+
+    child.add_condition(RuleCondition("to", "bob"))
+    assert child.flatten()["to"] == RuleCondition("to", "bob")
+
+    base.add_condition(RuleCondition("subject", "hello"))
+    assert child.flatten()["subject"] == RuleCondition("subject", "hello")
+
+    base.add_action(RuleAction("star", True))
+    assert RuleAction("shouldStar", "true") in child.actions
+    assert hash(child) != old_hash
+
+
+def test_rule_cache_invalidated_by_apply_format():
+    base = Rule({"from": "{item}@example.com"})
+    child = Rule({"label": "{item}"}, base_rule=base)
+    assert child.conditions == [RuleCondition("from", "{item}@example.com")]
+    base.apply_format(item="alice")
+    child.apply_format(item="alice")
+    assert child.conditions == [RuleCondition("from", "alice@example.com")]
+    assert child.actions == [RuleAction("label", "alice")]
+
+
+def test_identical_constructions_are_shared():
+    one = Rule({"from": "alice", "archive": True, "label": "friends"})
+    two = Rule({"from": "alice", "archive": True, "to": {"not": "bob"}})
+    assert one.conditions[0] is two.conditions[0]
+    assert one.actions[-1] is two.actions[0]
+    assert RuleCondition.interned("to", "bob").negated() is two.conditions[1]
+
+
+def test_apply_format_does_not_change_shared_constructions():
+    one = Rule({"from": "{item}@example.com"})
+    two = Rule({"from": "{item}@example.com"})
+    one.apply_format(item="alice")
+    assert one.conditions == [RuleCondition("from", "alice@example.com")]
+    assert two.conditions == [RuleCondition("from", "{item}@example.com")]
+
+
+def test_rule_cache_invalidated_by_new_base_rule():
+    child = Rule({"archive": True}, base_rule=Rule({"from": "alice"}))
+    assert child.conditions == [RuleCondition("from", "alice")]
+    child.base_rule = Rule({"from": "bob"})
+    assert child.conditions == [RuleCondition("from", "bob")]
+
+
+def test_siblings_do_not_share_base_conditions():
+    base = Rule({"to": "team"})
+    base.data  # fill the base rule's cache
+    one = Rule({"to": "alice"}, base_rule=base)
+    two = Rule({"to": "bob"}, base_rule=base)
+    assert one.conditions == [RuleCondition("to", "alice"), RuleCondition("to", "team")]
+    assert two.conditions == [RuleCondition("to", "bob"), RuleCondition("to", "team")]
+    assert base.conditions == [RuleCondition("to", "team")]
+
+
+def test_fingerprint_ignores_construction_order():
+    one = Rule({"from": {"any": ["alice", "bob"]}, "to": ["x", "y"], "star": True})
+    two = Rule({"star": True, "to": ["y", "x"], "from": {"any": ["bob", "alice"]}})
+    assert one.fingerprint == two.fingerprint
+    assert one == two
+    assert hash(one) == hash(two)
+    assert one.fingerprint != Rule({"from": "alice", "star": True}).fingerprint
+
+
+def test_ruleset_dedupes_by_fingerprint():
+    ruleset = RuleSet.from_object([sample_rule("bill"), sample_rule("bill")])
+    assert len(ruleset) == 1
+
+
+def test_iter_from_iterable_yields_unique_rules_in_order():
+    data = [sample_rule("bill"), sample_rule("steve"), sample_rule("bill")]
+    rules = list(RuleSet.iter_from_iterable(data))
+    assert rules == list(RuleSet.from_object(data))
+    assert [r.flatten()["from"].value for r in rules] == [
+        "bill@msft.com",
+        "steve@msft.com",
+    ]
+
+
+def test_foreach_index_and_escaped_braces():
+    ruleset = RuleSet.from_object(
+        {
+            "for_each": ["alice", "bob"],
+            "rule": {"from": "{item}", "label": "{{literal}}-{index}"},
+        }
+    )
+    assert [rule.flatten()["label"].value for rule in ruleset] == [
+        "{literal}-0",
+        "{literal}-1",
+    ]
+
+
+def test_foreach_nested():
+    ruleset = RuleSet.from_object(
+        {
+            "for_each": ["x", "y"],
+            "rule": {
+                "for_each": ["alice", "bob"],
+                "rule": {"from": "{item}", "label": "{{item}}"},
+            },
+        }
+    )
+    assert sorted(
+        (rule.flatten()["from"].value, rule.flatten()["label"].value)
+        for rule in ruleset
+    ) == [("alice", "x"), ("alice", "y"), ("bob", "x"), ("bob", "y")]
+
+
+def test_foreach_does_not_share_formatted_rules():
+    ruleset = RuleSet.from_object(
+        {
+            "for_each": ["alice", "bob"],
+            "rule": {
+                "from": "{item}",
+                "more": [{"to": "me", "star": True}],
+            },
+        }
+    )
+    children = [rule for rule in ruleset if rule.base_rule is not None]
+    assert [child.flatten()["from"].value for child in children] == ["alice", "bob"]
+    assert children[0].base_rule is not children[1].base_rule
+
+
+def test_foreach_with_no_items_ignores_template():
+    assert len(RuleSet.from_object({"for_each": [], "rule": {"bogus": True}})) == 0
+
+
+def test_ruleset_with_jobs_matches_sequential():
+    data = [
+        sample_rule("bill"),
+        {"for_each": ["steve", "satya"], "rule": sample_rule("{item}")},
+        {"from": "jony", "archive": True, "more": {"to": "tim", "star": True}},
+        sample_rule("bill"),
+    ]
+    sequential = RuleSet.from_object(data)
+    parallel = RuleSet.from_object(iter(data), jobs=2)
+    assert [r.fingerprint for r in parallel] == [r.fingerprint for r in sequential]
+
+
+def test_pickled_rule_keeps_base_rule_dependency():
+    child = pickle.loads(pickle.dumps(Rule({"archive": True}, Rule({"from": "a"}))))
+    assert child.conditions == [RuleCondition("from", "a")]
+    child.base_rule.add_condition(RuleCondition("to", "b"))
+    assert RuleCondition("to", "b") in child.conditions
+
+
+def test_rules_and_constructions_have_no_instance_dict():
+    rule = Rule({"from": "alice", "to": {"not": "bob"}, "archive": True})
+    for obj in [rule] + rule.conditions + rule.actions:
+        assert not hasattr(obj, "__dict__")
+
+
+def test_pickled_condition_keeps_negation():
+    condition = RuleCondition("to", "bob", negate=True)
+    copy = pickle.loads(pickle.dumps(condition))
+    assert copy == condition
+    assert copy.negate
+    assert copy.value == "-bob"
+
+
+def test_equivalent_rules_become_one_filter():
+    ruleset = RuleSet.from_object(
+        [
+            {"from": {"any": ["alice", "bob"]}, "archive": True},
+            {"match": "(from:bob OR from:alice)", "archive": True},
+            {"from": "(bob OR alice)", "archive": True, "more": [{"star": True}]},
+            {"from": {"any": ["bob", "alice"]}, "star": True, "archive": True},
+        ]
+    )
+    assert [sorted(rule.flatten()) for rule in ruleset] == [
+        ["from", "shouldArchive"],
+        ["from", "shouldArchive", "shouldStar"],
+    ]
+    # the first way each rule was written is kept
+    assert [rule.flatten()["from"].value for rule in ruleset] == [
+        "(alice OR bob)",
+        "(bob OR alice)",
+    ]
+
+
+def test_rules_with_different_criteria_are_kept():
+    ruleset = RuleSet()
+    for data in (
+        {"from": "alice", "archive": True},
+        {"to": "alice", "archive": True},
+        {"does_not_have": "alice", "archive": True},
+        {"from": "alice", "label": "alice"},
+    ):
+        ruleset.add(Rule(data))
+    assert len(ruleset) == 4
+
+
+def test_conditions_inherited_through_more_are_simplified():
+    ruleset = RuleSet.from_object(
+        {
+            "from": {"any": ["alice", "bob"]},
+            "more": [
+                {"from": "alice", "label": "alice"},
+                {"from": {"all": ["bob", "bob"]}, "label": "bob"},
+            ],
+        }
+    )
+    assert [rule.flatten()["from"].value for rule in ruleset] == [
+        "(alice OR bob)",
+        "alice",
+        "bob",
+    ]
+
+
+def test_template_values_are_not_parsed():
+    ruleset = RuleSet.from_object(
+        {
+            "for_each": ["alice", "bob"],
+            "rule": {"from": {"any": ["{item}", "x"]}, "label": "{item}"},
+        }
+    )
+    assert [rule.flatten()["from"].value for rule in ruleset] == [
+        "(x OR alice)",
+        "(x OR bob)",
+    ]
+
+
+@pytest.mark.parametrize(
+    "one, other",
+    [
+        ('"unclosed', "unclosed"),
+        ("a)", "a"),
+        ('"cat"', "cat"),
+        ("(foo AROUND 5 bar)", "(foo bar)"),
+        ("(foo AROUND 5 bar)", "(foo AROUND 6 bar)"),
+    ],
+)
+def test_rules_which_only_parse_alike_are_kept(one, other):
+    ruleset = RuleSet.from_object(
+        [{"has": one, "archive": True}, {"has": other, "archive": True}]
+    )
+    assert len(ruleset) == 2
+
+
+def test_foreach_templates_are_not_merged_before_formatting():
+    ruleset = RuleSet.from_object(
+        {
+            "for_each": [{"user": "jo", "team": "ops"}],
+            "rule": [
+                {"to": "{user}+{team}@corp.com", "label": "L"},
+                {"to": "{team}+{user}@corp.com", "label": "L"},
+            ],
+        }
+    )
+    assert sorted(rule.flatten()["to"].value for rule in ruleset) == [
+        "jo+ops@corp.com",
+        "ops+jo@corp.com",
+    ]
+
+
+def test_foreach_placeholder_is_not_merged_with_literal_text():
+    ruleset = RuleSet.from_object(
+        {
+            "for_each": ["alice", "bob"],
+            "rule": [
+                {"from": "{item}", "archive": True},
+                {"from": "item", "archive": True},
+            ],
+        }
+    )
+    assert sorted(rule.flatten()["from"].value for rule in ruleset) == [
+        "alice",
+        "bob",
+        "item",
+    ]
+
+
+@pytest.mark.parametrize(
+    "data, expected",
+    [
+        (
+            {"has": "(foo AROUND 5 bar)", "match": "baz"},
+            "((foo AROUND 5 bar) AND baz)",
+        ),
+        ({"has": ['"cat"', "c"]}, '("cat" AND c)'),
+        ({"has": ["a)", "a"]}, "(a AND a))"),
+        ({"has": ['"unclosed', "unclosed"]}, '("unclosed AND unclosed)'),
+        ({"larger": "10M", "has": "x"}, "(larger:(10M) AND x)"),
+    ],
+)
+def test_conditions_which_cannot_be_simplified_are_unchanged(data, expected):
+    assert Rule(data).flatten()["hasTheWord"].value == expected
+
+
+def test_multiple_does_not_have_excludes_any_of_them():
+    rule = Rule({"does_not_have": ["alice", "bob"], "archive": True})
+    assert rule.flatten()["doesNotHaveTheWord"].value == "(alice OR bob)"
@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import json
+
+import googleapiclient.errors
+import httplib2
+import pytest
+from fake_gmail import FakeGmail, FakeRequest
+
+from gmail_yaml_filters.ruleset import RuleSet
+from gmail_yaml_filters.scheduler import (
+    MissingResponseError,
+    RequestScheduler,
+    TokenBucket,
+    scheduler_for,
+    use_scheduler,
+)
+from gmail_yaml_filters.upload import upload_ruleset
+
+
+def http_error(status, content=b"", **headers):
+    response = httplib2.Response(dict(headers, status=status))
+    return googleapiclient.errors.HttpError(response, content)
+
+
+LIST = "gmail.users.labels.list"
+
+
+class FlakyRequest(FakeRequest):
+    """Fails with each of the given exceptions in turn, then succeeds."""
+
+    def __init__(
+        self, errors, response="ok", func=None, method_id="gmail.users.labels.create"
+    ):
+        self.errors = list(errors)
+        self.calls = 0
+        super(FlakyRequest, self).__init__(method_id, func or (lambda: response))
+
+    def execute(self, http=None, num_retries=0):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return super(FlakyRequest, self).execute(http)
+
+
+@pytest.fixture
+def sleeps():
+    return []
+
+
+@pytest.fixture
+def scheduler(sleeps):
+    return RequestScheduler(rate=None, sleep=sleeps.append, random=lambda: 0.5)
+
+
+def test_token_bucket_refills_over_time():
+    now = [0.0]
+    bucket = TokenBucket(10, capacity=20, clock=lambda: now[0])
+    assert bucket.reserve(20) == 0
+    assert bucket.reserve(5) == 0.5
+    now[0] = 10.0
+    # refilled, but only up to capacity
+    assert bucket.reserve(20) == 0
+    assert bucket.reserve(1) == 0.1
+
+
+def test_scheduler_waits_for_quota(sleeps):
+    scheduler = RequestScheduler(rate=10, sleep=sleeps.append)
+    scheduler.bucket.clock = lambda: 0.0
+    scheduler.bucket._updated = 0.0
+    for _ in range(3):
+        scheduler.execute(FlakyRequest([]))  # 5 units each
+    assert sleeps == [0.5]
+    assert scheduler.stats.requests == 3
+    assert scheduler.stats.quota_units == 15
+    assert scheduler.stats.waited_seconds == 0.5
+
+
+def test_retries_throttled_request_with_backoff(scheduler, sleeps):
+    request = FlakyRequest(
+        [http_error(429), http_error(429), http_error(503)], method_id=LIST
+    )
+    assert scheduler.execute(request) == "ok"
+    assert request.calls == 4
+    # full jitter: random() * base_delay * 2 ** attempt
+    assert sleeps == [0.5, 1.0, 2.0]
+    stats = scheduler.stats
+    assert (stats.throttled, stats.server_errors, stats.retries) == (2, 1, 3)
+    assert stats.backoff_seconds == 3.5
+
+
+def test_backoff_is_capped(sleeps):
+    scheduler = RequestScheduler(
+        rate=None, max_delay=3, sleep=sleeps.append, random=lambda: 1.0
+    )
+    scheduler.execute(FlakyRequest([http_error(500)] * 4, method_id=LIST))
+    assert sleeps == [1.0, 2.0, 3.0, 3.0]
+
+
+def test_honours_retry_after(scheduler, sleeps):
+    scheduler.execute(FlakyRequest([http_error(429, **{"retry-after": "7"})]))
+    assert sleeps == [7.0]
+
+
+def test_retries_rate_limit_exceeded(scheduler):
+    request = FlakyRequest(
+        [
+            http_error(
+                403, b'{"error": {"errors": [{"reason": "userRateLimitExceeded"}]}}'
+            )
+        ]
+    )
+    assert scheduler.execute(request) == "ok"
+    assert scheduler.stats.throttled == 1
+
+
+@pytest.mark.parametrize("status", [400, 403, 404])
+def test_does_not_retry_other_errors(scheduler, sleeps, status):
+    request = FlakyRequest([http_error(status)])
+    with pytest.raises(googleapiclient.errors.HttpError):
+        scheduler.execute(request)
+    assert request.calls == 1
+    assert sleeps == []
+    assert scheduler.stats.retries == 0
+
+
+def test_gives_up_after_max_retries(sleeps):
+    scheduler = RequestScheduler(rate=None, max_retries=2, sleep=sleeps.append)
+    request = FlakyRequest([http_error(429)] * 5)
+    with pytest.raises(googleapiclient.errors.HttpError):
+        scheduler.execute(request)
+    assert request.calls == 3
+    assert scheduler.stats.retries == 2
+
+
+def test_execute_batch_retries_only_failures(scheduler, sleeps):
+    gmail = FakeGmail()
+    requests = [
+        FlakyRequest([], "a"),
+        FlakyRequest([http_error(429)], "b"),
+        FlakyRequest([http_error(404)], "c"),
+    ]
+    results = scheduler.execute_batch(gmail, requests)
+    assert [response for response, _ in results] == ["a", "b", None]
+    assert results[2][1].resp.status == 404
+    assert [request.calls for request in requests] == [1, 2, 1]
+    assert len(sleeps) == 1
+    assert scheduler.stats.requests == 4
+
+
+def test_scheduler_for_is_per_service():
+    one, two = FakeGmail(), FakeGmail()
+    assert scheduler_for(one) is scheduler_for(one)
+    assert scheduler_for(one) is not scheduler_for(two)
+    scheduler = use_scheduler(two, RequestScheduler(rate=None))
+    assert scheduler_for(two) is scheduler
+
+
+def test_upload_retries_throttled_requests(sleeps):
+    gmail = FakeGmail()
+    scheduler = use_scheduler(
+        gmail, RequestScheduler(rate=None, sleep=sleeps.append, random=lambda: 0)
+    )
+    create = gmail.filters.create
+    errors = [http_error(429)]
+
+    def flaky_create(userId, body):
+        request = create(userId, body)
+        return FlakyRequest([errors.pop()] if errors else [], func=request._func)
+
+    gmail.filters.create = flaky_create
+    ruleset = RuleSet.from_object([{"from": "alice", "archive": True}])
+    upload_ruleset(ruleset, service=gmail)
+    assert scheduler.stats.throttled == 1
+    assert scheduler.stats.retries == 1
+    assert len(gmail.filters.items) == 1
+
+
+def test_execute_batch_retries_requests_without_a_response(scheduler, sleeps):
+    class LossyGmail(FakeGmail):
+        """Drops the response to the first request in the first batch."""
+
+        dropped = False
+
+        def new_batch_http_request(self, callback=None):
+            def lossy(request_id, response, exception):
+                if request_id == "0" and not self.dropped:
+                    self.dropped = True
+                    return
+                callback(request_id, response, exception)
+
+            return super(LossyGmail, self).new_batch_http_request(callback=lossy)
+
+    requests = [
+        FlakyRequest([], "a", method_id=LIST),
+        FlakyRequest([], "b", method_id=LIST),
+    ]
+    results = scheduler.execute_batch(LossyGmail(), requests)
+    assert results == [("a", None), ("b", None)]
+    assert [request.calls for request in requests] == [2, 1]
+    assert scheduler.stats.retries == 1
+
+
+def test_execute_batch_gives_up_on_requests_without_a_response(sleeps):
+    class SilentGmail(FakeGmail):
+        def new_batch_http_request(self, callback=None):
+            return super(SilentGmail, self).new_batch_http_request(
+                callback=lambda *args: None
+            )
+
+    scheduler = RequestScheduler(rate=None, max_retries=1, sleep=sleeps.append)
+    ((response, exception),) = scheduler.execute_batch(
+        SilentGmail(), [FlakyRequest([], "a")]
+    )
+    assert response is None
+    assert isinstance(exception, MissingResponseError)
+
+
+def applied_then_failed(request, error):
+    """Applies a FakeRequest, but fails as if its response was lost."""
+
+    def func():
+        request._func()
+        raise error
+
+    return FakeRequest(request.methodId, func, json.loads(request.body))
+
+
+def test_does_not_resend_create_after_server_error(scheduler, sleeps):
+    request = FlakyRequest([http_error(503)])
+    with pytest.raises(googleapiclient.errors.HttpError):
+        scheduler.execute(request)
+    assert request.calls == 1
+    assert sleeps == []
+
+
+def test_create_which_was_applied_is_not_sent_again(scheduler):
+    gmail = FakeGmail()
+    request = gmail.labels.create(userId="me", body={"name": "new"})
+    created = scheduler.execute(
+        applied_then_failed(request, http_error(500)), service=gmail
+    )
+    assert created["name"] == "new"
+    names = [label["name"] for label in gmail.labels.items.values()]
+    assert names.count("new") == 1
+
+
+def test_create_which_was_not_applied_is_sent_again(scheduler):
+    gmail = FakeGmail()
+    body = {"criteria": {"from": "alice"}, "action": {"addLabelIds": ["a"]}}
+    request = gmail.filters.create(userId="me", body=body)
+    flaky = FlakyRequest([http_error(502)], func=request._func)
+    flaky.body = request.body
+    assert scheduler.execute(flaky, service=gmail)["criteria"] == {"from": "alice"}
+    assert flaky.calls == 2
+    assert len(gmail.filters.items) == 1
+
+
+def test_execute_batch_does_not_resend_applied_creates(scheduler):
+    class SilentGmail(FakeGmail):
+        """Loses the response to every request in the first batch."""
+
+        batches = 0
+
+        def new_batch_http_request(self, callback=None):
+            self.batches += 1
+            if self.batches == 1:
+                callback = None
+            return super(SilentGmail, self).new_batch_http_request(callback=callback)
+
+    gmail = SilentGmail()
+    requests = [
+        gmail.filters.create(
+            userId="me", body={"criteria": {"from": name}, "action": {}}
+        )
+        for name in ("alice", "bob")
+    ]
+    results = scheduler.execute_batch(gmail, requests)
+    assert [response["criteria"] for response, _ in results] == [
+        {"from": "alice"},
+        {"from": "bob"},
+    ]
+    assert len(gmail.filters.items) == 2
+    assert gmail.batches == 1
+
+
+def test_upload_does_not_duplicate_filters_after_server_error(sleeps):
+    gmail = FakeGmail()
+    use_scheduler(gmail, RequestScheduler(rate=None, sleep=sleeps.append))
+    create = gmail.filters.create
+    errors = [http_error(503)]
+
+    def flaky_create(userId, body):
+        request = create(userId, body)
+        if errors:
+            return applied_then_failed(request, errors.pop())
+        return request
+
+    gmail.filters.create = flaky_create
+    ruleset = RuleSet.from_object([{"from": "alice", "archive": True}])
+    upload_ruleset(ruleset, service=gmail)
+    assert len(gmail.filters.items) == 1
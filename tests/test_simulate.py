@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from datetime import datetime, timezone
+from io import StringIO
+
+import pytest
+
+from gmail_yaml_filters.corpus import Corpus
+from gmail_yaml_filters.main import main
+from gmail_yaml_filters.query import criteria_query, rule_criteria
+from gmail_yaml_filters.ruleset import RuleSet
+from gmail_yaml_filters.simulate import (
+    Needs,
+    RuleIndex,
+    compile_query,
+    parse_message,
+    shards_for,
+    simulate,
+)
+
+NOW = datetime(2024, 6, 1, tzinfo=timezone.utc)
+
+
+def message(sender, to="me@example.com", subject="hello", body="", **headers):
+    lines = [
+        "From: {0}".format(sender),
+        "To: {0}".format(to),
+        "Subject: {0}".format(subject),
+        "Date: Mon, 20 May 2024 10:00:00 +0000",
+    ]
+    lines += ["{0}: {1}".format(key.replace("_", "-"), v) for key, v in headers.items()]
+    return "\n".join(lines) + "\n\n" + body + "\n"
+
+
+MESSAGES = [
+    message("Alice <alice@example.com>", subject="Lunch?", body="see you"),
+    message("bob@example.com", subject="Weekly report", List_Id="<dev.lists.example>"),
+    message("carol@other.org", to="team@example.com", body="great discount inside"),
+    message("alice@example.com", subject="Re: Lunch?", body=">From the cafe"),
+]
+
+
+@pytest.fixture
+def mbox(tmp_path):
+    path = tmp_path / "mail.mbox"
+    path.write_text(
+        "".join("From sender Mon May 20 10:00:00 2024\n" + text for text in MESSAGES)
+    )
+    return str(path)
+
+
+@pytest.fixture
+def maildir(tmp_path):
+    path = tmp_path / "Maildir"
+    for subdir in ("cur", "new", "tmp"):
+        (path / subdir).mkdir(parents=True)
+    for n, text in enumerate(MESSAGES):
+        (path / ("cur" if n % 2 else "new") / "{0}.eml".format(n)).write_text(text)
+    return str(path)
+
+
+RULES = [
+    {"from": "alice@example.com", "label": "alice"},
+    {"from": "example.com", "subject": "report", "archive": True},
+    {"list": "dev.lists.example", "star": True},
+    {"has": "great discount", "trash": True},
+    {"to": "team@example.com", "does_not_have": "discount", "read": True},
+    {"is": "starred", "important": True},
+    {"from": "nobody", "archive": True},
+]
+EXPECTED = [2, 1, 1, 1, 0, 0, 0]
+
+
+def matches(query_criteria, text, now=NOW):
+    query = criteria_query(query_criteria)
+    data = text.encode("utf-8")
+    return compile_query(query, now)(parse_message(data, Needs.of([query])))
+
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_simulate_mbox(mbox, jobs):
+    ruleset = RuleSet.from_object(RULES)
+    result = simulate(ruleset, mbox, jobs=jobs, now=NOW)
+    assert result.messages == 4
+    assert result.counts == EXPECTED
+
+
+def test_simulate_maildir(maildir):
+    result = simulate(RuleSet.from_object(RULES), maildir, now=NOW)
+    assert result.messages == 4
+    assert result.counts == EXPECTED
+
+
+def test_mbox_shards_start_at_messages(mbox):
+    shards = shards_for(mbox, 3)
+    assert 1 < len(shards) <= 3
+    with open(mbox, "rb") as inputf:
+        data = inputf.read()
+    for _, _, start, end in shards:
+        assert data[start : start + 5] == b"From "
+    assert shards[-1][3] == len(data)
+
+
+def test_not_a_maildir(tmp_path):
+    with pytest.raises(ValueError):
+        shards_for(str(tmp_path), 1)
+
+
+def test_report_marks_approximate_rules(mbox):
+    output = StringIO()
+    simulate(RuleSet.from_object(RULES), mbox, now=NOW).report(file=output)
+    lines = output.getvalue().splitlines()
+    assert lines[0].split() == ["2", "from:alice@example.com"]
+    assert "~" in lines[5] and "is:(starred)" in lines[5]
+    assert lines[-1].startswith("Scanned 4 messages")
+
+
+def test_matches_words_not_substrings():
+    text = message("alice@example.com", subject="category news")
+    assert matches({"subject": "news"}, text)
+    assert not matches({"subject": "cat"}, text)
+    assert matches({"from": "example.com"}, text)
+
+
+def test_matches_or_and_negation():
+    text = message("bob@example.com", subject="Weekly report")
+    assert matches({"from": "(alice OR bob)"}, text)
+    assert not matches({"from": "(alice OR carol)"}, text)
+    assert matches({"hasTheWord": "-subject:(monthly)"}, text)
+    assert not matches({"doesNotHaveTheWord": "weekly"}, text)
+
+
+def test_matches_size_and_dates():
+    text = message("bob@example.com", body="x" * 2000)
+    assert matches({"hasTheWord": "larger:(1K)"}, text)
+    assert not matches({"hasTheWord": "smaller:(1K)"}, text)
+    assert matches({"hasTheWord": "after:2024/05/01"}, text)
+    assert not matches({"hasTheWord": "before:2024/05/01"}, text)
+    assert matches({"hasTheWord": "newer_than:1m"}, text)
+    assert not matches({"hasTheWord": "older_than:1m"}, text)
+
+
+def test_matches_attachments():
+    text = (
+        "From: bob@example.com\n"
+        "Content-Type: multipart/mixed; boundary=XX\n\n"
+        "--XX\nContent-Type: text/plain\n\nsee attached\n"
+        "--XX\nContent-Type: application/pdf\n"
+        'Content-Disposition: attachment; filename="invoice.pdf"\n\nPDF\n'
+        "--XX--\n"
+    )
+    assert matches({"hasTheWord": "has:attachment"}, text)
+    assert matches({"hasTheWord": "filename:(invoice.pdf)"}, text)
+    assert matches({"hasTheWord": "attached"}, text)
+    assert not matches({"hasTheWord": "filename:(report.pdf)"}, text)
+
+
+def test_only_reads_needed_headers():
+    query = criteria_query({"from": "alice"})
+    parsed = parse_message(message("alice@x").encode(), Needs.of([query]))
+    assert set(parsed.headers) == {"from"}
+    assert parsed.body == ""
+
+
+def test_rule_index_matches_same_as_testing_every_rule():
+    ruleset = RuleSet.from_object(RULES + [{"from": "alice", "larger": "1K"}])
+    queries = [criteria_query(rule_criteria(rule)) for rule in ruleset]
+    index = RuleIndex(queries, NOW)
+    needs = Needs.of(queries)
+    for text in MESSAGES:
+        parsed = parse_message(text.encode("utf-8"), needs)
+        assert sorted(index.matches(parsed)) == index.match_all(parsed)
+
+
+def test_rule_index_only_tests_candidates():
+    queries = [
+        criteria_query(criteria)
+        for criteria in (
+            {"from": "alice@example.com"},
+            {"from": "(bob OR carol)", "subject": "lunch"},
+            {"hasTheWord": "is:starred"},
+            {"doesNotHaveTheWord": "discount"},
+        )
+    ]
+    index = RuleIndex(queries, NOW)
+    assert index.unindexed == [3]
+    parsed = parse_message(MESSAGES[0].encode("utf-8"), Needs.of(queries))
+    assert index.candidates(parsed) == {0, 1, 3}
+    assert sorted(index.matches(parsed)) == [0, 3]
+
+
+def test_main_simulate(tmp_path, mbox, monkeypatch, capsys):
+    config = tmp_path / "config.yaml"
+    config.write_text("- from: alice@example.com\n  archive: true\n")
+    monkeypatch.setattr(
+        "sys.argv", ["gmail-yaml-filters", "--simulate", mbox, str(config)]
+    )
+    main()
+    out = capsys.readouterr().out
+    assert out.splitlines()[0].split() == ["2", "from:alice@example.com"]
+
+
+@pytest.fixture
+def corpus():
+    corpus = Corpus(":memory:")
+    yield corpus
+    corpus.close()
+
+
+@pytest.mark.parametrize("mailbox", ["mbox", "maildir"])
+def test_corpus_matches_same_as_simulate(request, corpus, mailbox):
+    path = request.getfixturevalue(mailbox)
+    assert corpus.ingest(path) == 4
+    result = corpus.simulate(RuleSet.from_object(RULES), path, now=NOW)
+    assert result.messages == 4
+    assert result.counts == EXPECTED
+
+
+def test_corpus_only_ingests_changed_mailboxes(corpus, mbox):
+    assert corpus.ingest(mbox) == 4
+    assert corpus.ingest(mbox) == 0
+    with open(mbox, "a") as outputf:
+        outputf.write("From x\n" + message("dave@example.com"))
+    assert corpus.ingest(mbox) == 5
+    assert corpus.count(criteria_query({"from": "example.com"}), mbox) == 4
+    assert corpus.ingest(mbox, refresh=True) == 5
+
+
+def test_corpus_queries(corpus, mbox):
+    corpus.ingest(mbox)
+
+    def matches(criteria):
+        return corpus.matches(criteria_query(criteria), mbox, now=NOW)
+
+    assert matches({"from": "alice@example.com", "subject": "lunch"}) == [1, 4]
+    assert matches({"from": "(bob OR carol)"}) == [2, 3]
+    assert matches({"doesNotHaveTheWord": "lunch OR discount"}) == [2]
+    assert matches({"hasTheWord": "list:(dev.lists.example)"}) == [2]
+    assert matches({"hasTheWord": "before:2024/05/01 OR is:starred"}) == []
+    assert matches({"hasTheWord": "-older_than:1m larger:10"}) == [1, 2, 3, 4]
+
+
+def test_main_simulate_with_corpus(tmp_path, mbox, monkeypatch, capsys):
+    config = tmp_path / "config.yaml"
+    config.write_text("- from: alice@example.com\n  archive: true\n")
+    database = tmp_path / "corpus.sqlite3"
+    argv = ["gmail-yaml-filters", "--simulate", mbox, "--corpus", str(database)]
+    monkeypatch.setattr("sys.argv", argv + [str(config)])
+    for _ in range(2):
+        main()
+        out = capsys.readouterr().out
+        assert out.splitlines()[0].split() == ["2", "from:alice@example.com"]
+    assert database.exists()
@@ -0,0 +1,64 @@
+from gmail_yaml_filters import timing
+
+
+def test_phase_without_collector_is_noop():
+    with timing.phase("anything"):
+        pass
+
+
+def test_nested_phases_count_exclusive_time(monkeypatch):
+    clock = [0.0]
+    monkeypatch.setattr(timing, "perf_counter", lambda: clock[0])
+    with timing.collect() as timings:
+        with timing.phase("outer"):
+            clock[0] += 1
+            with timing.phase("inner"):
+                clock[0] += 2
+            with timing.phase("inner"):
+                pass
+    outer, inner = timings.phases["outer"], timings.phases["inner"]
+    assert (outer.calls, inner.calls) == (1, 2)
+    assert outer.seconds == 1
+    assert inner.seconds == 2
+    assert outer.peak_bytes is None
+
+
+def test_collect_restores_previous_collector():
+    with timing.collect() as outer:
+        with timing.collect() as inner:
+            with timing.phase("x"):
+                pass
+        with timing.phase("y"):
+            pass
+    assert list(inner.phases) == ["x"]
+    assert list(outer.phases) == ["y"]
+
+
+def test_trace_memory():
+    with timing.collect(trace_memory=True) as timings:
+        with timing.phase("allocate"):
+            data = [object() for _ in range(10000)]
+    assert timings.phases["allocate"].peak_bytes > 10000 * 16
+    del data
+
+
+def test_timed_iter():
+    with timing.collect() as timings:
+        assert list(timing.timed_iter("produce", range(3))) == [0, 1, 2]
+    # one call per item, plus one for the final StopIteration
+    assert timings.phases["produce"].calls == 4
+
+
+def test_as_dict_and_report(capsys):
+    with timing.collect() as timings:
+        with timing.phase("one"):
+            pass
+    assert timings.as_dict() == {
+        "one": {
+            "calls": 1,
+            "seconds": timings.phases["one"].seconds,
+            "peak_bytes": None,
+        }
+    }
+    timings.report()
+    assert "one" in capsys.readouterr().err
@@ -1,15 +1,25 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import asyncio
+import threading
+import time
+
 import googleapiclient.errors
 import pytest
+from fake_gmail import FakeGmail, user_label
 from mock import MagicMock
 
+from gmail_yaml_filters import timing
+from gmail_yaml_filters.cache import SnapshotCache
 from gmail_yaml_filters.ruleset import RuleSet
 from gmail_yaml_filters.upload import (
     GmailFilters,
     GmailLabels,
+    RequestBatcher,
+    RequestQueue,
     fake_label,
+    prune_filters_not_in_ruleset,
     prune_labels_not_in_ruleset,
     upload_ruleset,
 )
@@ -137,3 +147,250 @@ def test_prune_labels_not_in_ruleset_continue_on_http_error(fake_gmail):
 
     prune_labels_not_in_ruleset(ruleset, fake_gmail, continue_on_http_error=True)
     assert fake_gmail.users().labels().delete().execute.call_count == 2
+
+
+def test_upload_records_timings(fake_gmail):
+    ruleset = RuleSet.from_object([{"from": "alice", "label": "new"}])
+    with timing.collect() as timings:
+        upload_ruleset(ruleset, fake_gmail)
+    assert timings.phases["list labels"].calls == 1
+    assert timings.phases["list filters"].calls == 1
+    assert timings.phases["create label"].calls == 1
+    assert timings.phases["create filter"].calls == 1
+
+
+def http_error(status=400):
+    return googleapiclient.errors.HttpError(MagicMock(status=status), b"")
+
+
+def test_upload_in_batches():
+    gmail = FakeGmail()
+    gmail.new_batch_http_request = MagicMock(wraps=gmail.new_batch_http_request)
+    ruleset = RuleSet.from_object(
+        [{"from": name, "archive": True} for name in ("alice", "bob", "carol", "dave")]
+    )
+    upload_ruleset(ruleset, gmail, batch_size=2)
+    assert gmail.new_batch_http_request.call_count == 2
+    assert len(gmail.filters.items) == 4
+
+
+def test_upload_in_batches_dry_run():
+    gmail = FakeGmail()
+    ruleset = RuleSet.from_object([{"from": "alice", "archive": True}])
+    upload_ruleset(ruleset, gmail, batch_size=2, dry_run=True)
+    assert len(gmail.filters.items) == 0
+
+
+def test_prune_filters_in_batches():
+    gmail = FakeGmail(filters=[fake_gmail_filter(x) for x in range(5)])
+    prune_filters_not_in_ruleset(RuleSet(), gmail, batch_size=3)
+    assert len(gmail.filters.items) == 0
+
+
+def test_batch_raises_after_whole_batch(capsys):
+    gmail = FakeGmail()
+    requests = [MagicMock() for _ in range(3)]
+    requests[1].execute.side_effect = http_error()
+    batcher = RequestBatcher(gmail, batch_size=10)
+    for n, request in enumerate(requests):
+        batcher.add(request, description="request {}".format(n))
+    with pytest.raises(googleapiclient.errors.HttpError):
+        batcher.flush()
+    assert [r.execute.call_count for r in requests] == [1, 1, 1]
+    assert "Failed: request 1" in capsys.readouterr().err
+
+
+def test_batch_reports_each_error():
+    gmail = FakeGmail()
+    errors, responses = [], []
+    batcher = RequestBatcher(
+        gmail, batch_size=10, on_error=lambda d, e: errors.append(d)
+    )
+    for n in range(4):
+        request = MagicMock()
+        request.execute.return_value = n
+        if n % 2:
+            request.execute.side_effect = http_error()
+        batcher.add(request, description=n, on_success=responses.append)
+    batcher.flush()
+    assert errors == [1, 3]
+    assert responses == [0, 2]
+
+
+def test_prune_labels_in_batches_continue_on_http_error(fake_gmail, capsys):
+    ruleset = RuleSet.from_object([{"from": "alice", "label": "one"}])
+    fake_gmail.new_batch_http_request = FakeGmail().new_batch_http_request
+    fake_gmail.users().labels().delete().execute.side_effect = http_error()
+    prune_labels_not_in_ruleset(
+        ruleset, fake_gmail, continue_on_http_error=True, batch_size=5
+    )
+    assert capsys.readouterr().err.count("Failed to delete label") == 2
+
+
+def test_filter_exists_ignores_label_order(fake_gmail):
+    fake_gmail.fake_filters[0]["action"]["addLabelIds"] = ["b", "a"]
+    filters = GmailFilters(fake_gmail)
+    assert filters.exists(
+        {"criteria": {"from": "one@example.com"}, "action": {"addLabelIds": ["a", "b"]}}
+    )
+    assert not filters.exists(
+        {"criteria": {"from": "one@example.com"}, "action": {"addLabelIds": ["a"]}}
+    )
+
+
+def test_prunable_keeps_order(fake_gmail):
+    filters = GmailFilters(fake_gmail)
+    assert filters.prunable([]) == fake_gmail.fake_filters
+    assert filters.prunable([fake_gmail_filter("one")]) == [fake_gmail.fake_filters[1]]
+
+
+def test_upload_does_not_create_same_filter_twice(fake_gmail):
+    # both labels resolve to the same existing label, so the filters are identical
+    ruleset = RuleSet.from_object(
+        [{"from": "alice", "label": "one"}, {"from": "alice", "label": "ONE"}]
+    )
+    assert len(ruleset) == 2
+    upload_ruleset(ruleset, fake_gmail)
+    assert fake_gmail.users().settings().filters().create.call_count == 1
+
+
+def test_upload_with_cache_lists_once(tmpdir):
+    gmail = FakeGmail()
+    path = str(tmpdir.join("cache.json"))
+    ruleset = RuleSet.from_object([{"from": "alice", "label": "one"}])
+    with timing.collect() as timings:
+        upload_ruleset(ruleset, gmail, cache=SnapshotCache(path))
+        upload_ruleset(ruleset, gmail, cache=SnapshotCache(path))
+        prune_filters_not_in_ruleset(ruleset, gmail, cache=SnapshotCache(path))
+    assert timings.phases["list labels"].calls == 1
+    assert timings.phases["list filters"].calls == 1
+    assert timings.phases["create label"].calls == 1
+    assert timings.phases["create filter"].calls == 1
+    assert "delete filter" not in timings.phases
+    assert SnapshotCache(path).get("filters") == list(gmail.filters.items.values())
+
+
+def test_prune_with_cache_updates_snapshot(tmpdir):
+    gmail = FakeGmail(filters=[fake_gmail_filter(x) for x in range(3)])
+    path = str(tmpdir.join("cache.json"))
+    prune_filters_not_in_ruleset(RuleSet(), gmail, cache=SnapshotCache(path))
+    assert SnapshotCache(path).get("filters") == []
+
+
+def test_dry_run_does_not_update_cache(tmpdir):
+    gmail = FakeGmail()
+    path = str(tmpdir.join("cache.json"))
+    ruleset = RuleSet.from_object([{"from": "alice", "archive": True}])
+    upload_ruleset(ruleset, gmail, dry_run=True, cache=SnapshotCache(path))
+    assert SnapshotCache(path).get("filters") == []
+
+
+class SlowRequest(object):
+    """Records how many requests are executing at once."""
+
+    def __init__(self, tracker, response=None):
+        self.tracker = tracker
+        self.response = response
+
+    def execute(self, http=None):
+        with self.tracker["lock"]:
+            self.tracker["running"] += 1
+            self.tracker["peak"] = max(self.tracker["peak"], self.tracker["running"])
+            self.tracker["https"].add(http)
+        time.sleep(0.02)
+        with self.tracker["lock"]:
+            self.tracker["running"] -= 1
+        return self.response
+
+
+def test_request_queue_limits_concurrency():
+    tracker = {"lock": threading.Lock(), "running": 0, "peak": 0, "https": set()}
+    requests = RequestQueue(FakeGmail(), concurrency=3, http_factory=lambda: object())
+
+    async def execute_all():
+        return await asyncio.gather(
+            *(requests.execute(SlowRequest(tracker, n)) for n in range(9))
+        )
+
+    assert requests.run(execute_all()) == list(range(9))
+    assert tracker["peak"] == 3
+    # each thread made its own Http object
+    assert 1 < len(tracker["https"]) <= 3
+
+
+def test_upload_filter_waits_for_its_label():
+    gmail = FakeGmail(labels=[user_label("existing")])
+    ruleset = RuleSet.from_object(
+        [
+            {"from": "alice", "label": "new"},
+            {"from": "bob", "label": "existing"},
+            {"from": "carol", "label": "new", "star": True},
+        ]
+    )
+    upload_ruleset(ruleset, gmail, concurrency=4, http_factory=object)
+    label_ids = {label["name"]: label["id"] for label in gmail.labels.items.values()}
+    assert len(label_ids) == len(gmail.labels.items)  # "new" was only created once
+    assert sorted(
+        (f["criteria"]["from"], sorted(f["action"]["addLabelIds"]))
+        for f in gmail.filters.items.values()
+    ) == [
+        ("alice", [label_ids["new"]]),
+        ("bob", [label_ids["existing"]]),
+        ("carol", sorted([label_ids["new"], "STARRED"])),
+    ]
+
+
+def test_upload_continues_after_error(capsys):
+    gmail = FakeGmail()
+    create = gmail.filters.create
+
+    def failing_create(userId, body):
+        if body["criteria"]["from"] == "bob":
+            return MagicMock(execute=MagicMock(side_effect=http_error()))
+        return create(userId, body)
+
+    gmail.filters.create = failing_create
+    ruleset = RuleSet.from_object(
+        [{"from": name, "archive": True} for name in ("alice", "bob", "carol")]
+    )
+    with pytest.raises(googleapiclient.errors.HttpError):
+        upload_ruleset(ruleset, gmail, concurrency=2, http_factory=object)
+    assert len(gmail.filters.items) == 2
+    assert "Failed:" in capsys.readouterr().err
+
+
+def test_upload_matches_labels_being_created_like_existing_ones():
+    gmail = FakeGmail()
+    existing = set(gmail.labels.items)
+    ruleset = RuleSet.from_object(
+        [
+            {"from": "alice", "label": "foo bar"},
+            {"from": "bob", "label": "foo-bar"},
+            {"from": "carol", "label": "Foo Bar"},
+        ]
+    )
+    upload_ruleset(ruleset, gmail, concurrency=4, http_factory=object)
+    (label_id,) = set(gmail.labels.items) - existing
+    assert [f["action"]["addLabelIds"] for f in gmail.filters.items.values()] == [
+        [label_id]
+    ] * 3
+
+
+def test_request_queue_needs_an_http_for_each_thread():
+    with pytest.raises(ValueError):
+        RequestQueue(FakeGmail(), concurrency=2)
+
+
+def test_upload_from_a_running_event_loop():
+    gmail = FakeGmail()
+    ruleset = RuleSet.from_object([{"from": "alice", "archive": True}])
+
+    async def upload():
+        upload_ruleset(ruleset, gmail)
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(upload())
+    finally:
+        loop.close()
+    assert len(gmail.filters.items) == 1
@@ -1,10 +1,14 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import re
+from io import BytesIO
+
 import pytest
+from lxml import etree
 
 from gmail_yaml_filters.main import ruleset_to_xml
-from gmail_yaml_filters.ruleset import RuleSet
+from gmail_yaml_filters.ruleset import RuleSet, ruleset_to_etree, write_ruleset_xml
 
 NS = {"apps": "http://schemas.google.com/apps/2006"}
 
@@ -43,3 +47,62 @@ def test_ruleset_with_empty_rule():
     """
     xml = ruleset_to_xml(RuleSet.from_object([{"from": "alice"}]))
     assert "<entry>" not in xml
+
+
+def test_ruleset_to_xml_ids_are_stable(ruleset):
+    """
+    Tests that entry ids are derived from the rule's content, not from hash().
+    """
+    (rule, _) = ruleset
+    xml = ruleset_to_xml(ruleset)
+    assert "filter:{0}</id>".format(int(rule.fingerprint, 16)) in xml
+
+
+def test_write_ruleset_xml_matches_etree(ruleset, tmp_path):
+    """
+    Tests that the streaming writer produces the same document as the tree.
+    """
+    fpath = tmp_path / "filters.xml"
+    with open(fpath, "wb") as outputf:
+        write_ruleset_xml(iter(ruleset), outputf)
+    written = etree.parse(str(fpath)).getroot()
+    expected = etree.fromstring(etree.tostring(ruleset_to_etree(ruleset)))
+    assert [el.tag for el in written.iter()] == [el.tag for el in expected.iter()]
+    assert written.findall("{*}entry/apps:property", NS)[0].attrib == {
+        "name": "from",
+        "value": "alice@aapl.com",
+    }
+
+
+def test_write_ruleset_xml_is_incremental():
+    """
+    Tests that each entry is written before the next rule is requested.
+    """
+    output = BytesIO()
+    sizes = []
+
+    def rules():
+        for name in ("alice", "bob", "carol"):
+            sizes.append(len(output.getvalue()))
+            yield from RuleSet.from_object(sample_rule(name))
+
+    write_ruleset_xml(rules(), output)
+    assert sizes[0] < sizes[1] < sizes[2]
+
+
+@pytest.mark.parametrize("pretty_print", [True, False])
+def test_write_ruleset_xml_is_same_as_serialized_etree(ruleset, pretty_print):
+    """
+    Tests that namespaces are only declared by the <feed> element.
+    """
+    output = BytesIO()
+    write_ruleset_xml(iter(ruleset), output, pretty_print=pretty_print)
+    expected = etree.tostring(
+        ruleset_to_etree(ruleset),
+        xml_declaration=True,
+        encoding="utf8",
+        pretty_print=pretty_print,
+    )
+    updated = re.compile(rb"<updated>[^<]*</updated>")
+    assert updated.sub(b"", output.getvalue()) == updated.sub(b"", expected)
+    assert output.getvalue().count(b"xmlns") == 2